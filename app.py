@@ -1,14 +1,30 @@
-from flask import Flask, render_template, jsonify, request
+from flask import Flask, render_template, jsonify, request, Response, make_response
 from src.inventory_manager import InventoryManager
 from src.goods_inward import GoodsInwardManager
 from src.inventory_adjustment import AdjustmentManager
-import collections
-from datetime import datetime
-from src import toast_api
-from src.database import get_connection, init_db
+import csv
+import hashlib
+import io
+import os
+from src import toast_api, rollups, http_cache, metrics, sql_trace, forecast, plate_costs, units
+from src.dashboard import build_view_model, get_data_key
+from src.database import get_connection, init_db, get_version
+from src.stock_ledger import stock_at
+from src.history import HistoryManager
+from src.orders import OrderManager
+from src.live_updates import stream_events
+from src.logger import get_logger
+from src.variance import variance_report
+from src.stock_alerts import get_alerts
+from src.recipe_replay import replay_recipe
 
 app = Flask(__name__, static_folder='static', static_url_path='/static')
 app.config['TEMPLATES_AUTO_RELOAD'] = True
+http_cache.init_app(app)
+metrics.init_app(app)
+sql_trace.init_app(app)
+DASHBOARD_TEMPLATE = os.path.join(app.root_path, 'templates', 'index.html')
+logger = get_logger('app')
 
 # Initialize database on startup
 init_db()
@@ -16,50 +32,40 @@ init_db()
 inventory = InventoryManager()
 delivery_manager = GoodsInwardManager()
 adjustment_manager = AdjustmentManager()
+history_manager = HistoryManager()
+order_manager = OrderManager()
+
+# (data key, html, etag, last_modified) for the most recently rendered dashboard
+_dashboard_cache = None
+
+def _render_dashboard():
+    """Serve index.html from cache while the ingredient/recipe data versions are unchanged"""
+    global _dashboard_cache
+    key, last_modified = get_data_key()
+    # Template edits should show up too when TEMPLATES_AUTO_RELOAD is on
+    key += (os.path.getmtime(DASHBOARD_TEMPLATE),)
+    
+    cached = _dashboard_cache
+    if cached is None or cached[0] != key:
+        view = build_view_model(inventory.get_all_stock(), inventory.get_all_recipes(), forecast.get_forecasts())
+        html = render_template('index.html', **view)
+        cached = (key, html, hashlib.sha1(html.encode('utf-8')).hexdigest(), last_modified)
+        _dashboard_cache = cached
+    
+    response = make_response(cached[1])
+    response.set_etag(cached[2])
+    if cached[3]:
+        response.last_modified = cached[3]
+    response.cache_control.no_cache = True
+    return response.make_conditional(request)
 
 @app.route('/')
 def index():
     """Load main dashboard"""
     try:
-        stock = inventory.get_all_stock()
-        recipes = inventory.get_all_recipes()
-        sorted_stock = sorted(stock, key=lambda x: x['name'])
-
-        inventory_by_category = collections.defaultdict(list)
-        category_order = ["Meat", "Bread", "Produce", "Dairy", "sides", "Sauce", "Drink", "Dessert"]
-        
-        for item in stock:
-            cat = item.get('category', 'Other')
-            qty = item.get('quantity', item.get('current_stock', 0))
-            threshold = item.get('threshold', 0)
-            
-            normalized_item = {
-                'id': item['id'],
-                'name': item['name'],
-                'current_stock': qty,
-                'unit': item['unit'],
-                'low_stock_threshold': threshold,
-                'category': cat,
-                'cost_per_unit': item.get('cost_per_unit', 0)
-            }
-            inventory_by_category[cat].append(normalized_item)
-
-        sorted_inventory = {}
-        for cat in category_order:
-            if cat in inventory_by_category:
-                sorted_inventory[cat] = inventory_by_category[cat]
-        for cat in inventory_by_category:
-            if cat not in sorted_inventory:
-                sorted_inventory[cat] = inventory_by_category[cat]
-
-        return render_template('index.html', 
-                             inventory_by_category=sorted_inventory,
-                             all_ingredients=sorted_stock,
-                             recipes=recipes or {})
+        return _render_dashboard()
     except Exception as e:
-        print(f"Error loading dashboard: {str(e)}")
-        import traceback
-        traceback.print_exc()
+        logger.exception(f"Error loading dashboard: {str(e)}")
         # Render template with empty data as fallback
         try:
             return render_template('index.html', 
@@ -72,7 +78,7 @@ def index():
 @app.route('/api/sync/toast', methods=['POST'])
 def sync_toast():
     """Initial check/preview for sync"""
-    print(f"\n[{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] Received sync preview request")
+    logger.info("Received sync preview request")
     try:
         # We call run_sync with dry_run=True to get the preview
         success, result = toast_api.run_sync(dry_run=True)
@@ -92,66 +98,30 @@ def sync_toast():
         
         return jsonify({"status": "error", "message": result}), 500
     except Exception as e:
-        import traceback
-        traceback.print_exc()
+        logger.exception(f"Sync failed: {e}")
         return jsonify({"status": "error", "message": str(e)}), 500
 
 @app.route('/api/sync/toast/confirm', methods=['POST'])
 def confirm_sync():
     """Finalize the sync after user approval"""
-    print(f"\n[{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] Received sync confirmation")
+    logger.info("Received sync confirmation")
     try:
         success, message = toast_api.run_sync(dry_run=False)
         if success:
+            try:
+                # New sales move the usage curves; the rebuild is a single vectorized pass
+                forecast.recompute()
+            except Exception as e:
+                logger.warning(f"Forecast recompute after sync failed: {e}")
             return jsonify({"status": "success", "message": message})
         return jsonify({"status": "error", "message": message}), 500
     except Exception as e:
-        import traceback
-        traceback.print_exc()
+        logger.exception(f"Sync failed: {e}")
         return jsonify({"status": "error", "message": str(e)}), 500
 
 @app.route('/dashboard')
 def dashboard():
-    # Get raw stock data
-    stock = inventory.get_all_stock()
-    recipes = inventory.get_all_recipes()
-    
-    # Sort alphabetical for fields
-    sorted_stock = sorted(stock, key=lambda x: x['name'])
-
-    # Group by category for Dashboard View
-    inventory_by_category = collections.defaultdict(list)
-    category_order = ["Meat", "Bread", "Produce", "Dairy", "sides", "Sauce", "Drink", "Dessert"]
-    
-    for item in stock:
-        cat = item.get('category', 'Other')
-        qty = item.get('quantity', item.get('current_stock', 0))
-        threshold = item.get('threshold', 0)
-        
-        normalized_item = {
-            'id': item['id'],
-            'name': item['name'],
-            'current_stock': qty,
-            'unit': item['unit'],
-            'low_stock_threshold': threshold,
-            'category': cat,
-            'cost_per_unit': item.get('cost_per_unit', 0)
-        }
-        inventory_by_category[cat].append(normalized_item)
-
-    # Sort categories
-    sorted_inventory = {}
-    for cat in category_order:
-        if cat in inventory_by_category:
-            sorted_inventory[cat] = inventory_by_category[cat]
-    for cat in inventory_by_category:
-        if cat not in sorted_inventory:
-            sorted_inventory[cat] = inventory_by_category[cat]
-
-    return render_template('index.html', 
-                         inventory_by_category=sorted_inventory,
-                         all_ingredients=sorted_stock,
-                         recipes=recipes)
+    return _render_dashboard()
 
 
 @app.route('/api/toast/menu')
@@ -165,43 +135,81 @@ def get_toast_menu():
         return jsonify(menu)
     return jsonify({"status": "error", "message": "Failed to fetch menu from Toast"}), 500
 
-@app.route('/api/menu/local')
-def get_local_menu():
-    """Load menu items from database"""
+def _data_version(name):
+    conn = get_connection()
+    try:
+        return get_version(conn.cursor(), name)
+    finally:
+        conn.close()
+
+def _load_local_menu():
+    conn = get_connection()
+    cursor = conn.cursor()
     try:
-        # Load from menu_items in database
-        conn = get_connection()
-        cursor = conn.cursor()
         cursor.execute('''
             SELECT item_guid, item_name, menu, group_path 
             FROM menu_items 
             ORDER BY menu, item_name
         ''')
         rows = cursor.fetchall()
+    finally:
         conn.close()
-        
-        menu_items = []
-        for row in rows:
-            menu_items.append({
-                'guid': row['item_guid'],
-                'name': row['item_name'],
-                'menu': row['menu'],
-                'group': row['group_path']
-            })
-        
-        return jsonify({"status": "success", "menu_items": menu_items})
+    
+    menu_items = []
+    for row in rows:
+        menu_items.append({
+            'guid': row['item_guid'],
+            'name': row['item_name'],
+            'menu': row['menu'],
+            'group': row['group_path']
+        })
+    return {"status": "success", "menu_items": menu_items}
+
+@app.route('/api/menu/local')
+def get_local_menu():
+    """Load menu items from database"""
+    try:
+        return http_cache.versioned_json_response('menu_items', _data_version('menu_items'), _load_local_menu)
     except Exception as e:
         return jsonify({"status": "error", "message": str(e)}), 500
 
 
 @app.route('/api/recipes', methods=['GET'])
 def get_recipes():
-    return jsonify(inventory.get_all_recipes())
+    return http_cache.versioned_json_response('recipes', _data_version('recipes'), inventory.get_all_recipes)
 
 
 @app.route('/api/stock')
 def api_stock():
-    return jsonify(inventory.get_all_stock())
+    return http_cache.versioned_json_response('ingredients', _data_version('ingredients'), inventory.get_all_stock)
+
+@app.route('/api/stock/at')
+def api_stock_at():
+    """Point-in-time stock from the ledger: ?ts=<ISO timestamp>[&ingredient_id=...]"""
+    as_of = request.args.get('ts')
+    if not as_of:
+        return jsonify({"status": "error", "message": "ts is required"}), 400
+    try:
+        balances = stock_at(as_of, ingredient_id=request.args.get('ingredient_id'))
+        return jsonify({"status": "success", "as_of": as_of, "stock": balances})
+    except Exception as e:
+        return jsonify({"status": "error", "message": str(e)}), 500
+
+@app.route('/metrics')
+def metrics_endpoint():
+    """Prometheus scrape endpoint (aggregated across workers)"""
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/api/stream/stock')
+def stream_stock():
+    """Server-Sent Events feed of per-ingredient stock changes (resumable via Last-Event-ID)"""
+    last_event_id = request.headers.get('Last-Event-ID') or request.args.get('last_event_id')
+    if last_event_id is not None and not last_event_id.isdigit():
+        return jsonify({"status": "error", "message": "Invalid Last-Event-ID"}), 400
+    response = Response(metrics.TrackedStream(stream_events(last_event_id)), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
 
 @app.route('/api/ingredients', methods=['POST'])
 def add_ingredient():
@@ -232,6 +240,39 @@ def update_ingredient(id):
         if success:
             return jsonify({"status": "success", "message": "Ingredient updated"})
         return jsonify({"status": "error", "message": "Ingredient not found"}), 404
+    except ValueError as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
+    except Exception as e:
+        return jsonify({"status": "error", "message": str(e)}), 500
+
+@app.route('/api/ingredients/<id>/units', methods=['GET'])
+def get_ingredient_units(id):
+    """Pack sizes defined for an ingredient"""
+    try:
+        return jsonify({"status": "success", "units": units.get_ingredient_units(id)})
+    except Exception as e:
+        return jsonify({"status": "error", "message": str(e)}), 500
+
+@app.route('/api/ingredients/<id>/units', methods=['POST'])
+def set_ingredient_unit(id):
+    """Define a pack size (JSON: unit, stock_units = stock units in one `unit`)"""
+    data = request.get_json(silent=True) or {}
+    try:
+        recompiled = units.set_ingredient_unit(id, data.get('unit'), data.get('stock_units', 0))
+        return jsonify({"status": "success", "message": f"Pack size saved, {recompiled} recipe(s) updated"})
+    except (TypeError, ValueError) as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
+    except Exception as e:
+        return jsonify({"status": "error", "message": str(e)}), 500
+
+@app.route('/api/ingredients/<id>/units/<unit>', methods=['DELETE'])
+def delete_ingredient_unit(id, unit):
+    try:
+        if units.delete_ingredient_unit(id, unit):
+            return jsonify({"status": "success", "message": "Pack size removed"})
+        return jsonify({"status": "error", "message": "Pack size not found"}), 404
+    except ValueError as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
     except Exception as e:
         return jsonify({"status": "error", "message": str(e)}), 500
 
@@ -265,17 +306,17 @@ def receive_delivery():
 
 @app.route('/api/receive/bulk', methods=['POST'])
 def receive_bulk_delivery():
-    data = request.json
+    data = request.get_json(silent=True)
     try:
-        items = data.get('items', [])
-        if not items:
+        items = data.get('items', []) if isinstance(data, dict) else None
+        if not items or not isinstance(items, list):
             return jsonify({"status": "error", "message": "No items provided"}), 400
             
-        success = delivery_manager.receive_multiple_items(items)
+        report = delivery_manager.receive_bulk(items)
         
-        if success:
-            return jsonify({"status": "success", "message": f"Successfully received {len(items)} items"})
-        return jsonify({"status": "warning", "message": "Completed with some potential warnings"}), 200
+        if report['success']:
+            return jsonify({"status": "success", "message": f"Successfully received {report['received']} items", "results": report['results']})
+        return jsonify({"status": "error", "message": "No items received: some lines are invalid", "results": report['results']}), 400
     except Exception as e:
         return jsonify({"status": "error", "message": str(e)}), 500
 
@@ -302,35 +343,150 @@ def log_waste_legacy():
     # Keep for compatibility with old UI calls
     return log_adjustment()
 
+@app.route('/api/waste/summary')
+def get_waste_summary():
+    """Waste by ingredient and reason: ?days=30, or ?start=YYYY-MM-DD&end=YYYY-MM-DD (end exclusive)"""
+    try:
+        summary = adjustment_manager.get_adjustment_summary(
+            days=request.args.get('days', 30, type=int),
+            start=request.args.get('start'),
+            end=request.args.get('end')
+        )
+        return jsonify({"status": "success", **summary})
+    except ValueError as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
+    except Exception as e:
+        return jsonify({"status": "error", "message": str(e)}), 500
+
+@app.route('/api/variance')
+def get_variance():
+    """Theoretical vs actual usage: ?start=&end= (YYYY-MM-DD, end exclusive), ?period=day|week|month, ?ingredient_id="""
+    try:
+        report = variance_report(
+            start=request.args.get('start'),
+            end=request.args.get('end'),
+            period=request.args.get('period', 'week'),
+            ingredient_id=request.args.get('ingredient_id')
+        )
+        return jsonify({"status": "success", **report})
+    except ValueError as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
+    except Exception as e:
+        return jsonify({"status": "error", "message": str(e)}), 500
+
+def _iter_stock_counts():
+    """Yield (ingredient_id, counted) pairs from a CSV upload/body or a JSON list"""
+    if request.files.get('file'):
+        stream = io.TextIOWrapper(request.files['file'].stream, encoding='utf-8-sig')
+    elif request.mimetype == 'text/csv':
+        # Read the body incrementally instead of buffering the whole upload
+        stream = io.TextIOWrapper(request.stream, encoding='utf-8-sig')
+    else:
+        data = request.get_json() or {}
+        rows = data if isinstance(data, list) else data.get('counts', [])
+        for row in rows:
+            # Anything but an object is passed on as None so it is reported as a bad line
+            yield (row.get('ingredient_id'), row.get('counted', row.get('quantity'))) if isinstance(row, dict) else None
+        return
+    
+    for row in csv.DictReader(stream):
+        yield row.get('ingredient_id'), row.get('counted', row.get('quantity'))
+
+@app.route('/api/adjust/bulk', methods=['POST'])
+def log_stock_count():
+    """Apply a full stocktake (CSV with ingredient_id,counted columns or JSON list)"""
+    try:
+        if request.mimetype == 'application/json':
+            options = request.get_json() or {}
+            if not isinstance(options, dict):
+                options = {}
+        elif request.mimetype == 'multipart/form-data':
+            # Upload forms send staff/reason next to the file
+            options = request.values
+        else:
+            options = request.args
+        report = adjustment_manager.apply_stock_count(
+            _iter_stock_counts(),
+            staff_member=options.get('staff', ''),
+            reason=options.get('reason') or 'Stock Count',
+            notes=options.get('notes', '')
+        )
+        if report['success']:
+            return jsonify({
+                "status": "success",
+                "message": f"Stock count applied: {report['adjusted']} adjusted, {report['unchanged']} unchanged",
+                "results": report['results']
+            })
+        return jsonify({"status": "error", "message": "Stock count rejected: some lines are invalid", "results": report['results']}), 400
+    except Exception as e:
+        return jsonify({"status": "error", "message": str(e)}), 500
+
 @app.route('/api/history')
 def get_history():
-    # Fetch recent deliveries and manual adjustments
-    deliveries = delivery_manager.load_delivery_history().get('deliveries', [])[-10:]
-    adjustments = adjustment_manager.load_adjustment_history().get('adjustments', [])[-10:]
+    # Fetch the most recent deliveries and manual adjustments
+    deliveries = delivery_manager.load_delivery_history(limit=10).get('deliveries', [])
+    adjustments = adjustment_manager.load_adjustment_history(limit=10).get('adjustments', [])
     
     return jsonify({
-        "deliveries": sorted(deliveries, key=lambda x: x['timestamp'], reverse=True),
-        "waste": sorted(adjustments, key=lambda x: x['timestamp'], reverse=True)
+        "deliveries": deliveries,
+        "waste": adjustments
     })
 
+@app.route('/api/history/events')
+def get_history_events():
+    """Merged deliveries/adjustments/sales stream with keyset paging and filters"""
+    try:
+        types = request.args.get('type')
+        page = history_manager.get_events(
+            limit=request.args.get('limit', 50, type=int),
+            cursor=request.args.get('cursor'),
+            ingredient_id=request.args.get('ingredient_id'),
+            types=types.split(',') if types else None,
+            staff=request.args.get('staff'),
+            start=request.args.get('start'),
+            end=request.args.get('end')
+        )
+        return jsonify({"status": "success", **page})
+    except (ValueError, KeyError) as e:
+        return jsonify({"status": "error", "message": f"Invalid cursor or filter: {e}"}), 400
+    except Exception as e:
+        return jsonify({"status": "error", "message": str(e)}), 500
+
+def _order_filters():
+    return {
+        'start': request.args.get('start'),
+        'end': request.args.get('end'),
+        'source': request.args.get('source'),
+        'payment_status': request.args.get('payment_status')
+    }
+
 @app.route('/api/orders')
 def get_orders():
-    """Get recent orders with basic info"""
+    """Get orders newest first, with keyset paging (?cursor=) and date/source/payment filters"""
     try:
-        conn = get_connection()
-        cursor = conn.cursor()
-        cursor.execute('''
-            SELECT id, toast_guid, order_number, closed_date, total_amount, payment_status, source
-            FROM orders
-            ORDER BY closed_date DESC
-            LIMIT 50
-        ''')
-        orders = [dict(row) for row in cursor.fetchall()]
-        conn.close()
-        return jsonify({"status": "success", "orders": orders})
+        page = order_manager.list_orders(
+            limit=request.args.get('limit', 50, type=int),
+            cursor=request.args.get('cursor'),
+            **_order_filters()
+        )
+        return jsonify({"status": "success", **page})
+    except ValueError as e:
+        return jsonify({"status": "error", "message": f"Invalid cursor: {e}"}), 400
     except Exception as e:
         return jsonify({"status": "error", "message": str(e)}), 500
 
+@app.route('/api/orders/export')
+def export_orders():
+    """Stream orders with items and deductions as NDJSON (default) or CSV"""
+    filters = _order_filters()
+    if request.args.get('format') == 'csv':
+        response = Response(order_manager.export_csv(**filters), mimetype='text/csv')
+        response.headers['Content-Disposition'] = 'attachment; filename=orders.csv'
+    else:
+        response = Response(order_manager.export_ndjson(**filters), mimetype='application/x-ndjson')
+        response.headers['Content-Disposition'] = 'attachment; filename=orders.ndjson'
+    return response
+
 @app.route('/api/orders/<int:order_id>')
 def get_order_details(order_id):
     """Get detailed order information with items and deductions"""
@@ -369,19 +525,66 @@ def get_order_details(order_id):
 def get_order_stats():
     """Get order statistics"""
     try:
-        conn = get_connection()
-        cursor = conn.cursor()
-        
-        # Total orders
-        cursor.execute('SELECT COUNT(*) as count, SUM(total_amount) as revenue FROM orders WHERE deleted = 0')
-        stats = dict(cursor.fetchone())
-        
-        # Orders today
-        today = datetime.now().strftime('%Y-%m-%d')
-        cursor.execute('SELECT COUNT(*) as count FROM orders WHERE DATE(closed_date) = ? AND deleted = 0', (today,))
-        stats['today_count'] = cursor.fetchone()['count']
-        
-        conn.close()
+        return jsonify({"status": "success", "stats": rollups.get_order_stats()})
+    except Exception as e:
+        return jsonify({"status": "error", "message": str(e)}), 500
+
+@app.route('/api/forecasts')
+def get_forecasts():
+    """Latest usage forecasts, days until stockout and suggested orders per ingredient"""
+    try:
+        return jsonify({"status": "success", "forecasts": list(forecast.get_forecasts().values())})
+    except Exception as e:
+        return jsonify({"status": "error", "message": str(e)}), 500
+
+@app.route('/api/forecasts/recompute', methods=['POST'])
+def recompute_forecasts():
+    """Rebuild all forecasts (optional JSON: lead_time_days, review_days)"""
+    data = request.get_json(silent=True) or {}
+    try:
+        count = forecast.recompute(
+            lead_time_days=int(data.get('lead_time_days', forecast.LEAD_TIME_DAYS)),
+            review_days=int(data.get('review_days', forecast.REVIEW_DAYS))
+        )
+        return jsonify({"status": "success", "message": f"Forecast {count} ingredient(s)", "count": count})
+    except ValueError as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
+    except Exception as e:
+        return jsonify({"status": "error", "message": str(e)}), 500
+
+@app.route('/api/alerts')
+def get_stock_alerts():
+    """Low-stock transitions (?after_id= to poll, ?ingredient_id=, ?limit=) and ingredients currently low"""
+    try:
+        after_id = request.args.get('after_id', type=int)
+        limit = min(request.args.get('limit', 100, type=int), 1000)
+        result = get_alerts(after_id=after_id, ingredient_id=request.args.get('ingredient_id'), limit=limit)
+        return jsonify({"status": "success", **result})
+    except Exception as e:
+        return jsonify({"status": "error", "message": str(e)}), 500
+
+@app.route('/api/food-cost')
+def get_food_cost():
+    """Stored plate cost per menu item (optional ?menu_item_guid=)"""
+    try:
+        guid = request.args.get('menu_item_guid')
+        if guid:
+            return jsonify({"status": "success", "items": plate_costs.get_plate_costs(guid)})
+        version = (_data_version('plate_costs'), _data_version('menu_items'))
+        return http_cache.versioned_json_response(
+            'plate_costs', version, lambda: {"status": "success", "items": plate_costs.get_plate_costs()})
+    except Exception as e:
+        return jsonify({"status": "error", "message": str(e)}), 500
+
+@app.route('/api/consumption/stats')
+def get_consumption_stats():
+    """Deducted/received/wasted per ingredient between ?start= and ?end= days"""
+    try:
+        stats = rollups.get_consumption_stats(
+            start=request.args.get('start'),
+            end=request.args.get('end'),
+            ingredient_id=request.args.get('ingredient_id')
+        )
         return jsonify({"status": "success", "stats": stats})
     except Exception as e:
         return jsonify({"status": "error", "message": str(e)}), 500
@@ -402,6 +605,73 @@ def save_recipe():
         if success:
             return jsonify({"status": "success", "message": "Recipe saved successfully"})
         return jsonify({"status": "error", "message": "Failed to save recipe"}), 500
+    except ValueError as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
+    except Exception as e:
+        return jsonify({"status": "error", "message": str(e)}), 500
+
+def _iter_recipe_rows():
+    """Yield (menu_guid, ingredient_id, quantity, unit) from a CSV upload/body or JSON"""
+    if request.files.get('file'):
+        stream = io.TextIOWrapper(request.files['file'].stream, encoding='utf-8-sig')
+    elif request.mimetype == 'text/csv':
+        stream = io.TextIOWrapper(request.stream, encoding='utf-8-sig')
+    else:
+        # Either flat rows or [{menu_guid, components: [...]}, ...]
+        data = request.get_json() or {}
+        if isinstance(data, dict):
+            data = data.get('recipes', [])
+        recipes = data if isinstance(data, list) else [data]
+        for recipe in recipes:
+            # Anything but an object is passed on as None so it is reported as a bad line
+            if not isinstance(recipe, dict):
+                yield None
+            elif 'components' in recipe:
+                components = recipe['components'] or []
+                if not isinstance(components, list):
+                    yield None
+                    continue
+                for component in components:
+                    yield (recipe.get('menu_guid'), component.get('ingredient_id'), component.get('quantity'),
+                           component.get('unit')) if isinstance(component, dict) else None
+            else:
+                yield recipe.get('menu_guid'), recipe.get('ingredient_id'), recipe.get('quantity'), recipe.get('unit')
+        return
+    
+    for row in csv.DictReader(stream):
+        yield row.get('menu_guid'), row.get('ingredient_id'), row.get('quantity'), row.get('unit')
+
+@app.route('/api/recipes/import', methods=['POST'])
+def import_recipes():
+    """Load many recipes at once (CSV with menu_guid,ingredient_id,quantity[,unit] columns or JSON)"""
+    try:
+        report = inventory.import_recipes(_iter_recipe_rows())
+        if report['success']:
+            return jsonify({
+                "status": "success",
+                "message": f"Recipes imported: {report['created']} created, {report['updated']} updated, {report['unchanged']} unchanged",
+                "results": report['results']
+            })
+        return jsonify({"status": "error", "message": "Recipe import rejected: some lines are invalid", "results": report['results']}), 400
+    except Exception as e:
+        return jsonify({"status": "error", "message": str(e)}), 500
+
+@app.route('/api/recipes/<guid>/replay', methods=['POST'])
+def replay_recipe_deductions(guid):
+    """Recompute past deductions with the current recipe (JSON: start, end, dry_run - defaults to a preview)"""
+    data = request.get_json(silent=True) or {}
+    try:
+        result = replay_recipe(guid, start=data.get('start'), end=data.get('end'),
+                               dry_run=bool(data.get('dry_run', True)))
+        if result['applied']:
+            message = f"Corrected {len(result['deductions'])} ingredient(s) across {result['orders']} order(s)"
+        elif not result['dry_run']:
+            message = "Deductions already match the recipe"
+        else:
+            message = f"{len(result['deductions'])} ingredient(s) would change across {result['orders']} order(s)"
+        return jsonify({"status": "success", "message": message, **result})
+    except ValueError as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
     except Exception as e:
         return jsonify({"status": "error", "message": str(e)}), 500
 
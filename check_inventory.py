@@ -1,43 +1,339 @@
+"""
+Inventory integrity check
+Verifies current_stock against the stock ledger and the ledger against the
+receipt, adjustment and order history, and reports orphaned rows and duplicate
+orders. All checks are set-based queries over one read-only snapshot.
+
+    python check_inventory.py [--samples] [--json] [--rebuild]
+
+Exits with status 1 when a problem is found. --rebuild first resets drifted
+current_stock values to their ledger balance in a single transaction, recorded
+as zero-delta 'correction' ledger rows so alerts and the live feed see it.
+"""
+
+import argparse
+import json
 import sqlite3
+import sys
+import time
+from src.database import DB_PATH, BUSY_TIMEOUT, get_connection, bump_version, init_db
+from src.stock_ledger import take_snapshot, record_movements
+from src.stock_mutations import fetch_ingredients
+from src.stock_alerts import check_thresholds
+
+SAMPLE_LIMIT = 10
+
+STOCK_DRIFT_SQL = '''
+    SELECT i.id, i.name, i.unit, COALESCE(i.current_stock, 0), COALESCE(l.balance, 0)
+    FROM ingredients i
+    LEFT JOIN (SELECT ingredient_id, SUM(delta) AS balance FROM stock_ledger GROUP BY ingredient_id) l
+        ON l.ingredient_id = i.id
+'''
+
+# Ledger totals per movement group vs. the history tables they were written with.
+# History from before the ledger existed is folded into its opening balances, so it is skipped.
+# Recipe replays rewrite deductions in place (keeping old timestamps, possibly from before the
+# opening) and book the difference as 'correction' rows: those are checked against
+# deduction_corrections, and sales against today's deductions minus the ledgered part of it.
+HISTORY_DRIFT_SQL = '''
+    WITH start AS (
+        SELECT COALESCE(MIN(timestamp), '') AS ts FROM stock_ledger WHERE movement_type = 'opening'
+    ),
+    ledger AS (
+        SELECT ingredient_id,
+               SUM(CASE WHEN movement_type = 'receipt' THEN delta ELSE 0 END) AS received,
+               SUM(CASE WHEN movement_type IN ('adjustment', 'count') THEN delta ELSE 0 END) AS adjusted,
+               SUM(CASE WHEN movement_type = 'sale' THEN delta ELSE 0 END) AS sold,
+               SUM(CASE WHEN movement_type = 'correction' THEN delta ELSE 0 END) AS corrected
+        FROM stock_ledger
+        GROUP BY ingredient_id
+    ),
+    history AS (
+        SELECT ingredient_id, SUM(received) AS received, SUM(adjusted) AS adjusted,
+               SUM(sold) AS sold, SUM(corrected) AS corrected
+        FROM (
+            SELECT ingredient_id, quantity_received AS received, 0 AS adjusted, 0 AS sold, 0 AS corrected
+            FROM goods_inward WHERE timestamp >= (SELECT ts FROM start)
+            UNION ALL
+            SELECT ingredient_id, 0, CASE WHEN type = 'Addition' THEN quantity ELSE -quantity END, 0, 0
+            FROM inventory_adjustments WHERE timestamp >= (SELECT ts FROM start)
+            UNION ALL
+            SELECT ingredient_id, 0, 0, -quantity_deducted, 0
+            FROM order_deductions WHERE timestamp >= (SELECT ts FROM start)
+            UNION ALL
+            SELECT ingredient_id, 0, 0, CASE WHEN ledgered THEN delta ELSE 0 END, -delta
+            FROM deduction_corrections
+        )
+        GROUP BY ingredient_id
+    )
+    SELECT i.id, i.name,
+           COALESCE(l.received, 0), COALESCE(h.received, 0),
+           COALESCE(l.adjusted, 0), COALESCE(h.adjusted, 0),
+           COALESCE(l.sold, 0), COALESCE(h.sold, 0),
+           COALESCE(l.corrected, 0), COALESCE(h.corrected, 0)
+    FROM ingredients i
+    LEFT JOIN ledger l ON l.ingredient_id = i.id
+    LEFT JOIN history h ON h.ingredient_id = i.id
+'''
+
+ORPHAN_CHECKS = {
+    'order_deductions without an order item': '''
+        SELECT od.id FROM order_deductions od
+        WHERE od.order_item_id IS NULL OR NOT EXISTS (SELECT 1 FROM order_items oi WHERE oi.id = od.order_item_id)
+    ''',
+    'order_deductions for an unknown ingredient': '''
+        SELECT od.id FROM order_deductions od
+        WHERE NOT EXISTS (SELECT 1 FROM ingredients i WHERE i.id = od.ingredient_id)
+    ''',
+    'order_items without an order': '''
+        SELECT oi.id FROM order_items oi
+        WHERE NOT EXISTS (SELECT 1 FROM orders o WHERE o.id = oi.order_id)
+    ''',
+    'recipe_components for an unknown ingredient': '''
+        SELECT rc.id FROM recipe_components rc
+        WHERE NOT EXISTS (SELECT 1 FROM ingredients i WHERE i.id = rc.ingredient_id)
+    ''',
+    'recipe_components for an unknown menu item': '''
+        SELECT rc.id FROM recipe_components rc
+        WHERE NOT EXISTS (SELECT 1 FROM menu_items m WHERE m.item_guid = rc.menu_item_guid)
+    '''
+}
+
+# Toast order numbers restart every business day, so a repeat within a day is a double import
+DUPLICATE_ORDERS_SQL = '''
+    SELECT order_number, substr(COALESCE(opened_date, closed_date), 1, 10) AS day,
+           COUNT(*) AS copies, GROUP_CONCAT(toast_guid) AS guids
+    FROM orders
+    WHERE order_number IS NOT NULL AND deleted = 0
+    GROUP BY order_number, day
+    HAVING COUNT(*) > 1
+    ORDER BY day DESC
+'''
+
+
+def _differs(a, b):
+    return abs(a - b) > 1e-6 * max(1.0, abs(a), abs(b))
+
+
+def stock_drift(cursor):
+    """Ingredients whose current_stock differs from their ledger balance"""
+    cursor.execute(STOCK_DRIFT_SQL)
+    return [{'id': i, 'name': name, 'unit': unit, 'current_stock': stock, 'ledger_balance': balance,
+             'drift': round(stock - balance, 6)}
+            for i, name, unit, stock, balance in cursor.fetchall() if _differs(stock, balance)]
+
+
+def history_drift(cursor):
+    """Ingredients whose ledger receipts, adjustments, sales or corrections disagree with the history tables"""
+    cursor.execute(HISTORY_DRIFT_SQL)
+    drift = []
+    for i, name, *totals in cursor.fetchall():
+        for group, ledger, history in zip(('received', 'adjusted', 'sold', 'corrected'), totals[0::2], totals[1::2]):
+            if _differs(ledger, history):
+                drift.append({'id': i, 'name': name, 'movement': group, 'ledger': round(ledger, 6),
+                              'history': round(history, 6), 'difference': round(ledger - history, 6)})
+    return drift
+
+
+def snapshot_drift(cursor):
+    """Balances in the latest stock snapshot that no longer match the ledger up to that point"""
+    cursor.execute('SELECT MAX(ledger_id) FROM stock_snapshots')
+    ledger_id = cursor.fetchone()[0]
+    if not ledger_id:
+        return None, []
+    cursor.execute('''
+        SELECT s.ingredient_id, s.balance, COALESCE(l.balance, 0)
+        FROM stock_snapshots s
+        LEFT JOIN (SELECT ingredient_id, SUM(delta) AS balance FROM stock_ledger WHERE id <= ? GROUP BY ingredient_id) l
+            ON l.ingredient_id = s.ingredient_id
+        WHERE s.ledger_id = ?
+    ''', (ledger_id, ledger_id))
+    return ledger_id, [{'id': i, 'snapshot': snapshot, 'ledger': ledger}
+                       for i, snapshot, ledger in cursor.fetchall() if _differs(snapshot, ledger)]
+
+
+def orphans(cursor):
+    found = {}
+    for label, query in ORPHAN_CHECKS.items():
+        cursor.execute(query)
+        ids = [row[0] for row in cursor.fetchall()]
+        if ids:
+            found[label] = {'count': len(ids), 'sample_ids': ids[:SAMPLE_LIMIT]}
+    return found
+
+
+def duplicate_orders(cursor):
+    cursor.execute(DUPLICATE_ORDERS_SQL)
+    return [{'order_number': number, 'day': day, 'copies': copies, 'guids': guids.split(',')}
+            for number, day, copies, guids in cursor.fetchall()]
+
+
+def run_checks():
+    """Every check from one read-only snapshot; returns the report dict"""
+    conn = sqlite3.connect(f"file:{DB_PATH}?mode=ro", uri=True, timeout=BUSY_TIMEOUT)
+    cursor = conn.cursor()
+    try:
+        cursor.execute('BEGIN')
+        cursor.execute('''
+            SELECT (SELECT COUNT(*) FROM ingredients), (SELECT COUNT(*) FROM orders),
+                   (SELECT COUNT(*) FROM order_deductions), (SELECT COUNT(*) FROM recipe_components),
+                   (SELECT COUNT(*) FROM stock_ledger)
+        ''')
+        counts = dict(zip(('ingredients', 'orders', 'order_deductions', 'recipe_components', 'stock_ledger'),
+                          cursor.fetchone()))
+        snapshot_id, bad_snapshot = snapshot_drift(cursor)
+        cursor.execute('SELECT id, name, current_stock, unit FROM ingredients WHERE current_stock < 0 ORDER BY name')
+        negative = [{'id': i, 'name': name, 'current_stock': stock, 'unit': unit}
+                    for i, name, stock, unit in cursor.fetchall()]
+        return {
+            'counts': counts,
+            'stock_drift': stock_drift(cursor),
+            'history_drift': history_drift(cursor),
+            'snapshot': {'ledger_id': snapshot_id, 'drift': bad_snapshot},
+            'orphans': orphans(cursor),
+            'duplicate_orders': duplicate_orders(cursor),
+            'negative_stock': negative
+        }
+    finally:
+        conn.close()
+
+
+def rebuild_stock():
+    """
+    Reset every drifted current_stock to its ledger balance and replace a stale latest
+    snapshot, in one write transaction. Returns (ingredients fixed, snapshot replaced).
+    """
+    conn = get_connection()
+    cursor = conn.cursor()
+    try:
+        cursor.execute('BEGIN IMMEDIATE')
+        drift = stock_drift(cursor)
+        if drift:
+            cursor.executemany('UPDATE ingredients SET current_stock = ? WHERE id = ?',
+                               [(row['ledger_balance'], row['id']) for row in drift])
+            # The ledger balance does not move, but a row marks the change so the live feed
+            # sends the new stock and the alerts below (which attach to the latest ledger id)
+            record_movements(cursor, [(row['id'], 0.0, 'correction',
+                                       f"Stock rebuilt from ledger (current_stock was {row['current_stock']})")
+                                      for row in drift])
+            ingredients = fetch_ingredients(cursor, [row['id'] for row in drift])
+            # fetch_ingredients already sees the new values; alerts compare against the old ones
+            for row in drift:
+                ingredients[row['id']]['current_stock'] = row['current_stock']
+            check_thresholds(cursor, ingredients, {row['id']: row['ledger_balance'] for row in drift},
+                             'correction', 'Stock rebuilt from ledger')
+            bump_version(cursor, 'ingredients')
+
+        ledger_id, bad_snapshot = snapshot_drift(cursor)
+        if bad_snapshot:
+            cursor.execute('DELETE FROM stock_snapshots WHERE ledger_id = ?', (ledger_id,))
+            take_snapshot(cursor)
+        conn.commit()
+        return len(drift), bool(bad_snapshot)
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+
+
+def print_samples():
+    conn = sqlite3.connect(f"file:{DB_PATH}?mode=ro", uri=True, timeout=BUSY_TIMEOUT)
+    cursor = conn.cursor()
+    try:
+        print("=== SAMPLE INVENTORY LEVELS ===")
+        cursor.execute('SELECT name, current_stock, unit FROM ingredients ORDER BY name LIMIT 15')
+        for row in cursor.fetchall():
+            print(f"{row[0]}: {row[1]} {row[2]}")
+
+        print("\n=== RECENT ORDER DEDUCTIONS ===")
+        cursor.execute('''
+            SELECT od.timestamp, i.name, od.quantity_deducted, i.unit
+            FROM order_deductions od
+            JOIN ingredients i ON od.ingredient_id = i.id
+            ORDER BY od.timestamp DESC
+            LIMIT 10
+        ''')
+        for row in cursor.fetchall():
+            print(f"{row[0]}: {row[1]} - Deducted {row[2]} {row[3]}")
+        print()
+    finally:
+        conn.close()
+
+
+def print_report(report):
+    counts = report['counts']
+    print("=== SUMMARY ===")
+    print(f"Ingredients: {counts['ingredients']}, orders: {counts['orders']}, "
+          f"deductions: {counts['order_deductions']}, recipe components: {counts['recipe_components']}, "
+          f"ledger rows: {counts['stock_ledger']}")
+
+    print("\n=== STOCK VS LEDGER ===")
+    for row in report['stock_drift']:
+        print(f"  {row['name']} ({row['id']}): current {row['current_stock']} {row['unit']}, "
+              f"ledger {row['ledger_balance']} (drift {row['drift']:+})")
+    if not report['stock_drift']:
+        print("  OK")
+
+    print("\n=== LEDGER VS HISTORY ===")
+    for row in report['history_drift']:
+        print(f"  {row['name']} ({row['id']}) {row['movement']}: ledger {row['ledger']}, "
+              f"history {row['history']} ({row['difference']:+})")
+    if not report['history_drift']:
+        print("  OK")
+
+    print("\n=== LATEST SNAPSHOT ===")
+    snapshot = report['snapshot']
+    if snapshot['drift']:
+        print(f"  {len(snapshot['drift'])} balance(s) at ledger id {snapshot['ledger_id']} do not match the ledger")
+    else:
+        print("  OK" if snapshot['ledger_id'] else "  No snapshots yet")
+
+    print("\n=== ORPHANED ROWS ===")
+    for label, found in report['orphans'].items():
+        print(f"  {found['count']} {label} (ids {', '.join(map(str, found['sample_ids']))})")
+    if not report['orphans']:
+        print("  None")
+
+    print("\n=== DUPLICATE ORDERS ===")
+    for row in report['duplicate_orders']:
+        print(f"  #{row['order_number']} on {row['day']}: {row['copies']} copies ({', '.join(row['guids'])})")
+    if not report['duplicate_orders']:
+        print("  None")
+
+    print("\n=== INGREDIENTS WITH NEGATIVE STOCK ===")
+    for row in report['negative_stock']:
+        print(f"  {row['name']}: {row['current_stock']} {row['unit']}")
+    if not report['negative_stock']:
+        print("  None (all stock levels are positive)")
+
+
+def has_problems(report):
+    return bool(report['stock_drift'] or report['history_drift'] or report['snapshot']['drift']
+                or report['orphans'] or report['duplicate_orders'])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Verify inventory data and optionally rebuild stock from the ledger")
+    parser.add_argument('--rebuild', action='store_true', help="reset drifted current_stock to the ledger balance first")
+    parser.add_argument('--samples', action='store_true', help="also print sample stock levels and recent deductions")
+    parser.add_argument('--json', action='store_true', help="print the report as JSON")
+    args = parser.parse_args()
+
+    init_db()
+    started = time.perf_counter()
+    if args.rebuild:
+        fixed, snapshot_replaced = rebuild_stock()
+        if not args.json:
+            print(f"Rebuilt stock for {fixed} ingredient(s)" + (", replaced the latest snapshot" if snapshot_replaced else ""))
+    if args.samples and not args.json:
+        print_samples()
+    report = run_checks()
+    report['seconds'] = round(time.perf_counter() - started, 3)
 
-conn = sqlite3.connect('data/inventory.db')
-cursor = conn.cursor()
-
-# Check inventory levels
-print("=== SAMPLE INVENTORY LEVELS ===")
-cursor.execute('SELECT name, current_stock, unit FROM ingredients ORDER BY name LIMIT 15')
-for row in cursor.fetchall():
-    print(f"{row[0]}: {row[1]} {row[2]}")
-
-print("\n=== RECENT ORDER DEDUCTIONS ===")
-cursor.execute('''
-    SELECT od.timestamp, i.name, od.quantity_deducted, i.unit
-    FROM order_deductions od
-    JOIN ingredients i ON od.ingredient_id = i.id
-    ORDER BY od.timestamp DESC
-    LIMIT 10
-''')
-for row in cursor.fetchall():
-    print(f"{row[0]}: {row[1]} - Deducted {row[2]} {row[3]}")
-
-print("\n=== ORDERS SUMMARY ===")
-cursor.execute('SELECT COUNT(*) FROM orders')
-print(f"Total orders stored: {cursor.fetchone()[0]}")
-
-cursor.execute('SELECT COUNT(*) FROM order_deductions')
-print(f"Total ingredient deductions: {cursor.fetchone()[0]}")
-
-cursor.execute('SELECT COUNT(*) FROM recipe_components')
-print(f"Total recipe components configured: {cursor.fetchone()[0]}")
-
-# Check if any ingredients have negative stock
-print("\n=== INGREDIENTS WITH NEGATIVE STOCK ===")
-cursor.execute('SELECT name, current_stock, unit FROM ingredients WHERE current_stock < 0')
-negative = cursor.fetchall()
-if negative:
-    for row in negative:
-        print(f"  {row[0]}: {row[1]} {row[2]}")
-else:
-    print("  None (all stock levels are positive)")
-
-conn.close()
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print_report(report)
+        print(f"\nChecked in {report['seconds']}s")
+    sys.exit(1 if has_problems(report) else 0)
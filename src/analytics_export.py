@@ -0,0 +1,252 @@
+"""
+Analytics Export
+Copies orders, deductions and stock movements into compressed columnar files
+partitioned by day, for offline analysis without touching the live database.
+Reads run in one read-only transaction (a consistent WAL snapshot that never
+blocks writers) and stream in batches; a watermark file of the last exported id
+per table makes each run incremental. Days whose rows were rewritten in place
+(recipe replays replace order_deductions) are listed in export_invalidations and
+their partitions are exported again from scratch. --full replaces each table's
+directory. Parquet needs pyarrow (in requirements.txt); without it the export
+falls back to compressed NumPy archives.
+
+    python -m src.analytics_export [--out exports] [--tables orders,...] [--full]
+"""
+
+import argparse
+import json
+import os
+import shutil
+import sqlite3
+from datetime import datetime
+import numpy as np
+from src.database import DB_PATH, BUSY_TIMEOUT
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:  # listed in requirements.txt; without it the export writes compressed NumPy archives
+    pyarrow = None
+
+EXPORT_DIR = 'exports'
+WATERMARK_FILE = '_watermark.json'
+INVALIDATIONS_KEY = '_invalidations'
+BATCH_ROWS = 50000
+
+# table -> (expression for its partition day, columns left out)
+EXPORTS = {
+    'orders': ("COALESCE(t.closed_date, t.opened_date, t.synced_at)", ('raw_json',)),
+    'order_items': ("(SELECT COALESCE(o.closed_date, o.opened_date, o.synced_at) FROM orders o WHERE o.id = t.order_id)", ()),
+    'order_deductions': ("t.timestamp", ()),
+    'goods_inward': ("t.timestamp", ()),
+    'inventory_adjustments': ("t.timestamp", ()),
+    'stock_ledger': ("t.timestamp", ())
+}
+
+
+def _column_kinds(cursor, table, excluded):
+    """[(name, 'int' | 'float' | 'str'), ...] from the declared SQLite column types"""
+    cursor.execute(f'PRAGMA table_info({table})')
+    kinds = []
+    for _, name, declared, *_ in cursor.fetchall():
+        if name in excluded:
+            continue
+        declared = (declared or '').upper()
+        if 'INT' in declared or 'BOOL' in declared:
+            kinds.append((name, 'int'))
+        elif 'REAL' in declared:
+            kinds.append((name, 'float'))
+        else:
+            kinds.append((name, 'str'))
+    return kinds
+
+
+def _write_parquet(path, kinds, rows):
+    types = {'int': pyarrow.int64(), 'float': pyarrow.float64(), 'str': pyarrow.string()}
+    arrays = [pyarrow.array([row[i] for row in rows], type=types[kind]) for i, (_, kind) in enumerate(kinds)]
+    table = pyarrow.Table.from_arrays(arrays, names=[name for name, _ in kinds])
+    pyarrow.parquet.write_table(table, path, compression='zstd')
+
+
+def _write_npz(path, kinds, rows):
+    """One array per column; NULLs become NaN (numbers) or '' plus a '<column>__null' mask (text)"""
+    arrays = {}
+    for i, (name, kind) in enumerate(kinds):
+        values = [row[i] for row in rows]
+        nulls = np.array([value is None for value in values])
+        if kind == 'str':
+            arrays[name] = np.array(['' if value is None else str(value) for value in values], dtype=str)
+            if nulls.any():
+                arrays[f'{name}__null'] = nulls
+        elif kind == 'int' and not nulls.any():
+            arrays[name] = np.array(values, dtype=np.int64)
+        else:
+            arrays[name] = np.array([np.nan if value is None else float(value) for value in values], dtype=np.float64)
+    with open(path, 'wb') as f:
+        np.savez_compressed(f, **arrays)
+
+
+def _flush(out_dir, table, day, kinds, rows, file_format):
+    """Write one part file into <out>/<table>/day=<day>/; the name carries its id range"""
+    directory = os.path.join(out_dir, table, f"day={day}")
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, f"part-{rows[0][0]}-{rows[-1][0]}.{file_format}")
+    if file_format == 'parquet':
+        _write_parquet(path + '.tmp', kinds, rows)
+    else:
+        _write_npz(path + '.tmp', kinds, rows)
+    os.replace(path + '.tmp', path)
+    return path
+
+
+def export_table(cursor, out_dir, table, after_id, upto_id, file_format, batch_rows=BATCH_ROWS, days=None, skip_days=None):
+    """
+    Stream rows with after_id < id <= upto_id into day partitions, only those of
+    `days` if given and none of `skip_days`; returns (rows, files)
+    """
+    day_expr, excluded = EXPORTS[table]
+    kinds = _column_kinds(cursor, table, excluded)
+    columns = ', '.join(f't.{name}' for name, _ in kinds)
+    day_filter = ''
+    params = [after_id, upto_id]
+    if days:
+        day_filter = f" AND substr({day_expr}, 1, 10) IN ({','.join('?' * len(days))})"
+        params.extend(days)
+    if skip_days:
+        day_filter += f" AND COALESCE(substr({day_expr}, 1, 10), '') NOT IN ({','.join('?' * len(skip_days))})"
+        params.extend(skip_days)
+    cursor.execute(f'''
+        SELECT {columns}, substr({day_expr}, 1, 10)
+        FROM {table} t
+        WHERE t.id > ? AND t.id <= ?{day_filter}
+        ORDER BY t.id
+    ''', params)
+
+    pending = {}
+    exported = 0
+    files = 0
+    while True:
+        batch = cursor.fetchmany(batch_rows)
+        if not batch:
+            break
+        days_in_batch = set()
+        for row in batch:
+            day = row[-1] or 'unknown'
+            days_in_batch.add(day)
+            pending.setdefault(day, []).append(row[:-1])
+        exported += len(batch)
+        # Rows arrive roughly in time order, so a day missing from this batch is complete
+        for day in [day for day in pending if day not in days_in_batch or len(pending[day]) >= batch_rows]:
+            _flush(out_dir, table, day, kinds, pending.pop(day), file_format)
+            files += 1
+    for day, rows in pending.items():
+        _flush(out_dir, table, day, kinds, rows, file_format)
+        files += 1
+    return exported, files
+
+
+def rewrite_days(cursor, out_dir, table, days, upto_id, file_format, batch_rows=BATCH_ROWS):
+    """Replace the partitions of `days` with every row of those days up to upto_id; returns (rows, files)"""
+    for day in days:
+        shutil.rmtree(os.path.join(out_dir, table, f"day={day}"), ignore_errors=True)
+    return export_table(cursor, out_dir, table, 0, upto_id, file_format, batch_rows, days=days)
+
+
+def _pending_invalidations(cursor, after_id):
+    """(last invalidation id, {table: [day, ...]}) recorded after `after_id`"""
+    cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'export_invalidations'")
+    if not cursor.fetchone():
+        return after_id, {}
+    cursor.execute('SELECT id, table_name, day FROM export_invalidations WHERE id > ? ORDER BY id', (after_id,))
+    pending = {}
+    for row_id, table, day in cursor.fetchall():
+        after_id = row_id
+        if table in EXPORTS and day not in pending.setdefault(table, []):
+            pending[table].append(day)
+    return after_id, pending
+
+
+def load_watermark(out_dir):
+    path = os.path.join(out_dir, WATERMARK_FILE)
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_watermark(out_dir, watermark):
+    path = os.path.join(out_dir, WATERMARK_FILE)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(watermark, f, indent=2)
+    os.replace(path + '.tmp', path)
+
+
+def run_export(out_dir=EXPORT_DIR, tables=None, full=False, file_format=None, batch_rows=BATCH_ROWS):
+    """
+    Export new rows of each table since the watermark, then re-export invalidated days.
+    Returns {table: {'rows', 'files', 'last_id', 'rewritten_days'}}
+    """
+    tables = list(tables or EXPORTS)
+    unknown = [table for table in tables if table not in EXPORTS]
+    if unknown:
+        raise ValueError(f"Unknown table(s): {', '.join(unknown)}")
+    file_format = file_format or ('parquet' if pyarrow is not None else 'npz')
+    if file_format == 'parquet' and pyarrow is None:
+        raise ValueError("Parquet export needs the optional pyarrow package")
+
+    os.makedirs(out_dir, exist_ok=True)
+    watermark = {} if full else load_watermark(out_dir)
+    conn = sqlite3.connect(f"file:{DB_PATH}?mode=ro", uri=True, timeout=BUSY_TIMEOUT)
+    cursor = conn.cursor()
+    summary = {}
+    try:
+        # Every table is read from the same snapshot; WAL keeps writers going meanwhile
+        cursor.execute('BEGIN')
+        upper = {}
+        for table in tables:
+            cursor.execute(f'SELECT COALESCE(MAX(id), 0) FROM {table}')
+            upper[table] = cursor.fetchone()[0]
+        invalidated_upto, invalidated = _pending_invalidations(
+            cursor, watermark.get(INVALIDATIONS_KEY, {}).get('last_id', 0))
+
+        for table in tables:
+            after_id = watermark.get(table, {}).get('last_id', 0)
+            if full:
+                # Part files are named by id range, so old ones would sit next to the new ones
+                shutil.rmtree(os.path.join(out_dir, table), ignore_errors=True)
+            # A full export already holds the current rows of every day
+            days = [] if full else sorted(invalidated.get(table, []))
+            # New rows of rewritten days are written by rewrite_days, not twice
+            rows, files = export_table(cursor, out_dir, table, after_id, upper[table], file_format, batch_rows,
+                                       skip_days=days)
+            if days:
+                rewritten, rewritten_files = rewrite_days(cursor, out_dir, table, days, upper[table], file_format, batch_rows)
+                rows += rewritten
+                files += rewritten_files
+            last_id = max(after_id, upper[table])
+            summary[table] = {'rows': rows, 'files': files, 'last_id': last_id, 'rewritten_days': len(days)}
+            watermark[table] = {'last_id': last_id, 'exported_at': datetime.now().isoformat(), 'format': file_format}
+            save_watermark(out_dir, watermark)
+        # Invalidations are consumed only once every table they name has been exported
+        if all(table in tables for table in invalidated):
+            watermark[INVALIDATIONS_KEY] = {'last_id': invalidated_upto}
+            save_watermark(out_dir, watermark)
+    finally:
+        conn.close()
+    return summary
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export orders, deductions and stock movements for offline analytics")
+    parser.add_argument('--out', default=EXPORT_DIR, help="output directory (default: exports)")
+    parser.add_argument('--tables', help=f"comma-separated subset of: {', '.join(EXPORTS)}")
+    parser.add_argument('--full', action='store_true', help="ignore the watermark and re-export everything, replacing the tables' files in --out")
+    parser.add_argument('--format', choices=('parquet', 'npz'), help="default: parquet if pyarrow is installed, else npz")
+    parser.add_argument('--batch-size', type=int, default=BATCH_ROWS)
+    args = parser.parse_args()
+
+    result = run_export(args.out, args.tables.split(',') if args.tables else None,
+                        full=args.full, file_format=args.format, batch_rows=args.batch_size)
+    for table, stats in result.items():
+        rewritten = f", {stats['rewritten_days']} day(s) rewritten" if stats['rewritten_days'] else ''
+        print(f"{table}: {stats['rows']} row(s) in {stats['files']} file(s), up to id {stats['last_id']}{rewritten}")
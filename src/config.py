@@ -5,3 +5,14 @@ LOG_DIR = 'logs'
 if not os.path.exists(LOG_DIR):
     os.makedirs(LOG_DIR)
 
+
+LOG_FILE = os.path.join(LOG_DIR, 'inventory_log.txt')
+LOG_MAX_BYTES = int(os.environ.get('LOG_MAX_BYTES', 5 * 1024 * 1024))
+LOG_BACKUP_COUNT = int(os.environ.get('LOG_BACKUP_COUNT', 5))
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO').upper()
+
+# Fraction of records kept per level, e.g. LOG_SAMPLE_DEBUG=0.1 (WARNING and above are never sampled)
+LOG_SAMPLE_RATES = {
+    level: float(os.environ.get(f'LOG_SAMPLE_{level}', 1.0))
+    for level in ('DEBUG', 'INFO')
+}
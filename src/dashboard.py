@@ -0,0 +1,64 @@
+"""
+Dashboard View Model
+Groups stock by category for index.html and identifies the data it was built from
+"""
+
+import collections
+from datetime import datetime
+from src.database import get_connection, get_versions
+
+CATEGORY_ORDER = ["Meat", "Bread", "Produce", "Dairy", "sides", "Sauce", "Drink", "Dessert"]
+
+# Data versions the dashboard depends on
+DASHBOARD_DATA = ('ingredients', 'recipes', 'forecasts')
+
+
+def get_data_key():
+    """
+    One cheap query for the versions behind the dashboard.
+    Returns (key, last_modified) where key changes whenever the rendered page would.
+    """
+    conn = get_connection()
+    try:
+        versions = get_versions(conn.cursor(), DASHBOARD_DATA)
+    finally:
+        conn.close()
+
+    key = tuple(versions[name][0] for name in DASHBOARD_DATA)
+    stamps = [versions[name][1] for name in DASHBOARD_DATA if versions[name][1]]
+    last_modified = datetime.fromisoformat(max(stamps)).replace(microsecond=0) if stamps else None
+    return key, last_modified
+
+
+def build_view_model(stock, recipes, forecasts=None):
+    """Template context for index.html: stock grouped by category (with forecasts) plus the ingredient/recipe lists"""
+    forecasts = forecasts or {}
+    sorted_stock = sorted(stock, key=lambda x: x['name'])
+
+    inventory_by_category = collections.defaultdict(list)
+    for item in stock:
+        cat = item.get('category', 'Other')
+        inventory_by_category[cat].append({
+            'id': item['id'],
+            'name': item['name'],
+            'current_stock': item.get('quantity', item.get('current_stock', 0)),
+            'unit': item['unit'],
+            'low_stock_threshold': item.get('threshold', 0),
+            'category': cat,
+            'cost_per_unit': item.get('cost_per_unit', 0),
+            'forecast': forecasts.get(item['id'])
+        })
+
+    sorted_inventory = {}
+    for cat in CATEGORY_ORDER:
+        if cat in inventory_by_category:
+            sorted_inventory[cat] = inventory_by_category[cat]
+    for cat in inventory_by_category:
+        if cat not in sorted_inventory:
+            sorted_inventory[cat] = inventory_by_category[cat]
+
+    return {
+        'inventory_by_category': sorted_inventory,
+        'all_ingredients': sorted_stock,
+        'recipes': recipes or {}
+    }
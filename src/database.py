@@ -1,11 +1,62 @@
 import sqlite3
 import os
+import time
+from datetime import datetime
 
 DB_PATH = os.path.join('data', 'inventory.db')
 
+# Seconds a writer waits on another worker's BEGIN IMMEDIATE before giving up
+BUSY_TIMEOUT = 30
+
+# Stay well below SQLite's bound-variable limit (999 on older builds)
+IN_CLAUSE_CHUNK = 500
+
+# Called after every statement as hook(sql, seconds); used by metrics and the SQL tracer
+_query_hooks = []
+
+def add_query_hook(hook):
+    """Register hook(sql, seconds) to run after each statement on get_connection() connections."""
+    if hook not in _query_hooks:
+        _query_hooks.append(hook)
+
+def _run_query_hooks(sql, started):
+    elapsed = time.perf_counter() - started
+    for hook in _query_hooks:
+        hook(sql, elapsed)
+
+class TimedCursor(sqlite3.Cursor):
+    """Cursor that reports each execute()/executemany() to the registered query hooks."""
+    def execute(self, sql, parameters=()):
+        if not _query_hooks:
+            return super().execute(sql, parameters)
+        started = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            _run_query_hooks(sql, started)
+
+    def executemany(self, sql, seq_of_parameters):
+        if not _query_hooks:
+            return super().executemany(sql, seq_of_parameters)
+        started = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            _run_query_hooks(sql, started)
+
+class TimedConnection(sqlite3.Connection):
+    def cursor(self, factory=TimedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
 def get_connection():
     """Get a connection to the SQLite database."""
-    conn = sqlite3.connect(DB_PATH)
+    conn = sqlite3.connect(DB_PATH, timeout=BUSY_TIMEOUT, factory=TimedConnection)
     conn.row_factory = sqlite3.Row
     return conn
 
@@ -17,6 +68,9 @@ def init_db():
     conn = get_connection()
     cursor = conn.cursor()
     
+    # WAL lets readers keep going while a writer holds the lock (persists in the DB file)
+    cursor.execute('PRAGMA journal_mode=WAL')
+    
     # Create Ingredients table
     cursor.execute('''
     CREATE TABLE IF NOT EXISTS ingredients (
@@ -62,12 +116,70 @@ def init_db():
         menu_item_guid TEXT NOT NULL,
         ingredient_id TEXT,
         quantity REAL,
-        unit TEXT,
+        unit TEXT, -- recipe unit; NULL means the ingredient's stock unit
+        conversion_factor REAL NOT NULL DEFAULT 1, -- stock units per recipe unit (see src/units.py)
+        stock_quantity REAL, -- quantity * conversion_factor, what one sale deducts
         FOREIGN KEY (menu_item_guid) REFERENCES menu_items (item_guid),
         FOREIGN KEY (ingredient_id) REFERENCES ingredients (id)
     )
     ''')
     
+    # Databases created before unit conversion: quantities were already in stock units
+    cursor.execute('PRAGMA table_info(recipe_components)')
+    if 'stock_quantity' not in {row['name'] for row in cursor.fetchall()}:
+        cursor.execute('ALTER TABLE recipe_components ADD COLUMN conversion_factor REAL NOT NULL DEFAULT 1')
+        cursor.execute('ALTER TABLE recipe_components ADD COLUMN stock_quantity REAL')
+        cursor.execute('UPDATE recipe_components SET stock_quantity = quantity')
+    # Rows inserted without src/units.py (seed scripts, hand-written SQL) have no stock_quantity
+    cursor.execute('UPDATE recipe_components SET stock_quantity = quantity * conversion_factor WHERE stock_quantity IS NULL')
+    
+    # Create Ingredient Units table (pack sizes: how many stock units one `unit` holds)
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS ingredient_units (
+        ingredient_id TEXT NOT NULL,
+        unit TEXT NOT NULL,
+        stock_units REAL NOT NULL,
+        PRIMARY KEY (ingredient_id, unit),
+        FOREIGN KEY (ingredient_id) REFERENCES ingredients (id)
+    )
+    ''')
+    
+    cursor.execute('''
+    CREATE INDEX IF NOT EXISTS idx_recipe_components_menu_item 
+    ON recipe_components(menu_item_guid)
+    ''')
+    
+    # Reverse lookup from an ingredient to the menu items using it
+    cursor.execute('''
+    CREATE INDEX IF NOT EXISTS idx_recipe_components_ingredient
+    ON recipe_components(ingredient_id, menu_item_guid)
+    ''')
+
+    # Create Menu Item Costs table (plate cost per menu item, see src/plate_costs.py)
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS menu_item_costs (
+        menu_item_guid TEXT PRIMARY KEY,
+        plate_cost REAL NOT NULL DEFAULT 0,
+        component_count INTEGER NOT NULL DEFAULT 0,
+        missing_costs INTEGER NOT NULL DEFAULT 0, -- components with no ingredient cost yet
+        updated_at TEXT
+    )
+    ''')
+
+    # Backfill plate costs the first time the table is created
+    cursor.execute('''
+    INSERT INTO menu_item_costs (menu_item_guid, plate_cost, component_count, missing_costs, updated_at)
+    SELECT rc.menu_item_guid,
+           SUM(COALESCE(rc.stock_quantity, rc.quantity) * COALESCE(i.cost_per_unit, 0)),
+           COUNT(*),
+           SUM(CASE WHEN i.id IS NULL OR COALESCE(i.cost_per_unit, 0) + 0 <= 0 THEN 1 ELSE 0 END),
+           ?
+    FROM recipe_components rc
+    LEFT JOIN ingredients i ON i.id = rc.ingredient_id
+    WHERE NOT EXISTS (SELECT 1 FROM menu_item_costs)
+    GROUP BY rc.menu_item_guid
+    ''', (datetime.now().isoformat(),))
+
     # Create Goods Inward table
     cursor.execute('''
     CREATE TABLE IF NOT EXISTS goods_inward (
@@ -106,10 +218,30 @@ def init_db():
         new_stock REAL,
         cost_per_unit REAL,
         total_waste_cost REAL,
+        movement_type TEXT NOT NULL DEFAULT 'adjustment', -- stock_ledger movement type: 'adjustment' or 'count'
         FOREIGN KEY (ingredient_id) REFERENCES ingredients (id)
     )
     ''')
     
+    # Databases created before adjustments recorded their movement type
+    cursor.execute('PRAGMA table_info(inventory_adjustments)')
+    if 'movement_type' not in {row['name'] for row in cursor.fetchall()}:
+        cursor.execute("ALTER TABLE inventory_adjustments ADD COLUMN movement_type TEXT NOT NULL DEFAULT 'adjustment'")
+        cursor.execute("UPDATE inventory_adjustments SET movement_type = 'count' WHERE reason = 'Stock Count'")
+        cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'stock_ledger'")
+        if cursor.fetchone():
+            # Stocktakes under another reason: the 'count' ledger row written just before them
+            cursor.execute('''
+                UPDATE inventory_adjustments SET movement_type = 'count'
+                WHERE movement_type != 'count' AND EXISTS (
+                    SELECT 1 FROM stock_ledger l
+                    WHERE l.movement_type = 'count' AND l.ingredient_id = inventory_adjustments.ingredient_id
+                      AND l.reference IS inventory_adjustments.reason
+                      AND l.timestamp BETWEEN strftime('%Y-%m-%dT%H:%M:%S', inventory_adjustments.timestamp, '-5 seconds')
+                                          AND inventory_adjustments.timestamp
+                )
+            ''')
+    
     # Create Orders table
     cursor.execute('''
     CREATE TABLE IF NOT EXISTS orders (
@@ -160,9 +292,278 @@ def init_db():
     )
     ''')
     
+    # History indexes (newest-first paging, optionally per ingredient)
+    for table in ('goods_inward', 'inventory_adjustments', 'order_deductions'):
+        cursor.execute(f'''
+        CREATE INDEX IF NOT EXISTS idx_{table}_timestamp 
+        ON {table}(timestamp, id)
+        ''')
+        cursor.execute(f'''
+        CREATE INDEX IF NOT EXISTS idx_{table}_ingredient 
+        ON {table}(ingredient_id, timestamp, id)
+        ''')
+    
+    # Waste summaries scan deductions by time range
+    cursor.execute('''
+    CREATE INDEX IF NOT EXISTS idx_inventory_adjustments_type
+    ON inventory_adjustments(type, timestamp)
+    ''')
+
+    # Order paging/filter indexes and per-order child lookups
+    cursor.execute('''
+    CREATE INDEX IF NOT EXISTS idx_orders_closed_date 
+    ON orders(closed_date, id)
+    ''')
+    
+    cursor.execute('''
+    CREATE INDEX IF NOT EXISTS idx_orders_source 
+    ON orders(source, closed_date, id)
+    ''')
+    
+    cursor.execute('''
+    CREATE INDEX IF NOT EXISTS idx_orders_payment_status 
+    ON orders(payment_status, closed_date, id)
+    ''')
+    
+    cursor.execute('''
+    CREATE INDEX IF NOT EXISTS idx_order_items_order 
+    ON order_items(order_id)
+    ''')
+    
+    cursor.execute('''
+    CREATE INDEX IF NOT EXISTS idx_order_deductions_order 
+    ON order_deductions(order_id)
+    ''')
+    
+    # Recipe replay finds a menu item's past order lines and their deductions
+    cursor.execute('''
+    CREATE INDEX IF NOT EXISTS idx_order_items_menu_item 
+    ON order_items(menu_item_guid)
+    ''')
+    
+    cursor.execute('''
+    CREATE INDEX IF NOT EXISTS idx_order_deductions_item 
+    ON order_deductions(order_item_id)
+    ''')
+    
+    # Create Daily Rollup tables (kept up to date by the sync and the stock mutation engine)
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS daily_order_stats (
+        day TEXT PRIMARY KEY,
+        order_count INTEGER NOT NULL DEFAULT 0,
+        revenue REAL NOT NULL DEFAULT 0,
+        tax REAL NOT NULL DEFAULT 0,
+        tips REAL NOT NULL DEFAULT 0
+    )
+    ''')
+    
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS daily_ingredient_stats (
+        day TEXT NOT NULL,
+        ingredient_id TEXT NOT NULL,
+        deducted REAL NOT NULL DEFAULT 0,
+        received REAL NOT NULL DEFAULT 0,
+        wasted REAL NOT NULL DEFAULT 0,
+        PRIMARY KEY (day, ingredient_id)
+    )
+    ''')
+    
+    # Backfill the rollups from existing history the first time they are created
+    cursor.execute('''
+    INSERT INTO daily_order_stats (day, order_count, revenue, tax, tips)
+    SELECT substr(COALESCE(closed_date, synced_at), 1, 10), COUNT(*),
+           COALESCE(SUM(total_amount), 0), COALESCE(SUM(tax_amount), 0), COALESCE(SUM(tip_amount), 0)
+    FROM orders
+    WHERE deleted = 0 AND NOT EXISTS (SELECT 1 FROM daily_order_stats)
+    GROUP BY 1
+    ''')
+    
+    # Same split as the live rollups: only 'adjustment' deductions are waste, never stocktakes
+    cursor.execute('''
+    INSERT INTO daily_ingredient_stats (day, ingredient_id, deducted, received, wasted)
+    SELECT day, ingredient_id, SUM(deducted), SUM(received), SUM(wasted)
+    FROM (
+        SELECT substr(timestamp, 1, 10) AS day, ingredient_id,
+               quantity_deducted AS deducted, 0 AS received, 0 AS wasted
+        FROM order_deductions
+        UNION ALL
+        SELECT substr(timestamp, 1, 10), ingredient_id, 0, quantity_received, 0
+        FROM goods_inward
+        UNION ALL
+        SELECT substr(timestamp, 1, 10), ingredient_id, 0, 0, quantity
+        FROM inventory_adjustments
+        WHERE type = 'Deduction' AND movement_type = 'adjustment'
+    )
+    WHERE ingredient_id IS NOT NULL AND NOT EXISTS (SELECT 1 FROM daily_ingredient_stats)
+    GROUP BY day, ingredient_id
+    ''')
+
+    # Create Ingredient Forecasts table (rebuilt by src/forecast.py, read by the dashboard)
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS ingredient_forecasts (
+        ingredient_id TEXT PRIMARY KEY,
+        computed_at TEXT NOT NULL,
+        avg_daily_usage REAL NOT NULL,
+        forecast_7d REAL NOT NULL,
+        days_until_stockout REAL, -- NULL when stock outlasts the forecast horizon
+        stockout_date TEXT,
+        reorder_point REAL NOT NULL,
+        par_level REAL NOT NULL,
+        suggested_order_qty REAL NOT NULL,
+        needs_reorder INTEGER NOT NULL DEFAULT 0,
+        history_days INTEGER NOT NULL DEFAULT 0,
+        FOREIGN KEY (ingredient_id) REFERENCES ingredients (id)
+    )
+    ''')
+
+    # Create Data Versions table (bumped by every write so in-process caches can revalidate)
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS data_versions (
+        name TEXT PRIMARY KEY,
+        version INTEGER NOT NULL DEFAULT 0,
+        updated_at TEXT
+    )
+    ''')
+
+    # menu_items is loaded outside the app (nothing here writes it), so triggers bump its version
+    for event in ('INSERT', 'UPDATE', 'DELETE'):
+        cursor.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS trg_menu_items_version_{event.lower()}
+        AFTER {event} ON menu_items
+        BEGIN
+            INSERT INTO data_versions (name, version, updated_at)
+            VALUES ('menu_items', 1, strftime('%Y-%m-%dT%H:%M:%f', 'now', 'localtime'))
+            ON CONFLICT(name) DO UPDATE SET version = version + 1, updated_at = excluded.updated_at;
+        END
+        ''')
+
+    # Create Stock Ledger table (append-only, one row per stock movement)
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS stock_ledger (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        timestamp TEXT NOT NULL,
+        ingredient_id TEXT NOT NULL,
+        delta REAL NOT NULL,
+        movement_type TEXT NOT NULL, -- 'opening', 'receipt', 'adjustment', 'count', 'sale', 'manual', 'correction'
+        reference TEXT
+    )
+    ''')
+    
+    cursor.execute('''
+    CREATE INDEX IF NOT EXISTS idx_stock_ledger_ingredient 
+    ON stock_ledger(ingredient_id)
+    ''')
+    
+    # Create Stock Snapshots table (per-ingredient ledger balance up to ledger_id)
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS stock_snapshots (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        ingredient_id TEXT NOT NULL,
+        ledger_id INTEGER NOT NULL,
+        timestamp TEXT NOT NULL,
+        balance REAL NOT NULL
+    )
+    ''')
+    
+    cursor.execute('''
+    CREATE INDEX IF NOT EXISTS idx_stock_snapshots_ledger 
+    ON stock_snapshots(ledger_id)
+    ''')
+    
+    cursor.execute('''
+    CREATE INDEX IF NOT EXISTS idx_stock_snapshots_timestamp 
+    ON stock_snapshots(timestamp)
+    ''')
+    
+    # Create Alert State table (current low-stock state per ingredient, see src/stock_alerts.py)
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS ingredient_alert_state (
+        ingredient_id TEXT PRIMARY KEY,
+        state TEXT NOT NULL, -- 'ok', 'low', 'out'
+        changed_at TEXT
+    )
+    ''')
+    
+    # Create Stock Alerts table (one row per state transition)
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS stock_alerts (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        timestamp TEXT NOT NULL,
+        ledger_id INTEGER NOT NULL, -- last stock_ledger row of the write that raised it
+        ingredient_id TEXT NOT NULL,
+        ingredient_name TEXT,
+        unit TEXT,
+        state TEXT NOT NULL,
+        previous_state TEXT,
+        stock REAL,
+        threshold REAL,
+        movement_type TEXT,
+        reference TEXT
+    )
+    ''')
+    
+    cursor.execute('''
+    CREATE INDEX IF NOT EXISTS idx_stock_alerts_ledger 
+    ON stock_alerts(ledger_id)
+    ''')
+    
+    # Create Deduction Corrections table (what each recipe replay changed per day and
+    # ingredient; 'ledgered' is 0 when the replaced deductions predate the opening balances)
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS deduction_corrections (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        timestamp TEXT NOT NULL,
+        reference TEXT,
+        day TEXT NOT NULL,
+        ingredient_id TEXT NOT NULL,
+        delta REAL NOT NULL, -- recomputed minus recorded deductions
+        ledgered INTEGER NOT NULL
+    )
+    ''')
+    
+    # Create Export Invalidations table (day partitions whose rows were rewritten in place,
+    # e.g. by a recipe replay; src/analytics_export.py re-exports them)
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS export_invalidations (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        table_name TEXT NOT NULL,
+        day TEXT NOT NULL,
+        timestamp TEXT NOT NULL,
+        reference TEXT
+    )
+    ''')
+    
+    # Seed the ledger with opening balances the first time it is created
+    cursor.execute('''
+    INSERT INTO stock_ledger (timestamp, ingredient_id, delta, movement_type, reference)
+    SELECT ?, id, current_stock, 'opening', 'Opening balance'
+    FROM ingredients
+    WHERE current_stock != 0 AND NOT EXISTS (SELECT 1 FROM stock_ledger)
+    ''', (datetime.now().isoformat(),))
+    
     conn.commit()
     conn.close()
 
+def bump_version(cursor, name):
+    """Increment the data version for `name` as part of the caller's transaction."""
+    cursor.execute('''
+        INSERT INTO data_versions (name, version, updated_at) VALUES (?, 1, ?)
+        ON CONFLICT(name) DO UPDATE SET version = version + 1, updated_at = excluded.updated_at
+    ''', (name, datetime.now().isoformat()))
+
+def get_versions(cursor, names):
+    """Return {name: (version, updated_at)} for several data versions in one query."""
+    placeholders = ','.join('?' * len(names))
+    cursor.execute(f'SELECT name, version, updated_at FROM data_versions WHERE name IN ({placeholders})', list(names))
+    found = {row[0]: (row[1], row[2]) for row in cursor.fetchall()}
+    return {name: found.get(name, (0, None)) for name in names}
+
+def get_version(cursor, name):
+    """Return the current data version for `name` (0 if it was never written)."""
+    cursor.execute('SELECT version FROM data_versions WHERE name = ?', (name,))
+    row = cursor.fetchone()
+    return row[0] if row else 0
+
 if __name__ == "__main__":
     init_db()
     print(f"Database initialized at {DB_PATH}")
@@ -0,0 +1,171 @@
+"""
+Usage Forecasting
+Builds a day x ingredient consumption matrix (sales deductions plus waste) from
+the daily rollups and, for every ingredient at once, projects usage from a
+moving average scaled by day-of-week factors. From that it derives days until
+stockout, reorder points, par levels and suggested order quantities, stored in
+ingredient_forecasts for the dashboard.
+"""
+
+from datetime import date, datetime, timedelta
+import numpy as np
+from src.database import get_connection, bump_version
+
+HISTORY_DAYS = 364         # consumption history loaded (52 full weeks)
+MOVING_AVERAGE_DAYS = 28   # window for the base daily rate and its volatility
+SEASON_DAYS = 84           # window for day-of-week factors
+MIN_SEASON_DAYS = 28       # below this, day-of-week factors are not trusted
+HORIZON_DAYS = 60          # how far ahead stockouts are projected
+LEAD_TIME_DAYS = 2         # order-to-delivery time
+REVIEW_DAYS = 7            # time until the next order opportunity
+SERVICE_Z = 1.65           # safety stock multiplier (~95% service level)
+
+
+def load_usage(cursor, today=None):
+    """
+    Daily consumption matrix ending yesterday (today is still incomplete).
+    Returns (first_day, ingredient_ids, stocks, usage[days, ingredients]).
+    """
+    today = today or date.today()
+    cursor.execute('SELECT id, current_stock FROM ingredients ORDER BY id')
+    ingredients = cursor.fetchall()
+    ids = [row['id'] for row in ingredients]
+    stocks = np.array([float(row['current_stock'] or 0) for row in ingredients])
+
+    # Only the span the system has actually recorded, so a new install is not averaged against empty months
+    cursor.execute('SELECT MIN(day) FROM daily_ingredient_stats WHERE day >= ?',
+                   ((today - timedelta(days=HISTORY_DAYS)).isoformat(),))
+    first = cursor.fetchone()[0]
+    if not first or first >= today.isoformat():
+        return today, ids, stocks, np.zeros((0, len(ids)))
+    first_day = date.fromisoformat(first)
+
+    cursor.execute('''
+        SELECT ingredient_id, day, deducted + wasted
+        FROM daily_ingredient_stats
+        WHERE day >= ? AND day < ?
+    ''', (first_day.isoformat(), today.isoformat()))
+    rows = cursor.fetchall()
+
+    usage = np.zeros(((today - first_day).days, len(ids)))
+    if rows:
+        index = {ingredient_id: i for i, ingredient_id in enumerate(ids)}
+        ing_ids, days, amounts = zip(*rows)
+        cols = np.fromiter((index.get(i, -1) for i in ing_ids), dtype=np.int64, count=len(rows))
+        offsets = (np.array(days, dtype='datetime64[D]') - np.datetime64(first_day, 'D')).astype(np.int64)
+        keep = cols >= 0
+        np.add.at(usage, (offsets[keep], cols[keep]), np.array(amounts, dtype=float)[keep])
+    return first_day, ids, stocks, usage
+
+
+def forecast_usage(first_day, stocks, usage, today=None, lead_time_days=LEAD_TIME_DAYS, review_days=REVIEW_DAYS):
+    """Vectorized forecast for all ingredients; returns a dict of per-ingredient arrays"""
+    today = today or date.today()
+    n = usage.shape[1]
+    recent = usage[-MOVING_AVERAGE_DAYS:]
+    rate = recent.mean(axis=0) if len(recent) else np.zeros(n)
+    sigma = recent.std(axis=0) if len(recent) else np.zeros(n)
+
+    # Day-of-week factors: mean usage on each weekday relative to the overall mean
+    factors = np.ones((7, n))
+    season = usage[-SEASON_DAYS:]
+    if len(season) >= MIN_SEASON_DAYS:
+        season_start = first_day + timedelta(days=len(usage) - len(season))
+        weekdays = (np.arange(len(season)) + season_start.weekday()) % 7
+        sums = np.zeros((7, n))
+        np.add.at(sums, weekdays, season)
+        counts = np.bincount(weekdays, minlength=7)[:, None]
+        overall = season.mean(axis=0)
+        np.divide(sums / np.maximum(counts, 1), overall, out=factors, where=overall > 0)
+
+    future_weekdays = (np.arange(HORIZON_DAYS) + today.weekday()) % 7
+    daily = rate[None, :] * factors[future_weekdays]          # [HORIZON_DAYS, n], today first
+    cumulative = np.cumsum(daily, axis=0)
+
+    # Fractional day on which cumulative usage first reaches the stock on hand
+    exhausted = cumulative >= stocks[None, :]
+    runs_out = exhausted.any(axis=0) & (rate > 0)
+    first_idx = exhausted.argmax(axis=0)
+    cols = np.arange(n)
+    before = np.where(first_idx > 0, cumulative[first_idx - 1, cols], 0.0)
+    on_day = daily[first_idx, cols]
+    fraction = np.divide(stocks - before, on_day, out=np.zeros(n), where=on_day > 0)
+    days_left = np.where(stocks <= 0, 0.0, first_idx + np.clip(fraction, 0, 1))
+
+    safety = SERVICE_Z * sigma * np.sqrt(lead_time_days)
+    reorder_point = cumulative[lead_time_days - 1] + safety if lead_time_days > 0 else safety
+    par_level = cumulative[min(lead_time_days + review_days, HORIZON_DAYS) - 1] + safety
+    needs_reorder = stocks <= reorder_point
+    suggested = np.where(needs_reorder, np.maximum(par_level - stocks, 0), 0.0)
+
+    return {
+        'avg_daily_usage': rate,
+        'forecast_7d': cumulative[6],
+        'days_until_stockout': np.where(runs_out | (stocks <= 0), days_left, np.nan),
+        'reorder_point': reorder_point,
+        'par_level': par_level,
+        'suggested_order_qty': suggested,
+        'needs_reorder': needs_reorder & (rate > 0)
+    }
+
+
+def recompute(lead_time_days=LEAD_TIME_DAYS, review_days=REVIEW_DAYS):
+    """Rebuild ingredient_forecasts in one transaction; returns the number of ingredients forecast"""
+    if lead_time_days < 0 or review_days < 1 or lead_time_days + review_days > HORIZON_DAYS:
+        raise ValueError(f"lead_time_days + review_days must be between 1 and {HORIZON_DAYS}")
+    today = date.today()
+    conn = get_connection()
+    cursor = conn.cursor()
+    try:
+        first_day, ids, stocks, usage = load_usage(cursor, today)
+        result = forecast_usage(first_day, stocks, usage, today, lead_time_days, review_days)
+        computed_at = datetime.now().isoformat()
+
+        rows = []
+        for i, ingredient_id in enumerate(ids):
+            days_left = result['days_until_stockout'][i]
+            stockout = None if np.isnan(days_left) else round(float(days_left), 1)
+            rows.append((
+                ingredient_id, computed_at,
+                round(float(result['avg_daily_usage'][i]), 4),
+                round(float(result['forecast_7d'][i]), 4),
+                stockout,
+                (today + timedelta(days=int(stockout))).isoformat() if stockout is not None else None,
+                round(float(result['reorder_point'][i]), 4),
+                round(float(result['par_level'][i]), 4),
+                round(float(result['suggested_order_qty'][i]), 4),
+                int(bool(result['needs_reorder'][i])),
+                len(usage)
+            ))
+
+        cursor.execute('BEGIN IMMEDIATE')
+        cursor.execute('DELETE FROM ingredient_forecasts')
+        cursor.executemany('''
+            INSERT INTO ingredient_forecasts (ingredient_id, computed_at, avg_daily_usage, forecast_7d,
+                days_until_stockout, stockout_date, reorder_point, par_level, suggested_order_qty,
+                needs_reorder, history_days)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ''', rows)
+        bump_version(cursor, 'forecasts')
+        conn.commit()
+        return len(rows)
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+
+
+def get_forecasts():
+    """{ingredient_id: forecast row} from the last recompute"""
+    conn = get_connection()
+    cursor = conn.cursor()
+    try:
+        cursor.execute('SELECT * FROM ingredient_forecasts')
+        return {row['ingredient_id']: dict(row) for row in cursor.fetchall()}
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    print(f"Forecast {recompute()} ingredient(s)")
@@ -3,11 +3,13 @@ Goods Inward (Receipt of Goods) System
 Use this when you receive shipments to add stock to inventory
 """
 
+import math
 import os
 import sqlite3
 from datetime import datetime
 from src.database import get_connection
 from src.inventory_manager import InventoryManager
+from src.stock_mutations import fetch_ingredients, apply_stock_deltas
 from src.logger import Logger
 
 class GoodsInwardManager:
@@ -15,11 +17,14 @@ class GoodsInwardManager:
         self.inventory = InventoryManager()
         self.logger = Logger()
     
-    def load_delivery_history(self):
-        """Load past receipt records"""
+    def load_delivery_history(self, limit=None):
+        """Load past receipt records, newest first"""
         conn = get_connection()
         cursor = conn.cursor()
-        cursor.execute('SELECT * FROM goods_inward ORDER BY timestamp DESC')
+        if limit is None:
+            cursor.execute('SELECT * FROM goods_inward ORDER BY timestamp DESC, id DESC')
+        else:
+            cursor.execute('SELECT * FROM goods_inward ORDER BY timestamp DESC, id DESC LIMIT ?', (int(limit),))
         rows = cursor.fetchall()
         conn.close()
         
@@ -27,30 +32,30 @@ class GoodsInwardManager:
     
     def receive_delivery(self, ingredient_id, quantity, supplier="", invoice_number="", notes="", unit_cost=None):
         """Receive a delivery and update database"""
-        ingredient = self.inventory.get_ingredient(ingredient_id)
-        
-        if not ingredient:
-            self.logger.error(f"Ingredient '{ingredient_id}' not found!")
-            return False
-        
-        # Get current stock
-        old_stock = ingredient['current_stock']
-        new_stock = old_stock + float(quantity)
-        
-        # Effective unit cost
-        final_unit_cost = unit_cost if unit_cost is not None else ingredient.get('cost_per_unit', 0)
-        total_cost = final_unit_cost * float(quantity)
-        
         conn = get_connection()
         cursor = conn.cursor()
         
         try:
+            # Hold the write lock from the stock read through to the commit
+            cursor.execute('BEGIN IMMEDIATE')
+            ingredients = fetch_ingredients(cursor, [ingredient_id])
+            ingredient = ingredients.get(ingredient_id)
+            
+            if not ingredient:
+                conn.rollback()
+                self.logger.error(f"Ingredient '{ingredient_id}' not found!")
+                return False
+            
+            # Effective unit cost
+            final_unit_cost = float(unit_cost if unit_cost is not None else ingredient.get('cost_per_unit') or 0)
+            total_cost = final_unit_cost * float(quantity)
+            
             # 1. Update ingredient stock and cost
-            cursor.execute('''
-                UPDATE ingredients 
-                SET current_stock = ?, cost_per_unit = ? 
-                WHERE id = ?
-            ''', (float(new_stock), float(final_unit_cost), ingredient_id))
+            change = apply_stock_deltas(
+                cursor, [(ingredient_id, float(quantity))], 'receipt', reference=invoice_number or supplier,
+                costs={ingredient_id: final_unit_cost}, ingredients=ingredients
+            )[0]
+            old_stock, new_stock = change['old_stock'], change['new_stock']
             
             # 2. Log receipt
             cursor.execute('''
@@ -88,28 +93,131 @@ class GoodsInwardManager:
         finally:
             conn.close()
     
-    def receive_multiple_items(self, items):
-        """Receive multiple items in one transaction"""
-        self.logger.section("RECEIVING GOODS INWARD - MULTIPLE ITEMS")
-        success_count = 0
+    def receive_bulk(self, items):
+        """
+        Receive a whole delivery (e.g. one supplier invoice) in a single transaction.
+        Every line is validated first; if any line is invalid nothing is applied.
+        Returns {'success': bool, 'received': n, 'results': [per-line result, ...]}
+        """
+        results = []
+        lines = []
         
-        for item in items:
-            if self.receive_delivery(
-                ingredient_id=item.get('ingredient_id'),
-                quantity=item.get('quantity', 0),
-                supplier=item.get('supplier', ''),
-                invoice_number=item.get('invoice_number', ''),
-                notes=item.get('notes', ''),
-                unit_cost=item.get('unit_cost', None)
-            ):
-                success_count += 1
+        # 1. Validate every line before touching the database
+        for line_no, item in enumerate(items, 1):
+            if not isinstance(item, dict):
+                results.append({'line': line_no, 'ingredient_id': None, 'status': 'error',
+                                'message': "Each line must be an object"})
+                continue
+            ingredient_id = item.get('ingredient_id')
+            result = {'line': line_no, 'ingredient_id': ingredient_id, 'status': 'error'}
+            results.append(result)
+            
+            try:
+                quantity = float(item.get('quantity', 0))
+                unit_cost = item.get('unit_cost')
+                unit_cost = float(unit_cost) if unit_cost not in (None, '') else None
+            except (TypeError, ValueError):
+                result['message'] = "Quantity and unit cost must be numbers"
+                continue
+            
+            if not math.isfinite(quantity) or (unit_cost is not None and not math.isfinite(unit_cost)):
+                result['message'] = "Quantity and unit cost must be finite numbers"
+            elif not ingredient_id:
+                result['message'] = "Missing ingredient_id"
+            elif quantity <= 0:
+                result['message'] = "Quantity must be greater than zero"
+            else:
+                result['status'] = 'ok'
+                lines.append((result, item, quantity, unit_cost))
+        
+        conn = get_connection()
+        cursor = conn.cursor()
+        
+        try:
+            # 2. Load every referenced ingredient in one query, under the write lock
+            cursor.execute('BEGIN IMMEDIATE')
+            ingredients = fetch_ingredients(cursor, [line[0]['ingredient_id'] for line in lines])
+            
+            for result, item, quantity, unit_cost in lines:
+                if result['ingredient_id'] not in ingredients:
+                    result['status'] = 'error'
+                    result['message'] = f"Ingredient '{result['ingredient_id']}' not found"
+            
+            if not items or any(r['status'] == 'error' for r in results):
+                conn.rollback()
+                self.logger.error(f"Bulk delivery rejected: {sum(r['status'] == 'error' for r in results)} invalid line(s)")
+                return {'success': False, 'received': 0, 'results': results}
+            
+            # 3. Apply all stock changes and receipt rows together
+            costs = {}
+            for result, item, quantity, unit_cost in lines:
+                ingredient = ingredients[result['ingredient_id']]
+                costs[result['ingredient_id']] = float(unit_cost if unit_cost is not None else ingredient.get('cost_per_unit') or 0)
+            
+            changes = apply_stock_deltas(
+                cursor,
+                [(line[0]['ingredient_id'], line[2], line[1].get('invoice_number') or line[1].get('supplier'))
+                 for line in lines],
+                'receipt', costs=costs, ingredients=ingredients
+            )
+            
+            timestamp = datetime.now().isoformat()
+            rows = []
+            for (result, item, quantity, unit_cost), change in zip(lines, changes):
+                ingredient = change['ingredient']
+                final_unit_cost = float(unit_cost if unit_cost is not None else ingredient.get('cost_per_unit') or 0)
+                rows.append((
+                    timestamp,
+                    ingredient['id'],
+                    ingredient['name'],
+                    quantity,
+                    ingredient['unit'],
+                    change['old_stock'],
+                    change['new_stock'],
+                    item.get('supplier', ''),
+                    item.get('invoice_number', ''),
+                    item.get('notes', ''),
+                    "System",
+                    final_unit_cost,
+                    final_unit_cost * quantity
+                ))
+                result['status'] = 'received'
+                result['name'] = ingredient['name']
+                result['quantity'] = quantity
+                result['old_stock'] = change['old_stock']
+                result['new_stock'] = change['new_stock']
+            
+            cursor.executemany('''
+                INSERT INTO goods_inward (
+                    timestamp, ingredient_id, ingredient_name, quantity_received, unit, 
+                    old_stock, new_stock, supplier, invoice_number, notes, received_by, 
+                    unit_cost, total_cost
+                ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ''', rows)
+            
+            conn.commit()
+        except Exception as e:
+            self.logger.error(f"Error processing bulk delivery: {e}")
+            conn.rollback()
+            for result in results:
+                result['status'] = 'error'
+                result.setdefault('message', str(e))
+            return {'success': False, 'received': 0, 'results': results}
+        finally:
+            conn.close()
         
-        self.logger.section(f"DELIVERY COMPLETE - {success_count}/{len(items)} items received")
-        return success_count == len(items)
+        self.logger.info(f"[DELIVERY] RECEIVED {len(rows)} line(s): " + ", ".join(
+            f"{row[3]} {row[4]} {row[2]}" for row in rows
+        ))
+        return {'success': True, 'received': len(rows), 'results': results}
+    
+    def receive_multiple_items(self, items):
+        """Receive multiple items in one transaction"""
+        return self.receive_bulk(items)['success']
 
     def view_delivery_history(self, limit=10):
         """Print recent receipts to console"""
-        history = self.load_delivery_history()
+        history = self.load_delivery_history(limit=limit)
         deliveries = history['deliveries']
         
         print("\n" + "="*70)
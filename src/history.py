@@ -0,0 +1,140 @@
+"""
+Stock History
+One time-ordered stream of deliveries, adjustments and order deductions,
+paged with keyset cursors so each page costs the same regardless of history size
+"""
+
+import base64
+import binascii
+import json
+from src.database import get_connection
+
+# Each source contributes one event type. The rank breaks timestamp ties so
+# that the (timestamp, rank, id) ordering is total and cursors are stable.
+EVENT_SOURCES = {
+    'delivery': {
+        'rank': 3,
+        'alias': 'g',
+        'sql': '''
+            SELECT 'delivery' AS type, g.id, g.timestamp, g.ingredient_id, g.ingredient_name,
+                   g.quantity_received AS quantity, g.unit, g.received_by AS staff,
+                   COALESCE(NULLIF(g.supplier, ''), g.invoice_number) AS detail,
+                   g.old_stock, g.new_stock
+            FROM goods_inward g
+        ''',
+        'staff_column': 'g.received_by'
+    },
+    'adjustment': {
+        'rank': 2,
+        'alias': 'a',
+        'sql': '''
+            SELECT 'adjustment' AS type, a.id, a.timestamp, a.ingredient_id, a.ingredient_name,
+                   CASE WHEN a.type = 'Addition' THEN a.quantity ELSE -a.quantity END AS quantity,
+                   a.unit, a.staff_member AS staff, a.reason AS detail,
+                   a.old_stock, a.new_stock
+            FROM inventory_adjustments a
+        ''',
+        'staff_column': 'a.staff_member'
+    },
+    'sale': {
+        'rank': 1,
+        'alias': 'od',
+        'sql': '''
+            SELECT 'sale' AS type, od.id, od.timestamp, od.ingredient_id, i.name AS ingredient_name,
+                   -od.quantity_deducted AS quantity, i.unit, NULL AS staff,
+                   o.order_number AS detail, NULL AS old_stock, NULL AS new_stock
+            FROM order_deductions od
+            LEFT JOIN ingredients i ON i.id = od.ingredient_id
+            LEFT JOIN orders o ON o.id = od.order_id
+        ''',
+        'staff_column': None
+    }
+}
+
+MAX_PAGE_SIZE = 200
+
+
+def encode_cursor(event):
+    """Opaque cursor pointing just after `event` in the stream"""
+    raw = json.dumps([event['timestamp'], event['type'], event['id']])
+    return base64.urlsafe_b64encode(raw.encode('utf-8')).decode('ascii')
+
+
+def decode_cursor(cursor_str):
+    """Raises ValueError for anything encode_cursor could not have produced"""
+    try:
+        timestamp, event_type, event_id = json.loads(base64.urlsafe_b64decode(cursor_str.encode('ascii')))
+        if event_type not in EVENT_SOURCES:
+            raise ValueError(f"unknown event type {event_type!r}")
+        return str(timestamp), event_type, int(event_id)
+    except (TypeError, ValueError, binascii.Error, UnicodeError) as e:
+        raise ValueError(f"malformed cursor ({e})")
+
+
+class HistoryManager:
+    def get_events(self, limit=50, cursor=None, ingredient_id=None, types=None, staff=None, start=None, end=None):
+        """
+        Return one page of the merged history, newest first.
+        start is inclusive and end exclusive (ISO timestamps or dates).
+        Returns {'events': [...], 'next_cursor': str or None}
+        """
+        limit = max(1, min(int(limit), MAX_PAGE_SIZE))
+        after = decode_cursor(cursor) if cursor else None
+        selected = [t for t in EVENT_SOURCES if not types or t in types]
+        if staff:
+            # Order deductions have no staff member
+            selected = [t for t in selected if EVENT_SOURCES[t]['staff_column']]
+
+        conn = get_connection()
+        db_cursor = conn.cursor()
+        events = []
+        try:
+            for event_type in selected:
+                source = EVENT_SOURCES[event_type]
+                alias = source['alias']
+                where = []
+                params = []
+
+                if ingredient_id:
+                    where.append(f"{alias}.ingredient_id = ?")
+                    params.append(ingredient_id)
+                if staff:
+                    where.append(f"{source['staff_column']} = ?")
+                    params.append(staff)
+                if start:
+                    where.append(f"{alias}.timestamp >= ?")
+                    params.append(start)
+                if end:
+                    where.append(f"{alias}.timestamp < ?")
+                    params.append(end)
+
+                if after:
+                    after_ts, after_type, after_id = after
+                    after_rank = EVENT_SOURCES[after_type]['rank']
+                    if source['rank'] < after_rank:
+                        where.append(f"{alias}.timestamp <= ?")
+                        params.append(after_ts)
+                    elif source['rank'] > after_rank:
+                        where.append(f"{alias}.timestamp < ?")
+                        params.append(after_ts)
+                    else:
+                        # Row-value form, so the planner turns it into an index range
+                        where.append(f"({alias}.timestamp, {alias}.id) < (?, ?)")
+                        params.extend([after_ts, after_id])
+
+                query = source['sql']
+                if where:
+                    query += " WHERE " + " AND ".join(where)
+                # Fetch one extra row per source to know whether another page exists
+                query += f" ORDER BY {alias}.timestamp DESC, {alias}.id DESC LIMIT ?"
+                params.append(limit + 1)
+
+                db_cursor.execute(query, params)
+                events.extend(dict(row) for row in db_cursor.fetchall())
+        finally:
+            conn.close()
+
+        events.sort(key=lambda e: (e['timestamp'] or '', EVENT_SOURCES[e['type']]['rank'], e['id']), reverse=True)
+        page = events[:limit]
+        next_cursor = encode_cursor(page[-1]) if len(events) > limit else None
+        return {'events': page, 'next_cursor': next_cursor}
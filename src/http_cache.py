@@ -0,0 +1,101 @@
+"""
+HTTP Response Caching
+Versioned JSON payloads with ETags, and compression of large bodies with the
+compressed bytes cached per ETag so stable endpoints are only compressed once
+"""
+
+import collections
+import gzip
+import hashlib
+import json
+import threading
+from flask import request, current_app
+
+try:
+    import brotli
+except ImportError:  # optional; gzip is always available
+    brotli = None
+
+MIN_COMPRESS_SIZE = 1024
+COMPRESSIBLE_TYPES = {'application/json', 'text/html', 'text/css', 'text/csv', 'application/javascript'}
+MAX_COMPRESSED_ENTRIES = 32
+
+# slot -> (version, body bytes, etag)
+_payloads = {}
+_payloads_lock = threading.Lock()
+
+# (etag, encoding) -> compressed body, least recently used evicted first
+_compressed = collections.OrderedDict()
+_compressed_lock = threading.Lock()
+
+
+def versioned_json_response(slot, version, build):
+    """
+    Serve build()'s JSON for `slot`, serializing only when `version` changes.
+    Answers If-None-Match with 304.
+    """
+    cached = _payloads.get(slot)
+    if cached is None or cached[0] != version:
+        with _payloads_lock:
+            cached = _payloads.get(slot)
+            if cached is None or cached[0] != version:
+                body = json.dumps(build()).encode('utf-8')
+                cached = (version, body, hashlib.sha1(body).hexdigest())
+                _payloads[slot] = cached
+
+    response = current_app.response_class(cached[1], mimetype='application/json')
+    response.set_etag(cached[2])
+    response.cache_control.no_cache = True
+    return response.make_conditional(request)
+
+
+def _compress(body, encoding):
+    if encoding == 'br':
+        return brotli.compress(body, quality=5)
+    return gzip.compress(body, compresslevel=6)
+
+
+def compress_response(response):
+    """after_request hook: gzip/brotli large, non-streamed text responses"""
+    if (response.status_code != 200 or response.direct_passthrough or response.is_streamed
+            or 'Content-Encoding' in response.headers
+            or response.mimetype not in COMPRESSIBLE_TYPES):
+        return response
+
+    response.vary.add('Accept-Encoding')
+    offered = ['br', 'gzip'] if brotli else ['gzip']
+    encoding = request.accept_encodings.best_match(offered)
+    if not encoding:
+        return response
+
+    body = response.get_data()
+    if len(body) < MIN_COMPRESS_SIZE:
+        return response
+
+    etag, weak = response.get_etag()
+    key = (etag, encoding)
+    compressed = None
+    if etag:
+        with _compressed_lock:
+            compressed = _compressed.get(key)
+            if compressed is not None:
+                _compressed.move_to_end(key)
+
+    if compressed is None:
+        compressed = _compress(body, encoding)
+        if etag:
+            with _compressed_lock:
+                _compressed[key] = compressed
+                while len(_compressed) > MAX_COMPRESSED_ENTRIES:
+                    _compressed.popitem(last=False)
+
+    response.set_data(compressed)
+    response.headers['Content-Encoding'] = encoding
+    if etag and not weak:
+        # The bytes differ per encoding; a weak tag still revalidates (If-None-Match compares weakly)
+        response.set_etag(etag, weak=True)
+    return response
+
+
+def init_app(app):
+    app.after_request(compress_response)
@@ -3,22 +3,40 @@ Inventory Adjustment Management
 Handles Waste, Consumption, Corrections, and other manual stock changes
 """
 
+import math
 import os
-from datetime import datetime
+import threading
+from datetime import date, datetime, timedelta
 from src.database import get_connection
 from src.inventory_manager import InventoryManager
+from src.stock_mutations import fetch_ingredients, apply_stock_deltas
 from src.logger import Logger
 
+# Reason recorded on the adjustments a stocktake writes
+STOCK_COUNT_REASON = "Stock Count"
+
+# Longest span the waste summary covers
+MAX_SUMMARY_DAYS = 3660
+
+# Per-day waste aggregates for days before today, as of adjustment row `last_id`:
+# {'last_id': n, 'days': {'YYYY-MM-DD': [(ingredient_name, unit, reason, quantity, cost, count), ...]}}
+# Rows are only ever appended, so a day is dropped only when a newer row lands on it.
+_waste_day_cache = {'last_id': None, 'days': {}}
+_waste_day_cache_lock = threading.Lock()
+
 class AdjustmentManager:
     def __init__(self):
         self.inventory = InventoryManager()
         self.logger = Logger()
     
-    def load_adjustment_history(self):
-        """Load adjustment history from database"""
+    def load_adjustment_history(self, limit=None):
+        """Load adjustment history from database, newest first"""
         conn = get_connection()
         cursor = conn.cursor()
-        cursor.execute('SELECT * FROM inventory_adjustments ORDER BY timestamp DESC')
+        if limit is None:
+            cursor.execute('SELECT * FROM inventory_adjustments ORDER BY timestamp DESC, id DESC')
+        else:
+            cursor.execute('SELECT * FROM inventory_adjustments ORDER BY timestamp DESC, id DESC LIMIT ?', (int(limit),))
         rows = cursor.fetchall()
         conn.close()
         
@@ -26,35 +44,31 @@ class AdjustmentManager:
     
     def log_adjustment(self, ingredient_id, quantity, reason, adjustment_type="Deduction", staff_member="", notes=""):
         """Log an inventory adjustment to SQLite"""
-        ingredient = self.inventory.get_ingredient(ingredient_id)
-        
-        if not ingredient:
-            self.logger.error(f"Ingredient '{ingredient_id}' not found!")
-            return False
-        
         try:
             quantity = float(quantity)
         except ValueError:
             return False
-
-        # Get current stock
-        old_stock = float(ingredient['current_stock'])
         
-        # Calculate new stock
-        if adjustment_type == "Addition":
-            new_stock = old_stock + quantity
-        else:
-            new_stock = old_stock - quantity
-            
-        cost_per_unit = float(ingredient.get('cost_per_unit', 0))
-        total_cost = cost_per_unit * quantity
+        delta = quantity if adjustment_type == "Addition" else -quantity
         
         conn = get_connection()
         cursor = conn.cursor()
         
         try:
+            # Hold the write lock from the stock read through to the commit
+            cursor.execute('BEGIN IMMEDIATE')
+            
             # 1. Update ingredient stock
-            cursor.execute('UPDATE ingredients SET current_stock = ? WHERE id = ?', (float(new_stock), ingredient_id))
+            change = apply_stock_deltas(cursor, [(ingredient_id, delta)], 'adjustment', reference=reason)[0]
+            if not change:
+                conn.rollback()
+                self.logger.error(f"Ingredient '{ingredient_id}' not found!")
+                return False
+            
+            ingredient = change['ingredient']
+            old_stock, new_stock = change['old_stock'], change['new_stock']
+            cost_per_unit = float(ingredient.get('cost_per_unit') or 0)
+            total_cost = cost_per_unit * quantity
             
             # 2. Log event
             cursor.execute('''
@@ -92,44 +106,236 @@ class AdjustmentManager:
         finally:
             conn.close()
     
-    def get_adjustment_summary(self, days=30):
-        """Generate adjustment summary (primarily for waste/consumption)"""
-        from datetime import timedelta
-        cutoff_date = (datetime.now() - timedelta(days=days)).isoformat()
+    def apply_stock_count(self, counts, staff_member="", reason=STOCK_COUNT_REASON, notes=""):
+        """
+        Record a stocktake in a single transaction.
+        counts: iterable of (ingredient_id, counted_quantity), or None for an unreadable
+        line; an ingredient counted in several places is summed. The variance against current_stock is logged as an
+        Addition/Deduction per ingredient. If any line is invalid nothing is applied.
+        Returns {'success': bool, 'adjusted': n, 'unchanged': n, 'results': [...]}
+        """
+        results = []
+        counted = {}
+        first_line = {}
+        
+        for line_no, line in enumerate(counts, 1):
+            try:
+                ingredient_id, quantity = line
+            except (TypeError, ValueError):
+                results.append({'line': line_no, 'ingredient_id': None, 'status': 'error',
+                                'message': "Each line needs an ingredient_id and a counted quantity"})
+                continue
+            try:
+                quantity = float(quantity)
+            except (TypeError, ValueError):
+                results.append({'line': line_no, 'ingredient_id': ingredient_id, 'status': 'error',
+                                'message': "Counted quantity must be a number"})
+                continue
+            if not math.isfinite(quantity):
+                results.append({'line': line_no, 'ingredient_id': ingredient_id, 'status': 'error',
+                                'message': "Counted quantity must be a finite number"})
+                continue
+            if not ingredient_id or quantity < 0:
+                results.append({'line': line_no, 'ingredient_id': ingredient_id, 'status': 'error',
+                                'message': "Missing ingredient_id or negative count"})
+                continue
+            counted[ingredient_id] = counted.get(ingredient_id, 0.0) + quantity
+            first_line.setdefault(ingredient_id, line_no)
         
         conn = get_connection()
         cursor = conn.cursor()
-        cursor.execute('''
-            SELECT * FROM inventory_adjustments 
-            WHERE timestamp >= ? AND type = 'Deduction'
-        ''', (cutoff_date,))
-        events = [dict(row) for row in cursor.fetchall()]
-        conn.close()
         
-        summary_by_ingredient = {}
-        summary_by_reason = {}
-        total_cost = 0
-        
-        for event in events:
-            ing_name = event['ingredient_name']
-            if ing_name not in summary_by_ingredient:
-                summary_by_ingredient[ing_name] = {'quantity': 0, 'unit': event['unit'], 'cost': 0, 'count': 0}
+        try:
+            # Compare against stock read under the write lock, so no sale slips in between
+            cursor.execute('BEGIN IMMEDIATE')
+            ingredients = fetch_ingredients(cursor, counted.keys())
             
-            summary_by_ingredient[ing_name]['quantity'] += event['quantity']
-            summary_by_ingredient[ing_name]['cost'] += event['total_waste_cost']
-            summary_by_ingredient[ing_name]['count'] += 1
+            for ingredient_id in counted:
+                if ingredient_id not in ingredients:
+                    results.append({'line': first_line[ingredient_id], 'ingredient_id': ingredient_id, 'status': 'error',
+                                    'message': f"Ingredient '{ingredient_id}' not found"})
             
-            reason = event['reason']
-            if reason not in summary_by_reason:
-                summary_by_reason[reason] = {'count': 0, 'cost': 0}
-            summary_by_reason[reason]['count'] += 1
-            summary_by_reason[reason]['cost'] += event['total_waste_cost']
+            if not counted or results:
+                conn.rollback()
+                results.sort(key=lambda result: result['line'])
+                self.logger.error(f"Stock count rejected: {len(results)} invalid line(s)")
+                return {'success': False, 'adjusted': 0, 'unchanged': 0, 'results': results}
+            
+            deltas = []
+            for ingredient_id, quantity in counted.items():
+                variance = quantity - float(ingredients[ingredient_id]['current_stock'] or 0)
+                if abs(variance) < 1e-9:
+                    results.append({'ingredient_id': ingredient_id, 'status': 'unchanged', 'counted': quantity})
+                else:
+                    deltas.append((ingredient_id, variance))
+            
+            changes = apply_stock_deltas(cursor, deltas, 'count', reference=reason, ingredients=ingredients)
+            
+            timestamp = datetime.now().isoformat()
+            rows = []
+            for change in changes:
+                ingredient = change['ingredient']
+                variance = change['delta']
+                adjustment_type = "Addition" if variance > 0 else "Deduction"
+                cost_per_unit = float(ingredient.get('cost_per_unit') or 0)
+                total_cost = cost_per_unit * abs(variance)
+                rows.append((
+                    timestamp,
+                    ingredient['id'],
+                    ingredient['name'],
+                    abs(variance),
+                    adjustment_type,
+                    ingredient['unit'],
+                    reason,
+                    staff_member,
+                    notes,
+                    change['old_stock'],
+                    change['new_stock'],
+                    cost_per_unit,
+                    total_cost if adjustment_type == "Deduction" else -total_cost
+                ))
+                results.append({
+                    'ingredient_id': ingredient['id'],
+                    'status': 'adjusted',
+                    'counted': change['new_stock'],
+                    'variance': variance,
+                    'old_stock': change['old_stock'],
+                    'new_stock': change['new_stock']
+                })
+            
+            cursor.executemany('''
+                INSERT INTO inventory_adjustments (
+                    timestamp, ingredient_id, ingredient_name, quantity, type, unit,
+                    reason, staff_member, notes, old_stock, new_stock, cost_per_unit, total_waste_cost, movement_type
+                ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, 'count')
+            ''', rows)
             
-            total_cost += event['total_waste_cost']
+            conn.commit()
+        except Exception as e:
+            self.logger.error(f"Error applying stock count: {e}")
+            conn.rollback()
+            return {'success': False, 'adjusted': 0, 'unchanged': 0,
+                    'results': results + [{'status': 'error', 'message': str(e)}]}
+        finally:
+            conn.close()
         
+        self.logger.info(f"[STOCK COUNT] {len(counted)} item(s) counted, {len(rows)} adjusted - {reason}")
+        return {
+            'success': True,
+            'adjusted': len(rows),
+            'unchanged': len(counted) - len(rows),
+            'results': results
+        }
+    
+    def _waste_by_day(self, cursor, start_day, end_day):
+        """{day: [(ingredient_name, unit, reason, quantity, cost, count), ...]} for start_day <= day < end_day"""
+        cursor.execute('''
+            SELECT substr(timestamp, 1, 10) AS day, ingredient_name, unit, reason,
+                   SUM(quantity) AS quantity, COALESCE(SUM(total_waste_cost), 0) AS cost, COUNT(*) AS count
+            FROM inventory_adjustments
+            WHERE type = 'Deduction' AND movement_type = 'adjustment' AND timestamp >= ? AND timestamp < ?
+            GROUP BY day, ingredient_name, unit, reason
+        ''', (start_day, end_day))
+        days = {}
+        for row in cursor.fetchall():
+            days.setdefault(row['day'], []).append(
+                (row['ingredient_name'], row['unit'], row['reason'], row['quantity'], row['cost'], row['count'])
+            )
+        return days
+
+    def get_adjustment_summary(self, days=30, start=None, end=None):
+        """
+        Waste (deduction) summary by ingredient and by reason.
+        Covers the `days` calendar days ending today, or start (inclusive) to end (exclusive) as YYYY-MM-DD.
+        Past days are aggregated once and kept until a new adjustment lands on them; today
+        is always recomputed. Stock-count corrections are not waste and are left out, as in
+        the daily rollups.
+        """
+        days = int(days)
+        if not 0 < days <= MAX_SUMMARY_DAYS:
+            raise ValueError(f"days must be between 1 and {MAX_SUMMARY_DAYS}")
+        today = date.today()
+        end_day = date.fromisoformat(end[:10]) if end else today + timedelta(days=1)
+        try:
+            start_day = date.fromisoformat(start[:10]) if start else end_day - timedelta(days=days)
+        except OverflowError:
+            raise ValueError("start is out of range")
+        if start_day >= end_day:
+            raise ValueError("start must be before end")
+        if (end_day - start_day).days > MAX_SUMMARY_DAYS:
+            raise ValueError(f"The summary covers at most {MAX_SUMMARY_DAYS} days")
+
+        wanted = [(start_day + timedelta(days=i)).isoformat() for i in range((end_day - start_day).days)]
+        today_str = today.isoformat()
+        # Days from today on can still change, so they are never cached
+        past = [day for day in wanted if day < today_str]
+
+        partials = {}
+        conn = get_connection()
+        cursor = conn.cursor()
+        try:
+            # One read snapshot, so the cached days match last_id exactly
+            cursor.execute('BEGIN')
+            cursor.execute('SELECT COALESCE(MAX(id), 0) FROM inventory_adjustments')
+            last_id = cursor.fetchone()[0]
+            with _waste_day_cache_lock:
+                seen_id = _waste_day_cache['last_id']
+            if seen_id is None or last_id < seen_id:
+                # First use, or rows were removed
+                written = None
+            elif last_id > seen_id:
+                cursor.execute('SELECT DISTINCT substr(timestamp, 1, 10) FROM inventory_adjustments WHERE id > ? AND id <= ?',
+                               (seen_id, last_id))
+                written = [row[0] for row in cursor.fetchall()]
+            else:
+                written = []
+            with _waste_day_cache_lock:
+                # Another request may already have moved past this snapshot
+                if _waste_day_cache['last_id'] == seen_id:
+                    if written is None:
+                        _waste_day_cache['days'] = {}
+                    for day in written or []:
+                        _waste_day_cache['days'].pop(day, None)
+                    _waste_day_cache['last_id'] = last_id
+                current = _waste_day_cache['last_id'] == last_id
+                cached_days = dict(_waste_day_cache['days']) if current else {}
+            missing = [day for day in past if day not in cached_days]
+            if missing:
+                # One grouped scan over the uncached span; days without waste are cached as empty
+                found = self._waste_by_day(cursor, missing[0], (date.fromisoformat(missing[-1]) + timedelta(days=1)).isoformat())
+                for day in missing:
+                    cached_days[day] = found.get(day, [])
+                with _waste_day_cache_lock:
+                    if _waste_day_cache['last_id'] == last_id:
+                        _waste_day_cache['days'].update((day, cached_days[day]) for day in missing)
+            if wanted[-1] >= today_str:
+                partials.update(self._waste_by_day(cursor, max(wanted[0], today_str), end_day.isoformat()))
+        finally:
+            conn.close()
+        for day in past:
+            partials[day] = cached_days[day]
+
+        summary_by_ingredient = {}
+        summary_by_reason = {}
+        total_cost = 0
+        for rows in partials.values():
+            for ing_name, unit, reason, quantity, cost, count in rows:
+                ingredient = summary_by_ingredient.setdefault(ing_name, {'quantity': 0, 'unit': unit, 'cost': 0, 'count': 0})
+                ingredient['quantity'] += quantity
+                ingredient['cost'] += cost
+                ingredient['count'] += count
+
+                by_reason = summary_by_reason.setdefault(reason, {'count': 0, 'cost': 0})
+                by_reason['count'] += count
+                by_reason['cost'] += cost
+
+                total_cost += cost
+
         return {
             'by_ingredient': summary_by_ingredient,
             'by_reason': summary_by_reason,
             'total_cost': total_cost,
-            'period_days': days
+            'period_days': len(wanted),
+            'start': start_day.isoformat(),
+            'end': end_day.isoformat()
         }
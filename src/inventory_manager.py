@@ -1,7 +1,22 @@
 import sqlite3
 import os
+import threading
 from datetime import datetime
-from src.database import get_connection
+from src.database import get_connection, bump_version, get_version, IN_CLAUSE_CHUNK
+from src.stock_mutations import fetch_ingredients, apply_stock_deltas
+from src.logger import Logger
+from src.plate_costs import menu_items_using, refresh_menu_items, refresh_for_ingredients
+from src.units import compile_components, recompile_ingredients, load_units, rescale_pack_sizes
+
+# Process-wide copy of the ingredients table, shared by every InventoryManager
+# instance. Each read revalidates it against the 'ingredients' data version,
+# which every write path bumps in the same transaction as the change.
+_ingredient_cache = {'version': None, 'rows': [], 'by_id': {}}
+_ingredient_cache_lock = threading.Lock()
+
+# Same idea for recipe_components, keyed on the 'recipes' data version.
+_recipe_cache = {'version': None, 'recipes': {}}
+_recipe_cache_lock = threading.Lock()
 
 class InventoryManager:
     def __init__(self):
@@ -9,55 +24,72 @@ class InventoryManager:
         # but keep them for backward compatibility or reference if needed
         self.LOG_FILE = os.path.join('logs', 'inventory_log.txt')
 
-    def log(self, message):
-        timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-        entry = f"[{timestamp}] {message}"
-        print(entry)
-        if not os.path.exists('logs'):
-            os.makedirs('logs')
-        with open(self.LOG_FILE, 'a', encoding='utf-8') as f:
-            f.write(entry + "\n")
+    def log(self, message, level="INFO"):
+        Logger.log(message, level)
 
-    def get_all_stock(self):
-        """Return list of all ingredients"""
+    def _load_ingredients(self):
+        """Return the ingredient cache, reloading it only if the data version moved"""
         conn = get_connection()
         cursor = conn.cursor()
-        cursor.execute('SELECT * FROM ingredients ORDER BY name ASC')
-        rows = cursor.fetchall()
-        conn.close()
-        
-        # Convert to list of dicts with consistent key naming
-        ingredients = []
-        for row in rows:
-            ing = dict(row)
-            # Ensure both 'quantity' and 'current_stock' are available for compatibility
-            ing['quantity'] = ing['current_stock']
-            ingredients.append(ing)
-        return ingredients
+        try:
+            version = get_version(cursor, 'ingredients')
+            if version == _ingredient_cache['version']:
+                return _ingredient_cache
+            
+            with _ingredient_cache_lock:
+                if version == _ingredient_cache['version']:
+                    return _ingredient_cache
+                
+                cursor.execute('SELECT * FROM ingredients ORDER BY name ASC')
+                rows = []
+                for row in cursor.fetchall():
+                    ing = dict(row)
+                    # Ensure both 'quantity' and 'current_stock' are available for compatibility
+                    ing['quantity'] = ing['current_stock']
+                    rows.append(ing)
+                
+                _ingredient_cache['rows'] = rows
+                _ingredient_cache['by_id'] = {ing['id']: ing for ing in rows}
+                _ingredient_cache['version'] = version
+                return _ingredient_cache
+        finally:
+            conn.close()
+
+    def get_all_stock(self):
+        """Return list of all ingredients"""
+        return [dict(ing) for ing in self._load_ingredients()['rows']]
 
     def get_ingredient(self, ingredient_id):
         """Get single ingredient by ID"""
-        conn = get_connection()
-        cursor = conn.cursor()
-        cursor.execute('SELECT * FROM ingredients WHERE id = ?', (ingredient_id,))
-        row = cursor.fetchone()
-        conn.close()
-        
-        if row:
-            ing = dict(row)
-            ing['quantity'] = ing['current_stock']
-            return ing
-        return None
+        ing = self._load_ingredients()['by_id'].get(ingredient_id)
+        return dict(ing) if ing else None
+
+    def _set_stock_level(self, cursor, ingredient_id, new_quantity):
+        """Move stock to an absolute level as a ledgered 'manual' delta (inside BEGIN IMMEDIATE)"""
+        ingredients = fetch_ingredients(cursor, [ingredient_id])
+        if ingredient_id not in ingredients:
+            return False
+        delta = float(new_quantity) - float(ingredients[ingredient_id]['current_stock'] or 0)
+        if delta:
+            apply_stock_deltas(cursor, [(ingredient_id, delta)], 'manual',
+                               reference='Stock edited', ingredients=ingredients)
+        return True
 
     def update_stock(self, ingredient_id, new_quantity):
         """Update stock for a specific ingredient"""
         conn = get_connection()
         cursor = conn.cursor()
-        cursor.execute('UPDATE ingredients SET current_stock = ? WHERE id = ?', (float(new_quantity), ingredient_id))
-        success = cursor.rowcount > 0
-        conn.commit()
-        conn.close()
-        return success
+        try:
+            cursor.execute('BEGIN IMMEDIATE')
+            success = self._set_stock_level(cursor, ingredient_id, new_quantity)
+            conn.commit()
+            return success
+        except Exception as e:
+            self.log(f"Error updating stock for {ingredient_id}: {e}", "ERROR")
+            conn.rollback()
+            return False
+        finally:
+            conn.close()
         
     def add_ingredient(self, name, category, unit, cost_per_unit=0.0, threshold=5.0):
         """Add a new ingredient"""
@@ -82,6 +114,7 @@ class InventoryManager:
         INSERT INTO ingredients (id, name, category, unit, cost_per_unit, current_stock, threshold)
         VALUES (?, ?, ?, ?, ?, ?, ?)
         ''', (ing_id, name, category, unit, float(cost_per_unit), 0.0, float(threshold)))
+        bump_version(cursor, 'ingredients')
         
         conn.commit()
         
@@ -98,91 +131,317 @@ class InventoryManager:
         if not updates:
             return False
             
-        allowed_fields = ['name', 'category', 'unit', 'threshold', 'cost_per_unit', 'current_stock']
+        allowed_fields = ['name', 'category', 'unit', 'threshold', 'cost_per_unit']
         set_clauses = []
         values = []
         
         for key, value in updates.items():
+            # Blank numeric inputs from the edit form mean "leave unchanged"
+            if key in ('threshold', 'cost_per_unit') and value == '':
+                continue
             if key in allowed_fields:
                 set_clauses.append(f"{key} = ?")
                 values.append(value)
         
-        if not set_clauses:
+        # Stock edits go through the ledger rather than being overwritten in place
+        new_stock = updates.get('current_stock')
+        if new_stock == '':
+            new_stock = None
+        if not set_clauses and new_stock is None:
             return False
-            
-        values.append(ingredient_id)
-        query = f"UPDATE ingredients SET {', '.join(set_clauses)} WHERE id = ?"
         
         conn = get_connection()
         cursor = conn.cursor()
-        cursor.execute(query, values)
-        success = cursor.rowcount > 0
-        conn.commit()
-        conn.close()
-        return success
+        try:
+            cursor.execute('BEGIN IMMEDIATE')
+            success = True
+            if 'unit = ?' in set_clauses:
+                cursor.execute('SELECT unit FROM ingredients WHERE id = ?', (ingredient_id,))
+                row = cursor.fetchone()
+                if row:
+                    rescale_pack_sizes(cursor, ingredient_id, row['unit'], updates['unit'])
+            if set_clauses:
+                cursor.execute(f"UPDATE ingredients SET {', '.join(set_clauses)} WHERE id = ?", values + [ingredient_id])
+                success = cursor.rowcount > 0
+                if success:
+                    bump_version(cursor, 'ingredients')
+                    if 'cost_per_unit = ?' in set_clauses:
+                        refresh_for_ingredients(cursor, [ingredient_id])
+                    if 'unit = ?' in set_clauses:
+                        changed = recompile_ingredients(cursor, [ingredient_id])
+                        if changed:
+                            bump_version(cursor, 'recipes')
+                            refresh_menu_items(cursor, changed)
+            if success and new_stock is not None:
+                success = self._set_stock_level(cursor, ingredient_id, new_stock)
+            conn.commit()
+            return success
+        except ValueError:
+            # A stock unit that existing recipe units or pack sizes cannot convert to
+            conn.rollback()
+            raise
+        except Exception as e:
+            self.log(f"Error updating ingredient {ingredient_id}: {e}", "ERROR")
+            conn.rollback()
+            return False
+        finally:
+            conn.close()
 
-    def get_all_recipes(self):
-        """Get all recipes mapped by menu GUID"""
+    def _load_recipes(self):
+        """Return the recipe cache, reloading it only if the data version moved"""
         conn = get_connection()
         cursor = conn.cursor()
-        
-        # Get all menu items that have recipe components
-        cursor.execute('''
-            SELECT DISTINCT menu_item_guid 
-            FROM recipe_components
-        ''')
-        menu_guids = [row['menu_item_guid'] for row in cursor.fetchall()]
-        
-        all_recipes = {}
-        for guid in menu_guids:
-            cursor.execute('''
-                SELECT ingredient_id, quantity 
-                FROM recipe_components 
-                WHERE menu_item_guid = ?
-            ''', (guid,))
-            components = [dict(row) for row in cursor.fetchall()]
-            all_recipes[guid] = components
+        try:
+            version = get_version(cursor, 'recipes')
+            if version == _recipe_cache['version']:
+                return _recipe_cache
             
-        conn.close()
-        return all_recipes
+            with _recipe_cache_lock:
+                if version == _recipe_cache['version']:
+                    return _recipe_cache
+                
+                # One ordered scan, grouped in Python
+                cursor.execute('''
+                    SELECT menu_item_guid, ingredient_id, quantity, unit
+                    FROM recipe_components
+                    ORDER BY menu_item_guid, id
+                ''')
+                all_recipes = {}
+                for row in cursor.fetchall():
+                    all_recipes.setdefault(row['menu_item_guid'], []).append({
+                        'ingredient_id': row['ingredient_id'],
+                        'quantity': row['quantity'],
+                        'unit': row['unit']
+                    })
+                
+                _recipe_cache['recipes'] = all_recipes
+                _recipe_cache['version'] = version
+                return _recipe_cache
+        finally:
+            conn.close()
+
+    def get_all_recipes(self):
+        """Get all recipes mapped by menu GUID (shared cache, treat as read-only)"""
+        return self._load_recipes()['recipes']
+
+    def _write_recipes(self, cursor, recipes):
+        """
+        Bring the stored components of each menu item in `recipes` ({guid: compiled
+        components, see compile_components}) in line with it, touching only rows
+        that were added, changed or removed. Components are matched on
+        (ingredient_id, unit). Returns {guid: 'created' | 'updated' | 'unchanged'}.
+        """
+        guids = list(recipes)
+        existing = {}
+        for start in range(0, len(guids), IN_CLAUSE_CHUNK):
+            chunk = guids[start:start + IN_CLAUSE_CHUNK]
+            placeholders = ','.join('?' * len(chunk))
+            cursor.execute(f'''
+                SELECT id, menu_item_guid, ingredient_id, unit, quantity, conversion_factor
+                FROM recipe_components
+                WHERE menu_item_guid IN ({placeholders})
+                ORDER BY id
+            ''', chunk)
+            for row in cursor.fetchall():
+                existing.setdefault(row[1], {}).setdefault((row[2], row[3]), []).append(row)
+
+        inserts, updates, deletes = [], [], []
+        outcome = {}
+        for guid, components in recipes.items():
+            stored = existing.get(guid, {})
+            changes = len(inserts) + len(updates)
+            for ingredient_id, quantity, unit, factor, stock_quantity in components:
+                matches = stored.get((ingredient_id, unit))
+                if not matches:
+                    inserts.append((guid, ingredient_id, quantity, unit, factor, stock_quantity))
+                    continue
+                row = matches.pop(0)
+                if row[4] != quantity or row[5] != factor:
+                    updates.append((quantity, factor, stock_quantity, row[0]))
+            removed = [(row[0],) for rows in stored.values() for row in rows]
+            deletes.extend(removed)
+            if not stored:
+                outcome[guid] = 'created' if components else 'unchanged'
+            else:
+                outcome[guid] = 'updated' if removed or len(inserts) + len(updates) > changes else 'unchanged'
+
+        cursor.executemany('DELETE FROM recipe_components WHERE id = ?', deletes)
+        cursor.executemany('''
+            UPDATE recipe_components SET quantity = ?, conversion_factor = ?, stock_quantity = ?
+            WHERE id = ?
+        ''', updates)
+        cursor.executemany('''
+            INSERT INTO recipe_components (menu_item_guid, ingredient_id, quantity, unit, conversion_factor, stock_quantity)
+            VALUES (?, ?, ?, ?, ?, ?)
+        ''', inserts)
+        return outcome
+
+    def _commit_recipes(self, conn, cursor, recipes):
+        """
+        Write `recipes` and commit. When something changed, the 'recipes' version is
+        bumped and the process cache is patched for just those menu items instead of
+        being reloaded by the next reader. Returns the per-GUID outcome.
+        """
+        version = get_version(cursor, 'recipes')
+        outcome = self._write_recipes(cursor, recipes)
+        changed = [guid for guid, status in outcome.items() if status != 'unchanged']
+        if not changed:
+            conn.commit()
+            return outcome
+
+        bump_version(cursor, 'recipes')
+        refresh_menu_items(cursor, changed)
+        patched = {guid: [] for guid in changed}
+        for start in range(0, len(changed), IN_CLAUSE_CHUNK):
+            chunk = changed[start:start + IN_CLAUSE_CHUNK]
+            placeholders = ','.join('?' * len(chunk))
+            cursor.execute(f'''
+                SELECT menu_item_guid, ingredient_id, quantity, unit
+                FROM recipe_components
+                WHERE menu_item_guid IN ({placeholders})
+                ORDER BY menu_item_guid, id
+            ''', chunk)
+            for row in cursor.fetchall():
+                patched[row['menu_item_guid']].append({
+                    'ingredient_id': row['ingredient_id'],
+                    'quantity': row['quantity'],
+                    'unit': row['unit']
+                })
+        conn.commit()
+
+        with _recipe_cache_lock:
+            # Only valid if the cache held exactly the state this write started from
+            if _recipe_cache['version'] == version:
+                all_recipes = dict(_recipe_cache['recipes'])
+                for guid, components in patched.items():
+                    if components:
+                        all_recipes[guid] = components
+                    else:
+                        all_recipes.pop(guid, None)
+                _recipe_cache['recipes'] = all_recipes
+                _recipe_cache['version'] = version + 1
+        return outcome
 
     def update_recipe(self, menu_item_guid, ingredients_list):
         """
-        ingredients_list: [{"ingredient_id": "...", "quantity": 1.5}, ...]
+        ingredients_list: [{"ingredient_id": "...", "quantity": 1.5, "unit": "g"}, ...]
+        unit is optional (defaults to the ingredient's stock unit).
+        Only added, changed or removed components are written; saving an unchanged
+        recipe leaves the data version alone.
+        Raises ValueError if a unit cannot be converted to the ingredient's stock unit.
         """
         conn = get_connection()
         cursor = conn.cursor()
         
         try:
-            # Delete existing components
-            cursor.execute('DELETE FROM recipe_components WHERE menu_item_guid = ?', (menu_item_guid,))
-            
-            # Insert new components
-            for item in ingredients_list:
-                cursor.execute('''
-                    INSERT INTO recipe_components (menu_item_guid, ingredient_id, quantity)
-                    VALUES (?, ?, ?)
-                ''', (menu_item_guid, item['ingredient_id'], item['quantity']))
-            
-            conn.commit()
+            cursor.execute('BEGIN IMMEDIATE')
+            # Conversion factors are resolved once here, not on every sale
+            components = compile_components(cursor, ingredients_list)
+            self._commit_recipes(conn, cursor, {menu_item_guid: components})
             return True
+        except ValueError:
+            conn.rollback()
+            raise
         except Exception as e:
-            self.log(f"Error updating recipe: {e}")
+            self.log(f"Error updating recipe: {e}", "ERROR")
             conn.rollback()
             return False
         finally:
             conn.close()
 
+    def import_recipes(self, rows):
+        """
+        Bulk-load recipes in one transaction.
+        rows: iterable of (menu_item_guid, ingredient_id, quantity, unit); every menu item
+        named gets exactly the components listed for it, others are left alone. GUIDs and
+        ingredient ids are checked against the database; if any line is invalid nothing
+        is applied.
+        Returns {'success': bool, 'created': n, 'updated': n, 'unchanged': n, 'results': [...]}
+        """
+        lines = []
+        results = []
+        for line_no, line in enumerate(rows, 1):
+            try:
+                menu_item_guid, ingredient_id, quantity, unit = line
+                if any(isinstance(value, (list, dict)) for value in line) or not isinstance(unit, (str, type(None))):
+                    raise TypeError
+            except (TypeError, ValueError):
+                results.append({'line': line_no, 'menu_guid': None, 'ingredient_id': None, 'status': 'error',
+                                'message': "Each line needs a menu_guid, ingredient_id and quantity"})
+                continue
+            try:
+                quantity = float(quantity)
+            except (TypeError, ValueError):
+                results.append({'line': line_no, 'menu_guid': menu_item_guid, 'ingredient_id': ingredient_id,
+                                'status': 'error', 'message': "Quantity must be a number"})
+                continue
+            if not menu_item_guid or not ingredient_id or quantity < 0:
+                results.append({'line': line_no, 'menu_guid': menu_item_guid, 'ingredient_id': ingredient_id,
+                                'status': 'error', 'message': "Missing menu_guid/ingredient_id or negative quantity"})
+                continue
+            lines.append((line_no, menu_item_guid, {'ingredient_id': ingredient_id, 'quantity': quantity, 'unit': unit}))
+
+        conn = get_connection()
+        cursor = conn.cursor()
+        try:
+            cursor.execute('BEGIN IMMEDIATE')
+            guids = list(dict.fromkeys(guid for _, guid, _ in lines))
+            known_guids = set()
+            for start in range(0, len(guids), IN_CLAUSE_CHUNK):
+                chunk = guids[start:start + IN_CLAUSE_CHUNK]
+                placeholders = ','.join('?' * len(chunk))
+                cursor.execute(f'SELECT item_guid FROM menu_items WHERE item_guid IN ({placeholders})', chunk)
+                known_guids.update(row[0] for row in cursor.fetchall())
+            units = load_units(cursor, [item['ingredient_id'] for _, _, item in lines])
+
+            recipes = {}
+            for line_no, menu_item_guid, item in lines:
+                message = None
+                if menu_item_guid not in known_guids:
+                    message = f"Menu item '{menu_item_guid}' not found"
+                elif item['ingredient_id'] not in units:
+                    message = f"Ingredient '{item['ingredient_id']}' not found"
+                else:
+                    try:
+                        recipes.setdefault(menu_item_guid, []).extend(compile_components(cursor, [item], units))
+                    except ValueError as e:
+                        message = str(e)
+                if message:
+                    results.append({'line': line_no, 'menu_guid': menu_item_guid, 'ingredient_id': item['ingredient_id'],
+                                    'status': 'error', 'message': message})
+
+            if not lines or results:
+                conn.rollback()
+                results.sort(key=lambda result: result['line'])
+                self.log(f"Recipe import rejected: {len(results)} invalid line(s)", "ERROR")
+                return {'success': False, 'created': 0, 'updated': 0, 'unchanged': 0, 'results': results}
+
+            outcome = self._commit_recipes(conn, cursor, recipes)
+            counts = {status: 0 for status in ('created', 'updated', 'unchanged')}
+            for menu_item_guid, status in outcome.items():
+                counts[status] += 1
+                results.append({'menu_guid': menu_item_guid, 'status': status, 'components': len(recipes[menu_item_guid])})
+            self.log(f"Recipe import: {counts['created']} created, {counts['updated']} updated, {counts['unchanged']} unchanged")
+            return {'success': True, **counts, 'results': results}
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+
     def delete_recipe(self, menu_item_guid):
         conn = get_connection()
         cursor = conn.cursor()
         try:
             cursor.execute('DELETE FROM recipe_components WHERE menu_item_guid = ?', (menu_item_guid,))
             success = cursor.rowcount > 0
+            if success:
+                bump_version(cursor, 'recipes')
+                refresh_menu_items(cursor, [menu_item_guid])
             conn.commit()
             return success
         except Exception as e:
-            self.log(f"Error deleting recipe: {e}")
+            self.log(f"Error deleting recipe: {e}", "ERROR")
             conn.rollback()
             return False
         finally:
@@ -197,14 +456,21 @@ class InventoryManager:
         cursor = conn.cursor()
         try:
             # Remove from recipe components first to maintain integrity
+            affected = menu_items_using(cursor, [ingredient_id])
             cursor.execute('DELETE FROM recipe_components WHERE ingredient_id = ?', (ingredient_id,))
+            if cursor.rowcount > 0:
+                bump_version(cursor, 'recipes')
+                refresh_menu_items(cursor, affected)
+            cursor.execute('DELETE FROM ingredient_units WHERE ingredient_id = ?', (ingredient_id,))
             # Remove from ingredients
             cursor.execute('DELETE FROM ingredients WHERE id = ?', (ingredient_id,))
             success = cursor.rowcount > 0
+            if success:
+                bump_version(cursor, 'ingredients')
             conn.commit()
             return success
         except Exception as e:
-            self.log(f"Error deleting ingredient {ingredient_id}: {e}")
+            self.log(f"Error deleting ingredient {ingredient_id}: {e}", "ERROR")
             conn.rollback()
             return False
         finally:
@@ -0,0 +1,216 @@
+"""
+Live Stock Updates
+Fans stock changes out to Server-Sent Events clients. Every stock movement is
+already committed to stock_ledger, so each worker polls that table (one cheap
+indexed query per interval) and publishes compact per-ingredient deltas to its
+own in-process subscribers. This keeps all gunicorn workers in step. Low-stock
+alerts raised by those movements follow as 'alert' events. Each worker serves a
+bounded number of streams so open dashboards cannot take every request thread.
+"""
+
+import json
+import os
+import queue
+import threading
+import time
+from src.database import get_connection
+from src.logger import get_logger
+
+POLL_INTERVAL = 1.0          # seconds between change-log polls
+HEARTBEAT_INTERVAL = 15.0    # keep idle connections open through proxies
+STREAM_MAX_SECONDS = 300     # end streams periodically; EventSource reconnects with Last-Event-ID
+SUBSCRIBER_QUEUE_SIZE = 100
+POLL_BATCH_SIZE = 1000
+# Streams per worker (each holds a gthread thread); keep it below gunicorn's --threads
+MAX_STREAMS = int(os.environ.get('SSE_MAX_STREAMS', 4))
+BUSY_RETRY_MS = 30000        # how long a turned-away client waits before reconnecting
+HISTORY_MOVEMENTS = ('receipt', 'adjustment', 'count')   # shown in the dashboard's history lists
+MAX_MOVEMENTS = 20
+
+_logger = get_logger('live_updates')
+
+
+def fetch_changes(cursor, after_id, limit=POLL_BATCH_SIZE):
+    """
+    Ledger rows after `after_id`, compacted to one entry per ingredient, plus the most
+    recent receipts and adjustments so history views can be patched without a refetch.
+    Returns (last_id, [{'id', 'name', 'stock', 'delta', 'threshold'}, ...], movements).
+    """
+    cursor.execute('''
+        SELECT l.id, l.ingredient_id, l.delta, l.movement_type, l.reference, l.timestamp,
+               i.name, i.unit, i.current_stock, i.threshold
+        FROM stock_ledger l
+        LEFT JOIN ingredients i ON i.id = l.ingredient_id
+        WHERE l.id > ?
+        ORDER BY l.id
+        LIMIT ?
+    ''', (after_id, limit))
+    rows = cursor.fetchall()
+    if not rows:
+        return after_id, [], []
+
+    changes = {}
+    movements = []
+    for row in rows:
+        change = changes.setdefault(row['ingredient_id'], {
+            'id': row['ingredient_id'],
+            'name': row['name'],
+            'stock': row['current_stock'],
+            'threshold': row['threshold'],
+            'delta': 0.0
+        })
+        change['delta'] += row['delta']
+        if row['movement_type'] in HISTORY_MOVEMENTS:
+            movements.append({
+                'ingredient_id': row['ingredient_id'],
+                'ingredient_name': row['name'],
+                'unit': row['unit'],
+                'delta': row['delta'],
+                'type': row['movement_type'],
+                'reference': row['reference'],
+                'timestamp': row['timestamp']
+            })
+    return rows[-1]['id'], list(changes.values()), movements[-MAX_MOVEMENTS:]
+
+
+def fetch_alerts(cursor, after_id, last_id):
+    """Alerts raised by the ledger rows in (after_id, last_id]"""
+    cursor.execute('''
+        SELECT id, timestamp, ingredient_id, ingredient_name, unit, state, previous_state, stock, threshold
+        FROM stock_alerts
+        WHERE ledger_id > ? AND ledger_id <= ?
+        ORDER BY id
+    ''', (after_id, last_id))
+    return [dict(row) for row in cursor.fetchall()]
+
+
+def format_event(event_type, event_id, payload):
+    return f"id: {event_id}\nevent: {event_type}\ndata: {json.dumps(payload)}\n\n"
+
+
+class StockBroker:
+    """In-process pub/sub fed by a background thread polling stock_ledger"""
+
+    def __init__(self):
+        self._subscribers = set()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._last_id = None
+
+    def subscribe(self):
+        """A new subscriber queue, or None when this worker already serves MAX_STREAMS"""
+        q = queue.Queue(maxsize=SUBSCRIBER_QUEUE_SIZE)
+        with self._lock:
+            if len(self._subscribers) >= MAX_STREAMS:
+                return None
+            self._subscribers.add(q)
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._poll_loop, name="stock-broker", daemon=True)
+                self._thread.start()
+        return q
+
+    def unsubscribe(self, q):
+        with self._lock:
+            self._subscribers.discard(q)
+
+    def publish(self, event_type, from_id, event_id, payload):
+        """Publish changes covering ledger ids (from_id, event_id]"""
+        message = (event_type, from_id, event_id, payload)
+        with self._lock:
+            subscribers = list(self._subscribers)
+        for q in subscribers:
+            try:
+                q.put_nowait(message)
+            except queue.Full:
+                # A stalled client drops events; it catches up via Last-Event-ID on reconnect
+                pass
+
+    def _poll_loop(self):
+        while True:
+            with self._lock:
+                if not self._subscribers:
+                    self._thread = None
+                    self._last_id = None
+                    return
+            try:
+                conn = get_connection()
+                try:
+                    cursor = conn.cursor()
+                    if self._last_id is None:
+                        cursor.execute('SELECT COALESCE(MAX(id), 0) FROM stock_ledger')
+                        self._last_id = cursor.fetchone()[0]
+                    last_id, changes, movements = fetch_changes(cursor, self._last_id)
+                    alerts = fetch_alerts(cursor, self._last_id, last_id) if changes else []
+                finally:
+                    conn.close()
+                if changes:
+                    from_id, self._last_id = self._last_id, last_id
+                    self.publish('stock', from_id, last_id,
+                                 {'changes': changes, 'movements': movements, 'alerts': alerts})
+            except Exception as e:
+                _logger.warning(f"Live update poll failed: {e}")
+            time.sleep(POLL_INTERVAL)
+
+
+broker = StockBroker()
+
+
+def read_changes(after_id=None, limit=100000):
+    """
+    Changes (and the alerts they raised) since `after_id` straight from the database
+    (None means 'from now on'). Returns (last_id, {'changes', 'movements', 'alerts'}).
+    """
+    conn = get_connection()
+    try:
+        cursor = conn.cursor()
+        if after_id is None:
+            cursor.execute('SELECT COALESCE(MAX(id), 0) FROM stock_ledger')
+            return cursor.fetchone()[0], {'changes': [], 'movements': [], 'alerts': []}
+        last_id, changes, movements = fetch_changes(cursor, after_id, limit=limit)
+        return last_id, {'changes': changes, 'movements': movements,
+                         'alerts': fetch_alerts(cursor, after_id, last_id) if changes else []}
+    finally:
+        conn.close()
+
+
+def format_payload(event_id, payload):
+    """A 'stock' event, followed by an 'alert' event when the changes crossed a threshold"""
+    message = format_event('stock', event_id, {'changes': payload['changes'], 'movements': payload.get('movements', [])})
+    if payload.get('alerts'):
+        message += format_event('alert', event_id, {'alerts': payload['alerts']})
+    return message
+
+
+def stream_events(last_event_id=None):
+    """
+    Generate an SSE stream. With a last_event_id the client first receives everything
+    it missed (compacted), then live events. When the worker is at MAX_STREAMS the
+    client is told to come back later and the thread is released straight away.
+    """
+    q = broker.subscribe()
+    if q is None:
+        yield f"retry: {BUSY_RETRY_MS}\n"
+        yield "event: busy\ndata: {}\n\n"
+        return
+    try:
+        sent_id, backlog = read_changes(int(last_event_id) if last_event_id is not None else None)
+
+        yield "retry: 3000\n"
+        yield format_payload(sent_id, backlog)
+
+        started = time.monotonic()
+        while time.monotonic() - started < STREAM_MAX_SECONDS:
+            try:
+                event_type, from_id, event_id, payload = q.get(timeout=HEARTBEAT_INTERVAL)
+            except queue.Empty:
+                yield ": keep-alive\n\n"
+                continue
+            if event_id <= sent_id:
+                continue
+            if from_id > sent_id:
+                # Gap between what we sent and this event (dropped or raced); re-read from the ledger
+                event_id, payload = read_changes(sent_id)
+            sent_id = event_id
+            yield format_payload(event_id, payload)
+    finally:
+        broker.unsubscribe(q)
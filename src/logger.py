@@ -1,46 +1,225 @@
 """
 Logging utility
+One queue-backed logger for the whole app: callers only enqueue, and a background
+thread writes batches as JSON lines to a size/day-rotated file plus the console.
+Worker processes share the file and coordinate its rotation with a lock file.
 """
 
-from datetime import datetime
+from datetime import date, datetime
+import atexit
+import json
+import logging
+import logging.handlers
 import os
-from .config import LOG_FILE
+import queue
+import random
+import sys
+import threading
+try:
+    import fcntl
+except ImportError:  # Windows: single-process development server only
+    fcntl = None
+from .config import LOG_FILE, LOG_MAX_BYTES, LOG_BACKUP_COUNT, LOG_LEVEL, LOG_SAMPLE_RATES
 
+ROOT_LOGGER = 'inventory'
+MAX_BATCH = 500
 
-class Logger:
-    @staticmethod
-    def log(message, level="INFO"):
-        timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-        log_entry = f"[{timestamp}] [{level}] {message}"
-        
-        print(log_entry)
-        
+_queue = None
+_writer = None
+_writer_pid = None
+_setup_lock = threading.Lock()
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line; extra={'fields': {...}} adds structured fields"""
+    def format(self, record):
+        entry = {
+            'ts': datetime.fromtimestamp(record.created).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'pid': record.process,
+            'message': record.getMessage()
+        }
+        entry.update(getattr(record, 'fields', None) or {})
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class ConsoleFormatter(logging.Formatter):
+    def format(self, record):
+        timestamp = datetime.fromtimestamp(record.created).strftime('%Y-%m-%d %H:%M:%S')
+        entry = f"[{timestamp}] [{record.levelname}] {record.getMessage()}"
+        if record.exc_info:
+            entry += "\n" + self.formatException(record.exc_info)
+        return entry
+
+
+class SamplingFilter(logging.Filter):
+    """Keep a fraction of records per level (LOG_SAMPLE_RATES); warnings and above are always kept"""
+    def filter(self, record):
+        if record.levelno >= logging.WARNING:
+            return True
+        rate = LOG_SAMPLE_RATES.get(record.levelname, 1.0)
+        return rate >= 1.0 or random.random() < rate
+
+
+class BatchRotatingFileHandler(logging.handlers.RotatingFileHandler):
+    """
+    Rotates on size or at the first write of a new day; writes a whole batch with one flush.
+    Every gunicorn worker appends to the same file, so each batch is written under an
+    exclusive lock on <file>.lock: only the first worker to see the file due rotates it,
+    and the others notice the rename (a different inode at the path) and reopen.
+    """
+    def __init__(self, filename, max_bytes, backup_count):
+        super().__init__(filename, maxBytes=max_bytes, backupCount=backup_count, encoding='utf-8', delay=True)
+        self.lock_path = self.baseFilename + '.lock'
+
+    def _reopen_if_rotated(self):
+        if self.stream is None:
+            return
+        try:
+            current = os.stat(self.baseFilename)
+            opened = os.fstat(self.stream.fileno())
+            if (current.st_dev, current.st_ino) == (opened.st_dev, opened.st_ino):
+                return
+        except FileNotFoundError:
+            pass
+        self.stream.close()
+        self.stream = None
+
+    def shouldRollover(self, record):
+        # Judged from the shared file, not per-process state, so one worker rotates once
+        try:
+            if date.fromtimestamp(os.path.getmtime(self.baseFilename)) < date.today():
+                return True
+        except OSError:
+            return False
+        return super().shouldRollover(record)
+
+    def emit_batch(self, records):
+        self.acquire()
+        try:
+            with open(self.lock_path, 'a') as lock_file:
+                if fcntl is not None:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX)
+                self._reopen_if_rotated()
+                for record in records:
+                    try:
+                        if self.shouldRollover(record):
+                            self.doRollover()
+                        if self.stream is None:
+                            self.stream = self._open()
+                        self.stream.write(self.format(record) + self.terminator)
+                    except Exception:
+                        self.handleError(record)
+                if self.stream:
+                    self.stream.flush()
+        finally:
+            self.release()
+
+
+class _BatchWriter(threading.Thread):
+    """Drains the queue, handing each batch to the file and console handlers"""
+    def __init__(self, record_queue):
+        super().__init__(name="log-writer", daemon=True)
+        self.queue = record_queue
+        self.file_handler = BatchRotatingFileHandler(LOG_FILE, LOG_MAX_BYTES, LOG_BACKUP_COUNT)
+        self.file_handler.setFormatter(JsonFormatter())
+        self.console_formatter = ConsoleFormatter()
+
+    def run(self):
+        stopping = False
+        while not stopping:
+            batch = [self.queue.get()]
+            while len(batch) < MAX_BATCH:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            if None in batch:
+                stopping = True
+                batch = [record for record in batch if record is not None]
+            self._write(batch)
+
+    def _write(self, batch):
+        if not batch:
+            return
+        lines = []
+        for record in batch:
+            try:
+                lines.append(self.console_formatter.format(record))
+            except Exception:
+                pass
+        try:
+            print("\n".join(lines), file=sys.stdout, flush=True)
+        except Exception:
+            pass  # specific environment might have issues with stdout
         try:
-            # Ensure log directory exists
-            log_dir = os.path.dirname(LOG_FILE)
-            if not os.path.exists(log_dir):
-                os.makedirs(log_dir)
-            
-            with open(LOG_FILE, 'a') as f:
-                f.write(log_entry + "\n")
+            os.makedirs(os.path.dirname(LOG_FILE), exist_ok=True)
+            self.file_handler.emit_batch(batch)
         except Exception as e:
             print(f"Failed to write log: {e}")
-    
+
+
+def _stop_writer():
+    writer = _writer
+    if writer is not None and writer.is_alive() and _writer_pid == os.getpid():
+        _queue.put(None)
+        writer.join(timeout=2)
+
+
+def _setup():
+    """Attach the queue handler once per process (again after a fork, which loses the thread)"""
+    global _queue, _writer, _writer_pid
+    if _writer_pid == os.getpid():
+        return
+    with _setup_lock:
+        if _writer_pid == os.getpid():
+            return
+        root = logging.getLogger(ROOT_LOGGER)
+        for handler in list(root.handlers):
+            root.removeHandler(handler)
+        _queue = queue.SimpleQueue()
+        handler = logging.handlers.QueueHandler(_queue)
+        handler.addFilter(SamplingFilter())
+        root.addHandler(handler)
+        root.setLevel(LOG_LEVEL)
+        root.propagate = False
+        _writer = _BatchWriter(_queue)
+        _writer.start()
+        if _writer_pid is None:
+            atexit.register(_stop_writer)
+        _writer_pid = os.getpid()
+
+
+def get_logger(name=None):
+    """Logger under the shared 'inventory' hierarchy, e.g. get_logger('toast')"""
+    _setup()
+    return logging.getLogger(f"{ROOT_LOGGER}.{name}" if name else ROOT_LOGGER)
+
+
+class Logger:
+    @staticmethod
+    def log(message, level="INFO"):
+        levelno = logging.getLevelName(level)
+        get_logger().log(levelno if isinstance(levelno, int) else logging.INFO, message)
+
     @staticmethod
     def info(message):
         Logger.log(message, "INFO")
-    
+
     @staticmethod
     def warning(message):
         Logger.log(message, "WARNING")
-    
+
     @staticmethod
     def error(message):
         Logger.log(message, "ERROR")
-    
+
     @staticmethod
     def section(title):
         separator = "=" * 70
         Logger.log(separator)
         Logger.log(title)
-        Logger.log(separator)
\ No newline at end of file
+        Logger.log(separator)
@@ -0,0 +1,280 @@
+"""
+Request Metrics
+Per-endpoint latency histograms, status codes, in-flight requests, SQLite query
+and Toast API call counters, exposed in Prometheus text format. Each gunicorn
+worker writes its own totals to logs/metrics/<pid>.json about once a second and
+/metrics sums every live worker's file; files left by exited workers are removed.
+"""
+
+import glob
+import json
+import os
+import threading
+import time
+from flask import g, request
+from src.config import LOG_DIR
+from src.database import add_query_hook
+from src.logger import get_logger
+
+METRICS_DIR = os.path.join(LOG_DIR, 'metrics')
+FLUSH_INTERVAL = 1.0
+# A worker file not rewritten for this long belongs to a stuck worker: its gauges
+# are left out of the totals
+GAUGE_STALE_SECONDS = 30
+HEARTBEAT_SECONDS = 10
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+METRICS = {
+    'http_requests_total': ('counter', 'HTTP requests by endpoint, method and status'),
+    'http_request_duration_seconds': ('histogram', 'Time to produce a response, by endpoint and method'),
+    'http_requests_in_flight': ('gauge', 'Requests currently being handled'),
+    'sqlite_queries_total': ('counter', 'SQLite statements executed'),
+    'sqlite_query_seconds_total': ('counter', 'Time spent executing SQLite statements'),
+    'toast_api_calls_total': ('counter', 'Toast API calls by endpoint and status'),
+    'toast_api_call_seconds_total': ('counter', 'Time spent waiting on the Toast API, by endpoint'),
+}
+
+_logger = get_logger('metrics')
+_lock = threading.Lock()
+_state = None
+_state_pid = None
+_dirty = False
+_last_flush = 0.0
+
+
+def _new_state():
+    return {'counter': {}, 'histogram': {}, 'gauge': {}}
+
+
+def _labels(**labels):
+    """Rendered Prometheus label set, used as the series key"""
+    return ','.join('{}="{}"'.format(key, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                    for key, value in labels.items())
+
+
+def _current_state():
+    """This process's state; reset after a fork so workers do not inherit the master's counts"""
+    global _state, _state_pid
+    pid = os.getpid()
+    if _state_pid != pid:
+        _state = _new_state()
+        _state_pid = pid
+        threading.Thread(target=_flush_loop, name="metrics-flush", daemon=True).start()
+    return _state
+
+
+def inc(name, labels='', value=1.0):
+    global _dirty
+    with _lock:
+        series = _current_state()['counter'].setdefault(name, {})
+        series[labels] = series.get(labels, 0.0) + value
+        _dirty = True
+
+
+def add_gauge(name, labels='', value=1.0):
+    global _dirty
+    with _lock:
+        series = _current_state()['gauge'].setdefault(name, {})
+        series[labels] = series.get(labels, 0.0) + value
+        _dirty = True
+
+
+def observe(name, labels, seconds):
+    global _dirty
+    with _lock:
+        series = _current_state()['histogram'].setdefault(name, {})
+        # [count per bucket..., +Inf count, sum]
+        values = series.setdefault(labels, [0] * (len(LATENCY_BUCKETS) + 1) + [0.0])
+        for i, bound in enumerate(LATENCY_BUCKETS):
+            if seconds <= bound:
+                values[i] += 1
+        values[len(LATENCY_BUCKETS)] += 1
+        values[-1] += seconds
+        _dirty = True
+
+
+def observe_toast_call(endpoint, status, seconds):
+    inc('toast_api_calls_total', _labels(endpoint=endpoint, status=status))
+    inc('toast_api_call_seconds_total', _labels(endpoint=endpoint), seconds)
+
+
+def _observe_query(sql, seconds):
+    inc('sqlite_queries_total')
+    inc('sqlite_query_seconds_total', value=seconds)
+
+
+def _snapshot():
+    with _lock:
+        return json.loads(json.dumps(_current_state()))
+
+
+def flush():
+    """Write this worker's totals to its file (atomically, so readers never see half a file)"""
+    global _dirty, _last_flush
+    _dirty = False
+    _last_flush = time.monotonic()
+    data = _snapshot()
+    os.makedirs(METRICS_DIR, exist_ok=True)
+    path = os.path.join(METRICS_DIR, f"{os.getpid()}.json")
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(data, f)
+    os.replace(tmp_path, path)
+
+
+def _flush_loop():
+    pid = os.getpid()
+    while _state_pid == pid:
+        time.sleep(FLUSH_INTERVAL)
+        if _dirty or time.monotonic() - _last_flush >= HEARTBEAT_SECONDS:
+            try:
+                flush()
+            except Exception as e:
+                _logger.warning(f"Failed to write metrics: {e}")
+
+
+def _merge(total, data, include_gauges):
+    for kind in ('counter', 'gauge'):
+        if kind == 'gauge' and not include_gauges:
+            continue
+        for name, series in data.get(kind, {}).items():
+            merged = total[kind].setdefault(name, {})
+            for labels, value in series.items():
+                merged[labels] = merged.get(labels, 0.0) + value
+    for name, series in data.get('histogram', {}).items():
+        merged = total['histogram'].setdefault(name, {})
+        for labels, values in series.items():
+            if labels in merged:
+                merged[labels] = [a + b for a, b in zip(merged[labels], values)]
+            else:
+                merged[labels] = list(values)
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass  # exists, owned by another user
+    return True
+
+
+def collect():
+    """
+    Sum every live worker's totals; this worker's live state replaces its own
+    (possibly stale) file. Files of workers that have exited are deleted, so a
+    restarted worker's counters are not summed forever (Prometheus treats the
+    drop as a counter reset).
+    """
+    total = _new_state()
+    own_file = os.path.join(METRICS_DIR, f"{os.getpid()}.json")
+    now = time.time()
+    for path in glob.glob(os.path.join(METRICS_DIR, '*.json')):
+        if os.path.abspath(path) == os.path.abspath(own_file):
+            continue
+        name = os.path.basename(path)[:-len('.json')]
+        if name.isdigit() and not _pid_alive(int(name)):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            continue
+        try:
+            with open(path, encoding='utf-8') as f:
+                data = json.load(f)
+            fresh = now - os.path.getmtime(path) < GAUGE_STALE_SECONDS
+        except (OSError, ValueError):
+            continue
+        _merge(total, data, include_gauges=fresh)
+    _merge(total, _snapshot(), include_gauges=True)
+    return total
+
+
+def _format_value(value):
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+def _series_name(name, labels, suffix=''):
+    return f"{name}{suffix}{{{labels}}}" if labels else f"{name}{suffix}"
+
+
+def render():
+    """Prometheus text exposition of the aggregated metrics"""
+    total = collect()
+    lines = []
+    for name, (kind, help_text) in METRICS.items():
+        series = total[kind].get(name, {})
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {kind}")
+        for labels in sorted(series):
+            value = series[labels]
+            if kind != 'histogram':
+                lines.append(f"{_series_name(name, labels)} {_format_value(value)}")
+                continue
+            prefix = labels + ',' if labels else ''
+            for bound, count in zip(LATENCY_BUCKETS, value):
+                lines.append(f'{name}_bucket{{{prefix}le="{bound:g}"}} {count}')
+            lines.append(f'{name}_bucket{{{prefix}le="+Inf"}} {value[len(LATENCY_BUCKETS)]}')
+            lines.append(f"{_series_name(name, labels, '_sum')} {_format_value(value[-1])}")
+            lines.append(f"{_series_name(name, labels, '_count')} {value[len(LATENCY_BUCKETS)]}")
+    return "\n".join(lines) + "\n"
+
+
+def _before_request():
+    g._metrics_started = time.perf_counter()
+    g._metrics_in_flight = True
+    add_gauge('http_requests_in_flight')
+
+
+def _after_request(response):
+    started = g.pop('_metrics_started', None)
+    if started is not None:
+        endpoint = request.endpoint or 'unmatched'
+        observe('http_request_duration_seconds', _labels(endpoint=endpoint, method=request.method),
+                time.perf_counter() - started)
+        inc('http_requests_total', _labels(endpoint=endpoint, method=request.method, status=response.status_code))
+        g._metrics_counted = True
+    return response
+
+
+def _teardown_request(exc):
+    if not g.pop('_metrics_in_flight', False):
+        return
+    add_gauge('http_requests_in_flight', value=-1.0)
+    if not g.pop('_metrics_counted', False):
+        # Unhandled exception: after_request never ran
+        endpoint = request.endpoint or 'unmatched'
+        inc('http_requests_total', _labels(endpoint=endpoint, method=request.method, status=500))
+
+
+class TrackedStream:
+    """
+    Wraps a streamed response body so it counts as in flight until the server closes
+    it, not just until the view returns (teardown runs before the body is sent)
+    """
+
+    def __init__(self, body):
+        self._body = iter(body)
+        self._tracked = g.pop('_metrics_in_flight', False)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return next(self._body)
+
+    def close(self):
+        if hasattr(self._body, 'close'):
+            self._body.close()
+        if self._tracked:
+            self._tracked = False
+            add_gauge('http_requests_in_flight', value=-1.0)
+
+
+def init_app(app):
+    add_query_hook(_observe_query)
+    app.before_request(_before_request)
+    app.after_request(_after_request)
+    app.teardown_request(_teardown_request)
@@ -0,0 +1,184 @@
+"""
+Order Queries
+Keyset-paginated order listing and constant-memory exports of orders with
+their items and inventory deductions
+"""
+
+import base64
+import binascii
+import csv
+import io
+import json
+from src.database import get_connection
+
+ORDER_COLUMNS = 'id, toast_guid, order_number, opened_date, closed_date, total_amount, tax_amount, tip_amount, payment_status, source, deleted'
+MAX_PAGE_SIZE = 200
+EXPORT_BATCH_SIZE = 500
+
+
+def encode_cursor(order):
+    raw = json.dumps([order['closed_date'], order['id']])
+    return base64.urlsafe_b64encode(raw.encode('utf-8')).decode('ascii')
+
+
+def decode_cursor(cursor_str):
+    """Raises ValueError for anything encode_cursor could not have produced"""
+    try:
+        closed_date, order_id = json.loads(base64.urlsafe_b64decode(cursor_str.encode('ascii')))
+        # NULL closed dates are the tail range
+        if closed_date is not None and not isinstance(closed_date, str):
+            raise ValueError(f"bad closed_date {closed_date!r}")
+        return closed_date, int(order_id)
+    except (TypeError, ValueError, binascii.Error, UnicodeError) as e:
+        raise ValueError(f"malformed cursor ({e})")
+
+
+class OrderManager:
+    def _page_query(self, after=None, tail=False, start=None, end=None, source=None, payment_status=None):
+        """
+        Build the WHERE clause for one newest-first range (closed_date DESC, id DESC).
+        Dated orders and the NULL closed_date tail that sorts after them are separate
+        ranges, so each bound stays an index range instead of an OR over the whole index.
+        """
+        where = []
+        params = []
+        if start:
+            where.append("closed_date >= ?")
+            params.append(start)
+        if end:
+            where.append("closed_date < ?")
+            params.append(end)
+        if source:
+            where.append("source = ?")
+            params.append(source)
+        if payment_status:
+            where.append("payment_status = ?")
+            params.append(payment_status)
+        if tail:
+            where.append("closed_date IS NULL")
+            if after and after[0] is None:
+                where.append("id < ?")
+                params.append(after[1])
+        elif after:
+            where.append("(closed_date, id) < (?, ?)")
+            params.extend(after)
+        else:
+            where.append("closed_date IS NOT NULL")
+        clause = " WHERE " + " AND ".join(where)
+        return clause, params
+
+    def _fetch_page(self, cursor, limit, after=None, **filters):
+        rows = []
+        ranges = []
+        if not after or after[0] is not None:
+            ranges.append(False)
+        # A date filter already excludes orders that never closed
+        if not filters.get('start') and not filters.get('end'):
+            ranges.append(True)
+        for tail in ranges:
+            clause, params = self._page_query(after=after, tail=tail, **filters)
+            cursor.execute(f'''
+                SELECT {ORDER_COLUMNS}
+                FROM orders{clause}
+                ORDER BY closed_date DESC, id DESC
+                LIMIT ?
+            ''', params + [limit - len(rows)])
+            rows.extend(dict(row) for row in cursor.fetchall())
+            if len(rows) >= limit:
+                break
+        return rows
+
+    def list_orders(self, limit=50, cursor=None, start=None, end=None, source=None, payment_status=None):
+        """
+        One page of orders, newest closed first.
+        start is inclusive and end exclusive (compared against closed_date).
+        Returns {'orders': [...], 'next_cursor': str or None}
+        """
+        limit = max(1, min(int(limit), MAX_PAGE_SIZE))
+        after = decode_cursor(cursor) if cursor else None
+        conn = get_connection()
+        try:
+            rows = self._fetch_page(conn.cursor(), limit + 1, after=after, start=start, end=end,
+                                    source=source, payment_status=payment_status)
+        finally:
+            conn.close()
+        page = rows[:limit]
+        return {'orders': page, 'next_cursor': encode_cursor(page[-1]) if len(rows) > limit else None}
+
+    def iter_orders_with_details(self, **filters):
+        """Yield orders (with 'items' and 'deductions') batch by batch, holding one batch in memory"""
+        conn = get_connection()
+        cursor = conn.cursor()
+        try:
+            after = None
+            while True:
+                orders = self._fetch_page(cursor, EXPORT_BATCH_SIZE, after=after, **filters)
+                if not orders:
+                    break
+                after = (orders[-1]['closed_date'], orders[-1]['id'])
+
+                by_id = {order['id']: order for order in orders}
+                for order in orders:
+                    order['items'] = []
+                    order['deductions'] = []
+                placeholders = ','.join('?' * len(by_id))
+                ids = list(by_id)
+
+                cursor.execute(f'''
+                    SELECT id, order_id, menu_item_guid, menu_item_name, quantity, unit_price, total_price
+                    FROM order_items WHERE order_id IN ({placeholders})
+                    ORDER BY order_id, id
+                ''', ids)
+                for row in cursor.fetchall():
+                    by_id[row['order_id']]['items'].append(dict(row))
+
+                cursor.execute(f'''
+                    SELECT od.order_id, od.order_item_id, od.ingredient_id, i.name AS ingredient_name,
+                           od.quantity_deducted, i.unit
+                    FROM order_deductions od
+                    LEFT JOIN ingredients i ON i.id = od.ingredient_id
+                    WHERE od.order_id IN ({placeholders})
+                    ORDER BY od.order_id, od.id
+                ''', ids)
+                for row in cursor.fetchall():
+                    by_id[row['order_id']]['deductions'].append(dict(row))
+
+                yield from orders
+                if len(orders) < EXPORT_BATCH_SIZE:
+                    break
+        finally:
+            conn.close()
+
+    def export_ndjson(self, **filters):
+        """Generate NDJSON lines, one order per line"""
+        for order in self.iter_orders_with_details(**filters):
+            yield json.dumps(order) + "\n"
+
+    def export_csv(self, **filters):
+        """Generate CSV text, one row per order item (deductions as a JSON column)"""
+        columns = ['order_id', 'toast_guid', 'order_number', 'closed_date', 'total_amount', 'payment_status',
+                   'source', 'menu_item_guid', 'menu_item_name', 'quantity', 'unit_price', 'total_price', 'deductions']
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(columns)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate(0)
+
+        for order in self.iter_orders_with_details(**filters):
+            deductions_by_item = {}
+            for deduction in order['deductions']:
+                deductions_by_item.setdefault(deduction['order_item_id'], []).append(
+                    {'ingredient_id': deduction['ingredient_id'], 'quantity': deduction['quantity_deducted']}
+                )
+            for item in order['items'] or [{}]:
+                writer.writerow([
+                    order['id'], order['toast_guid'], order['order_number'], order['closed_date'],
+                    order['total_amount'], order['payment_status'], order['source'],
+                    item.get('menu_item_guid'), item.get('menu_item_name'), item.get('quantity'),
+                    item.get('unit_price'), item.get('total_price'),
+                    json.dumps(deductions_by_item.get(item.get('id'), []))
+                ])
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate(0)
@@ -0,0 +1,81 @@
+"""
+Plate Costs
+Per-menu-item food cost kept in menu_item_costs. Writers recompute only the
+menu items they affect: a recipe save refreshes that item, and an ingredient
+cost change refreshes the items using it (via the recipe_components(ingredient_id) index).
+"""
+
+from datetime import datetime
+from src.database import get_connection, bump_version, IN_CLAUSE_CHUNK
+
+# cost_per_unit can hold '' from older edit forms; SQLite arithmetic treats that as 0.
+# stock_quantity is NULL on rows written outside src/units.py until the next init_db.
+PLATE_COST_SELECT = '''
+    SELECT rc.menu_item_guid,
+           SUM(COALESCE(rc.stock_quantity, rc.quantity) * COALESCE(i.cost_per_unit, 0)),
+           COUNT(*),
+           SUM(CASE WHEN i.id IS NULL OR COALESCE(i.cost_per_unit, 0) + 0 <= 0 THEN 1 ELSE 0 END),
+           ?
+    FROM recipe_components rc
+    LEFT JOIN ingredients i ON i.id = rc.ingredient_id
+'''
+
+
+def menu_items_using(cursor, ingredient_ids):
+    """GUIDs of menu items whose recipes use any of the given ingredients"""
+    ids = list(dict.fromkeys(ingredient_ids))
+    guids = set()
+    for start in range(0, len(ids), IN_CLAUSE_CHUNK):
+        chunk = ids[start:start + IN_CLAUSE_CHUNK]
+        placeholders = ','.join('?' * len(chunk))
+        cursor.execute(f'SELECT DISTINCT menu_item_guid FROM recipe_components WHERE ingredient_id IN ({placeholders})', chunk)
+        guids.update(row[0] for row in cursor.fetchall())
+    return guids
+
+
+def refresh_menu_items(cursor, menu_item_guids):
+    """Recompute plate costs for these menu items inside the caller's transaction"""
+    guids = list(dict.fromkeys(menu_item_guids))
+    if not guids:
+        return 0
+    now = datetime.now().isoformat()
+    for start in range(0, len(guids), IN_CLAUSE_CHUNK):
+        chunk = guids[start:start + IN_CLAUSE_CHUNK]
+        placeholders = ','.join('?' * len(chunk))
+        cursor.execute(f'DELETE FROM menu_item_costs WHERE menu_item_guid IN ({placeholders})', chunk)
+        cursor.execute(f'''
+            INSERT INTO menu_item_costs (menu_item_guid, plate_cost, component_count, missing_costs, updated_at)
+            {PLATE_COST_SELECT}
+            WHERE rc.menu_item_guid IN ({placeholders})
+            GROUP BY rc.menu_item_guid
+        ''', [now] + chunk)
+    bump_version(cursor, 'plate_costs')
+    return len(guids)
+
+
+def refresh_for_ingredients(cursor, ingredient_ids):
+    """Recompute plate costs for every menu item using these ingredients"""
+    return refresh_menu_items(cursor, menu_items_using(cursor, ingredient_ids))
+
+
+def get_plate_costs(menu_item_guid=None):
+    """Stored plate costs with menu names, most expensive first"""
+    query = '''
+        SELECT c.menu_item_guid, m.item_name, m.menu, c.plate_cost, c.component_count,
+               c.missing_costs, c.updated_at
+        FROM menu_item_costs c
+        LEFT JOIN menu_items m ON m.item_guid = c.menu_item_guid
+    '''
+    params = []
+    if menu_item_guid:
+        query += ' WHERE c.menu_item_guid = ?'
+        params.append(menu_item_guid)
+    query += ' ORDER BY c.plate_cost DESC, m.item_name'
+
+    conn = get_connection()
+    cursor = conn.cursor()
+    try:
+        cursor.execute(query, params)
+        return [dict(row) for row in cursor.fetchall()]
+    finally:
+        conn.close()
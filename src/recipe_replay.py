@@ -0,0 +1,167 @@
+"""
+Recipe Replay
+Re-runs past order deductions for one menu item against its current recipe, e.g.
+after a wrong quantity was fixed. Affected order items are collected once into a
+temp table and everything else is set-based SQL: deductions are rewritten, the
+daily rollups are corrected on the days they were booked, and the net difference
+is applied to stock as ledgered 'correction' movements in a single transaction.
+The rewritten days are recorded in export_invalidations for the analytics export.
+"""
+
+from datetime import date, datetime
+from src.database import get_connection
+from src.stock_mutations import fetch_ingredients, apply_stock_deltas
+from src.stock_ledger import opening_timestamp
+
+# Differences smaller than this are float noise, not recipe changes
+EPSILON = 1e-9
+
+# New deductions keep the time of the deductions they replace, so they land on the same rollup day
+SELECT_ITEMS_SQL = '''
+    INSERT INTO replay_items (order_item_id, order_id, quantity, timestamp)
+    SELECT oi.id, oi.order_id, oi.quantity,
+           COALESCE((SELECT MIN(od.timestamp) FROM order_deductions od WHERE od.order_item_id = oi.id),
+                    o.synced_at, ?)
+    FROM order_items oi
+    JOIN orders o ON o.id = oi.order_id
+    WHERE oi.menu_item_guid = ?
+'''
+
+# (day, ingredient, ledgered, recorded, recomputed) for the selected order items, where
+# ledgered tells deductions made after the ledger's opening balances from older ones
+DIFF_SQL = '''
+    SELECT substr(timestamp, 1, 10) AS day, ingredient_id, timestamp >= ? AS ledgered,
+           SUM(recorded), SUM(recomputed)
+    FROM (
+        SELECT od.timestamp, od.ingredient_id, od.quantity_deducted AS recorded, 0 AS recomputed
+        FROM replay_items r
+        JOIN order_deductions od ON od.order_item_id = r.order_item_id
+        UNION ALL
+        SELECT r.timestamp, rc.ingredient_id, 0, COALESCE(rc.stock_quantity, rc.quantity) * r.quantity
+        FROM replay_items r
+        JOIN recipe_components rc ON rc.menu_item_guid = ?
+    )
+    WHERE ingredient_id IS NOT NULL
+    GROUP BY day, ingredient_id, ledgered
+'''
+
+
+def _select_items(cursor, menu_item_guid, start, end):
+    cursor.execute('''
+        CREATE TEMP TABLE IF NOT EXISTS replay_items (
+            order_item_id INTEGER PRIMARY KEY,
+            order_id INTEGER,
+            quantity REAL,
+            timestamp TEXT
+        )
+    ''')
+    cursor.execute('DELETE FROM replay_items')
+    query = SELECT_ITEMS_SQL
+    params = [datetime.now().isoformat(), menu_item_guid]
+    if start:
+        query += ' AND COALESCE(o.closed_date, o.opened_date) >= ?'
+        params.append(start)
+    if end:
+        query += ' AND COALESCE(o.closed_date, o.opened_date) < ?'
+        params.append(end)
+    cursor.execute(query, params)
+    cursor.execute('SELECT COUNT(*), COUNT(DISTINCT order_id) FROM replay_items')
+    return cursor.fetchone()
+
+
+def replay_recipe(menu_item_guid, start=None, end=None, dry_run=True):
+    """
+    Recompute deductions for orders of `menu_item_guid` closed in [start, end)
+    (YYYY-MM-DD, either may be omitted). With dry_run nothing is written.
+    Returns counts and the per-ingredient difference between recorded and recomputed usage.
+    """
+    for value in (start, end):
+        if value:
+            date.fromisoformat(value[:10])
+    if start and end and start >= end:
+        raise ValueError("start must be before end")
+
+    conn = get_connection()
+    cursor = conn.cursor()
+    try:
+        if not dry_run:
+            cursor.execute('BEGIN IMMEDIATE')
+        item_count, order_count = _select_items(cursor, menu_item_guid, start, end)
+        cursor.execute(DIFF_SQL, (opening_timestamp(cursor), menu_item_guid))
+        rows = cursor.fetchall()
+
+        totals = {}
+        day_diffs = []
+        for day, ingredient_id, ledgered, recorded, recomputed in rows:
+            total = totals.setdefault(ingredient_id, [0.0, 0.0])
+            total[0] += recorded
+            total[1] += recomputed
+            if abs(recomputed - recorded) > EPSILON:
+                day_diffs.append((day, ingredient_id, ledgered, recomputed - recorded))
+
+        ingredients = fetch_ingredients(cursor, totals.keys())
+        deductions = []
+        stock_changes = []
+        for ingredient_id, (recorded, recomputed) in totals.items():
+            if abs(recomputed - recorded) <= EPSILON:
+                continue
+            ingredient = ingredients.get(ingredient_id, {})
+            deductions.append({
+                'id': ingredient_id,
+                'name': ingredient.get('name'),
+                'unit': ingredient.get('unit'),
+                'recorded': round(recorded, 4),
+                'recomputed': round(recomputed, 4),
+                'stock_delta': round(recorded - recomputed, 4)
+            })
+            stock_changes.append((ingredient_id, recorded - recomputed))
+
+        result = {
+            'menu_item_guid': menu_item_guid,
+            'start': start,
+            'end': end,
+            'dry_run': dry_run,
+            'order_items': item_count,
+            'orders': order_count,
+            'deductions': deductions,
+            'applied': False
+        }
+        if dry_run or not deductions:
+            conn.rollback()
+            return result
+
+        cursor.execute('DELETE FROM order_deductions WHERE order_item_id IN (SELECT order_item_id FROM replay_items)')
+        cursor.execute('''
+            INSERT INTO order_deductions (order_id, order_item_id, ingredient_id, quantity_deducted, timestamp)
+            SELECT r.order_id, r.order_item_id, rc.ingredient_id, COALESCE(rc.stock_quantity, rc.quantity) * r.quantity, r.timestamp
+            FROM replay_items r
+            JOIN recipe_components rc ON rc.menu_item_guid = ?
+            WHERE rc.ingredient_id IS NOT NULL
+        ''', (menu_item_guid,))
+        # Sales usage is rolled up on the day it was booked, so correct those days rather than today
+        cursor.executemany('''
+            INSERT INTO daily_ingredient_stats (day, ingredient_id, deducted) VALUES (?, ?, ?)
+            ON CONFLICT(day, ingredient_id) DO UPDATE SET deducted = deducted + excluded.deducted
+        ''', [(day, ingredient_id, diff) for day, ingredient_id, _, diff in day_diffs])
+        reference = f"Recipe replay {menu_item_guid}"
+        apply_stock_deltas(cursor, stock_changes, 'correction', reference=reference, ingredients=ingredients)
+        # Kept so check_inventory.py can reconcile the ledger with the rewritten deductions
+        timestamp = datetime.now().isoformat()
+        cursor.executemany('''
+            INSERT INTO deduction_corrections (timestamp, reference, day, ingredient_id, delta, ledgered)
+            VALUES (?, ?, ?, ?, ?, ?)
+        ''', [(timestamp, reference, day, ingredient_id, diff, ledgered)
+              for day, ingredient_id, ledgered, diff in day_diffs])
+        # Deductions were replaced under new ids, so exported partitions of these days are stale
+        cursor.executemany('''
+            INSERT INTO export_invalidations (table_name, day, timestamp, reference) VALUES ('order_deductions', ?, ?, ?)
+        ''', [(day, timestamp, reference) for day in sorted({row[0] for row in rows if row[0]})])
+        cursor.execute('DELETE FROM replay_items')
+        conn.commit()
+        result['applied'] = True
+        return result
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
@@ -0,0 +1,115 @@
+"""
+Daily Rollups
+Per-day order totals and per-day, per-ingredient stock movement totals,
+updated in the same transaction as the writes they summarize
+"""
+
+import collections
+from datetime import datetime
+from src.database import get_connection
+
+# Which daily_ingredient_stats column a ledger movement type feeds (sign-flipped to positive)
+MOVEMENT_COLUMNS = {
+    'sale': 'deducted',
+    'receipt': 'received',
+    'adjustment': 'wasted'
+}
+
+
+def add_order_stats(cursor, orders):
+    """
+    Fold newly stored orders into daily_order_stats.
+    orders: [(day, total_amount, tax_amount, tip_amount), ...] for non-deleted orders
+    """
+    totals = collections.defaultdict(lambda: [0, 0.0, 0.0, 0.0])
+    for day, total_amount, tax_amount, tip_amount in orders:
+        row = totals[day]
+        row[0] += 1
+        row[1] += float(total_amount or 0)
+        row[2] += float(tax_amount or 0)
+        row[3] += float(tip_amount or 0)
+
+    cursor.executemany('''
+        INSERT INTO daily_order_stats (day, order_count, revenue, tax, tips) VALUES (?, ?, ?, ?, ?)
+        ON CONFLICT(day) DO UPDATE SET
+            order_count = order_count + excluded.order_count,
+            revenue = revenue + excluded.revenue,
+            tax = tax + excluded.tax,
+            tips = tips + excluded.tips
+    ''', [(day, *row) for day, row in totals.items()])
+
+
+def add_movement_stats(cursor, movements, day=None):
+    """
+    Fold ledger movements into daily_ingredient_stats.
+    movements: [(ingredient_id, delta, movement_type, reference), ...] as written to stock_ledger
+    """
+    day = day or datetime.now().strftime('%Y-%m-%d')
+    totals = collections.defaultdict(lambda: {'deducted': 0.0, 'received': 0.0, 'wasted': 0.0})
+    for ingredient_id, delta, movement_type, _ in movements:
+        column = MOVEMENT_COLUMNS.get(movement_type)
+        # Manual additions are not waste; only count stock leaving via adjustments
+        if column is None or (column == 'wasted' and delta > 0):
+            continue
+        totals[ingredient_id][column] += abs(delta)
+
+    cursor.executemany('''
+        INSERT INTO daily_ingredient_stats (day, ingredient_id, deducted, received, wasted) VALUES (?, ?, ?, ?, ?)
+        ON CONFLICT(day, ingredient_id) DO UPDATE SET
+            deducted = deducted + excluded.deducted,
+            received = received + excluded.received,
+            wasted = wasted + excluded.wasted
+    ''', [(day, ingredient_id, row['deducted'], row['received'], row['wasted'])
+          for ingredient_id, row in totals.items()])
+
+
+def get_order_stats(today=None):
+    """All-time and today's order totals, read from the daily rollup"""
+    today = today or datetime.now().strftime('%Y-%m-%d')
+    conn = get_connection()
+    cursor = conn.cursor()
+    try:
+        cursor.execute('''
+            SELECT COALESCE(SUM(order_count), 0) AS count, SUM(revenue) AS revenue,
+                   SUM(tax) AS tax, SUM(tips) AS tips
+            FROM daily_order_stats
+        ''')
+        stats = dict(cursor.fetchone())
+        cursor.execute('SELECT order_count, revenue FROM daily_order_stats WHERE day = ?', (today,))
+        row = cursor.fetchone()
+        stats['today_count'] = row['order_count'] if row else 0
+        stats['today_revenue'] = row['revenue'] if row else 0
+        return stats
+    finally:
+        conn.close()
+
+
+def get_consumption_stats(start=None, end=None, ingredient_id=None):
+    """Deducted/received/wasted totals per ingredient between two days (start inclusive, end exclusive)"""
+    where = []
+    params = []
+    if start:
+        where.append("s.day >= ?")
+        params.append(start)
+    if end:
+        where.append("s.day < ?")
+        params.append(end)
+    if ingredient_id:
+        where.append("s.ingredient_id = ?")
+        params.append(ingredient_id)
+    clause = (" WHERE " + " AND ".join(where)) if where else ""
+
+    conn = get_connection()
+    cursor = conn.cursor()
+    try:
+        cursor.execute(f'''
+            SELECT s.ingredient_id, i.name, i.unit,
+                   SUM(s.deducted) AS deducted, SUM(s.received) AS received, SUM(s.wasted) AS wasted
+            FROM daily_ingredient_stats s
+            LEFT JOIN ingredients i ON i.id = s.ingredient_id{clause}
+            GROUP BY s.ingredient_id
+            ORDER BY i.name
+        ''', params)
+        return [dict(row) for row in cursor.fetchall()]
+    finally:
+        conn.close()
@@ -0,0 +1,148 @@
+"""
+SQL Tracer
+Opt-in (SQL_TRACE=1) recording of every statement run through get_connection(),
+grouped per request or sync run. Flags statement shapes repeated more than
+SQL_TRACE_REPEAT times (usually an N+1 loop) and logs slow statements.
+"""
+
+import contextlib
+import contextvars
+import os
+import re
+import sys
+import time
+from flask import g, request
+from src.database import add_query_hook
+from src.logger import get_logger
+
+ENABLED = os.environ.get('SQL_TRACE', '').lower() in ('1', 'true', 'yes')
+SLOW_QUERY_MS = float(os.environ.get('SQL_TRACE_SLOW_MS', 100))
+REPEAT_THRESHOLD = int(os.environ.get('SQL_TRACE_REPEAT', 10))
+
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# Frames from these files are plumbing, not the code that issued the query
+_SKIP_FILES = {os.path.abspath(__file__), os.path.join(PROJECT_ROOT, 'src', 'database.py')}
+
+_logger = get_logger('sql_trace')
+_current = contextvars.ContextVar('sql_trace', default=None)
+
+_STRING_LITERAL = re.compile(r"'(?:[^']|'')*'")
+_NUMBER_LITERAL = re.compile(r"\b\d+(?:\.\d+)?\b")
+_PLACEHOLDER_LIST = re.compile(r"\(\s*\?(?:\s*,\s*\?)+\s*\)")
+_WHITESPACE = re.compile(r"\s+")
+
+
+def normalize(sql):
+    """Statement shape: literals become ?, IN-lists collapse, whitespace is squeezed"""
+    shape = _STRING_LITERAL.sub('?', sql)
+    shape = _NUMBER_LITERAL.sub('?', shape)
+    shape = _PLACEHOLDER_LIST.sub('(?, ...)', shape)
+    return _WHITESPACE.sub(' ', shape).strip()
+
+
+def _call_site():
+    """file:line function of the first project frame outside the database plumbing"""
+    frame = sys._getframe(1)
+    while frame:
+        filename = os.path.abspath(frame.f_code.co_filename)
+        if (filename.startswith(PROJECT_ROOT) and filename not in _SKIP_FILES
+                and 'site-packages' not in filename):
+            return f"{os.path.relpath(filename, PROJECT_ROOT)}:{frame.f_lineno} {frame.f_code.co_name}"
+        frame = frame.f_back
+    return 'unknown'
+
+
+class QueryTrace:
+    def __init__(self, name):
+        self.name = name
+        self.started = time.perf_counter()
+        self.queries = []  # (shape, seconds, call site)
+
+    def record(self, sql, seconds, site):
+        self.queries.append((normalize(sql), seconds, site))
+
+    def repeated(self, threshold=REPEAT_THRESHOLD):
+        """[(count, shape, call sites)] for shapes run more than `threshold` times, most frequent first"""
+        groups = {}
+        for shape, _, site in self.queries:
+            entry = groups.setdefault(shape, [0, set()])
+            entry[0] += 1
+            entry[1].add(site)
+        return sorted(((count, shape, sorted(sites)) for shape, (count, sites) in groups.items()
+                       if count > threshold), reverse=True)
+
+    def summary(self):
+        total_ms = sum(seconds for _, seconds, _ in self.queries) * 1000
+        return f"queries={len(self.queries)}; sql_ms={total_ms:.1f}; repeated_shapes={len(self.repeated())}"
+
+    def report(self):
+        elapsed_ms = (time.perf_counter() - self.started) * 1000
+        _logger.info(f"[sql-trace] {self.name}: {self.summary()}; wall_ms={elapsed_ms:.1f}")
+        for count, shape, sites in self.repeated():
+            _logger.warning(f"[sql-trace] {self.name}: {count}x {shape} (from {', '.join(sites)})")
+
+
+def _on_query(sql, seconds):
+    trace = _current.get()
+    if trace is None and seconds * 1000 < SLOW_QUERY_MS:
+        return
+    site = _call_site()
+    if trace is not None:
+        trace.record(sql, seconds, site)
+    if seconds * 1000 >= SLOW_QUERY_MS:
+        _logger.warning(f"[sql-trace] slow query {seconds * 1000:.1f} ms at {site}: {normalize(sql)}")
+
+
+def start(name):
+    """Begin collecting statements for this context; returns a token for finish()"""
+    trace = QueryTrace(name)
+    return trace, _current.set(trace)
+
+
+def finish(token):
+    trace, var_token = token
+    _current.reset(var_token)
+    trace.report()
+    return trace
+
+
+@contextlib.contextmanager
+def trace(name):
+    """Trace a block (e.g. a sync run). A no-op when disabled or already inside a trace."""
+    if not ENABLED or _current.get() is not None:
+        yield _current.get()
+        return
+    token = start(name)
+    try:
+        yield token[0]
+    finally:
+        finish(token)
+
+
+def _before_request():
+    g._sql_trace = start(f"{request.method} {request.path}")
+
+
+def _after_request(response):
+    token = g.get('_sql_trace')
+    if token is not None:
+        response.headers['X-SQL-Summary'] = token[0].summary()
+    return response
+
+
+def _teardown_request(exc):
+    token = g.pop('_sql_trace', None)
+    if token is not None:
+        finish(token)
+
+
+if ENABLED:
+    add_query_hook(_on_query)
+
+
+def init_app(app):
+    if not ENABLED:
+        return
+    app.before_request(_before_request)
+    app.after_request(_after_request)
+    app.teardown_request(_teardown_request)
@@ -0,0 +1,127 @@
+"""
+Stock Alerts
+Low-stock state per ingredient, re-evaluated by the stock mutation engine for the
+ingredients each write touches (never a full table scan). Only state transitions
+are recorded in stock_alerts; recovering from 'low' needs a margin above the
+threshold, so stock hovering around it does not raise an alert on every order.
+"""
+
+from datetime import datetime
+from src.database import get_connection, bump_version, IN_CLAUSE_CHUNK
+
+STATES = ('ok', 'low', 'out')
+RECOVERY_MARGIN = 0.1   # back to 'ok' only above threshold * (1 + RECOVERY_MARGIN)
+
+
+def classify(stock, threshold, previous=None):
+    """'out' at or below zero, 'low' at or below the threshold, else 'ok' (with hysteresis on recovery)"""
+    stock = float(stock or 0)
+    threshold = float(threshold or 0)
+    if stock <= 0:
+        return 'out'
+    if stock <= threshold:
+        return 'low'
+    if previous in ('low', 'out') and stock <= threshold * (1 + RECOVERY_MARGIN):
+        return 'low'
+    return 'ok'
+
+
+def _load_states(cursor, ingredient_ids):
+    states = {}
+    for start in range(0, len(ingredient_ids), IN_CLAUSE_CHUNK):
+        chunk = ingredient_ids[start:start + IN_CLAUSE_CHUNK]
+        placeholders = ','.join('?' * len(chunk))
+        cursor.execute(f'SELECT ingredient_id, state FROM ingredient_alert_state WHERE ingredient_id IN ({placeholders})', chunk)
+        states.update((row[0], row[1]) for row in cursor.fetchall())
+    return states
+
+
+def check_thresholds(cursor, ingredients, new_stocks, movement_type, reference=None):
+    """
+    Record alert transitions for the ingredients in `new_stocks` inside the caller's
+    transaction, after their stock_ledger rows have been written.
+
+    ingredients: {ingredient_id: row} as loaded before the change (see fetch_ingredients)
+    new_stocks: {ingredient_id: stock after the change}
+    Returns the list of alerts recorded.
+    """
+    ids = [ingredient_id for ingredient_id in new_stocks if ingredient_id in ingredients]
+    if not ids:
+        return []
+    stored = _load_states(cursor, ids)
+
+    timestamp = datetime.now().isoformat()
+    alerts = []
+    for ingredient_id in ids:
+        row = ingredients[ingredient_id]
+        # Without a stored state, start from what the stock was before this change
+        previous = stored.get(ingredient_id) or classify(row['current_stock'], row['threshold'])
+        state = classify(new_stocks[ingredient_id], row['threshold'], previous)
+        if state != previous:
+            alerts.append({
+                'ingredient_id': ingredient_id,
+                'ingredient_name': row['name'],
+                'unit': row['unit'],
+                'state': state,
+                'previous_state': previous,
+                'stock': float(new_stocks[ingredient_id]),
+                'threshold': float(row['threshold'] or 0),
+                'movement_type': movement_type,
+                'reference': reference,
+                'timestamp': timestamp
+            })
+    if not alerts:
+        return []
+
+    cursor.executemany('''
+        INSERT INTO ingredient_alert_state (ingredient_id, state, changed_at) VALUES (?, ?, ?)
+        ON CONFLICT(ingredient_id) DO UPDATE SET state = excluded.state, changed_at = excluded.changed_at
+    ''', [(alert['ingredient_id'], alert['state'], timestamp) for alert in alerts])
+
+    # Tie the alerts to this write's ledger rows so the live feed can replay them by ledger id
+    cursor.execute('SELECT COALESCE(MAX(id), 0) FROM stock_ledger')
+    ledger_id = cursor.fetchone()[0]
+    cursor.executemany('''
+        INSERT INTO stock_alerts (timestamp, ledger_id, ingredient_id, ingredient_name, unit, state,
+                                  previous_state, stock, threshold, movement_type, reference)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    ''', [(timestamp, ledger_id, a['ingredient_id'], a['ingredient_name'], a['unit'], a['state'],
+           a['previous_state'], a['stock'], a['threshold'], a['movement_type'], a['reference'])
+          for a in alerts])
+    bump_version(cursor, 'alerts')
+    return alerts
+
+
+def get_alerts(after_id=None, ingredient_id=None, limit=100):
+    """
+    Recorded transitions, newest first (oldest first when polling with after_id),
+    plus the ingredients currently 'low' or 'out'.
+    """
+    query = 'SELECT * FROM stock_alerts WHERE 1=1'
+    params = []
+    if after_id is not None:
+        query += ' AND id > ?'
+        params.append(after_id)
+    if ingredient_id:
+        query += ' AND ingredient_id = ?'
+        params.append(ingredient_id)
+    query += ' ORDER BY id ASC' if after_id is not None else ' ORDER BY id DESC'
+    query += ' LIMIT ?'
+    params.append(limit)
+
+    conn = get_connection()
+    cursor = conn.cursor()
+    try:
+        cursor.execute(query, params)
+        alerts = [dict(row) for row in cursor.fetchall()]
+        cursor.execute('''
+            SELECT s.ingredient_id, i.name, i.unit, i.current_stock, i.threshold, s.state, s.changed_at
+            FROM ingredient_alert_state s
+            JOIN ingredients i ON i.id = s.ingredient_id
+            WHERE s.state != 'ok'
+            ORDER BY s.changed_at DESC
+        ''')
+        active = [dict(row) for row in cursor.fetchall()]
+        return {'alerts': alerts, 'active': active}
+    finally:
+        conn.close()
@@ -0,0 +1,104 @@
+"""
+Stock Ledger
+Append-only record of every stock movement, with periodic snapshots so that
+"stock at time T" and full rebuilds only replay a short tail of the ledger
+"""
+
+from datetime import datetime
+from src.database import get_connection
+
+# Take a snapshot of every ingredient once this many ledger rows have piled up
+SNAPSHOT_INTERVAL = 2000
+
+
+def record_movements(cursor, movements):
+    """
+    Append ledger rows inside the caller's transaction.
+    movements: [(ingredient_id, delta, movement_type, reference), ...]
+    """
+    timestamp = datetime.now().isoformat()
+    cursor.executemany('''
+        INSERT INTO stock_ledger (timestamp, ingredient_id, delta, movement_type, reference)
+        VALUES (?, ?, ?, ?, ?)
+    ''', [(timestamp, ingredient_id, float(delta), movement_type, reference)
+          for ingredient_id, delta, movement_type, reference in movements])
+
+
+def opening_timestamp(cursor):
+    """When the ledger was seeded; history before it is folded into the opening balances ('' if never)"""
+    cursor.execute("SELECT timestamp FROM stock_ledger WHERE movement_type = 'opening' ORDER BY id LIMIT 1")
+    row = cursor.fetchone()
+    return row[0] if row else ''
+
+
+def ledger_balances(cursor, as_of=None, ingredient_id=None):
+    """
+    Stock per ingredient according to the ledger: the latest snapshot taken at or
+    before `as_of` (ISO timestamp, default now) plus the ledger rows after it.
+    Returns {ingredient_id: balance}.
+    """
+    as_of = as_of or datetime.now().isoformat()
+
+    # Snapshots are taken for all ingredients at once, so they share a ledger_id
+    cursor.execute('SELECT MAX(ledger_id) FROM stock_snapshots WHERE timestamp <= ?', (as_of,))
+    snapshot_ledger_id = cursor.fetchone()[0] or 0
+
+    balances = {}
+    if snapshot_ledger_id:
+        query = 'SELECT ingredient_id, balance FROM stock_snapshots WHERE ledger_id = ?'
+        params = [snapshot_ledger_id]
+        if ingredient_id is not None:
+            query += ' AND ingredient_id = ?'
+            params.append(ingredient_id)
+        cursor.execute(query, params)
+        balances = {row['ingredient_id']: row['balance'] for row in cursor.fetchall()}
+
+    query = '''
+        SELECT ingredient_id, SUM(delta) AS delta
+        FROM stock_ledger
+        WHERE id > ? AND timestamp <= ?
+    '''
+    params = [snapshot_ledger_id, as_of]
+    if ingredient_id is not None:
+        query += ' AND ingredient_id = ?'
+        params.append(ingredient_id)
+    cursor.execute(query + ' GROUP BY ingredient_id', params)
+    for row in cursor.fetchall():
+        balances[row['ingredient_id']] = balances.get(row['ingredient_id'], 0.0) + row['delta']
+
+    return balances
+
+
+def take_snapshot(cursor):
+    """Snapshot every ingredient's ledger balance inside the caller's transaction"""
+    cursor.execute('SELECT MAX(id) FROM stock_ledger')
+    last_ledger_id = cursor.fetchone()[0]
+    if not last_ledger_id:
+        return 0
+
+    balances = ledger_balances(cursor)
+    timestamp = datetime.now().isoformat()
+    cursor.executemany('''
+        INSERT INTO stock_snapshots (ingredient_id, ledger_id, timestamp, balance)
+        VALUES (?, ?, ?, ?)
+    ''', [(ingredient_id, last_ledger_id, timestamp, balance) for ingredient_id, balance in balances.items()])
+    return len(balances)
+
+
+def snapshot_if_due(cursor):
+    """Take a snapshot when SNAPSHOT_INTERVAL ledger rows have been written since the last one"""
+    cursor.execute('''
+        SELECT (SELECT MAX(id) FROM stock_ledger) - COALESCE((SELECT MAX(ledger_id) FROM stock_snapshots), 0)
+    ''')
+    pending = cursor.fetchone()[0] or 0
+    if pending >= SNAPSHOT_INTERVAL:
+        take_snapshot(cursor)
+
+
+def stock_at(as_of, ingredient_id=None):
+    """Point-in-time stock levels: {ingredient_id: balance} as of the given ISO timestamp"""
+    conn = get_connection()
+    try:
+        return ledger_balances(conn.cursor(), as_of=as_of, ingredient_id=ingredient_id)
+    finally:
+        conn.close()
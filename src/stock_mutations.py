@@ -0,0 +1,100 @@
+"""
+Stock Mutation Engine
+Applies relative stock changes atomically so concurrent writers never lose updates
+"""
+
+import collections
+from src.database import bump_version, IN_CLAUSE_CHUNK
+from src.stock_ledger import record_movements, snapshot_if_due
+from src.rollups import add_movement_stats
+from src.plate_costs import refresh_for_ingredients
+from src.stock_alerts import check_thresholds
+
+
+def fetch_ingredients(cursor, ingredient_ids):
+    """Load ingredient rows for the given IDs in as few queries as possible, keyed by ID"""
+    ids = list(dict.fromkeys(i for i in ingredient_ids if i is not None))
+    found = {}
+    for start in range(0, len(ids), IN_CLAUSE_CHUNK):
+        chunk = ids[start:start + IN_CLAUSE_CHUNK]
+        placeholders = ','.join('?' * len(chunk))
+        cursor.execute(f'SELECT * FROM ingredients WHERE id IN ({placeholders})', chunk)
+        for row in cursor.fetchall():
+            found[row['id']] = dict(row)
+    return found
+
+
+def apply_stock_deltas(cursor, changes, movement_type, reference=None, costs=None, ingredients=None):
+    """
+    Apply relative stock changes inside the caller's write transaction,
+    append one stock_ledger row per change and update the daily rollups.
+
+    The caller must have issued `BEGIN IMMEDIATE` on the cursor's connection so
+    that the stock values read here cannot change before the update lands.
+
+    changes: [(ingredient_id, delta), ...] applied in order; an ingredient may repeat.
+             A third element overrides `reference` for that change.
+    movement_type: ledger movement type ('receipt', 'adjustment', 'count', 'sale', 'manual', ...)
+    reference: free-text ledger reference (invoice, reason, order GUID, ...)
+    costs: optional {ingredient_id: new cost_per_unit}
+    ingredients: optional rows already loaded in this transaction (see fetch_ingredients)
+
+    Returns a list parallel to `changes` with
+    {'ingredient': row, 'delta': ..., 'old_stock': ..., 'new_stock': ...}
+    or None for ingredient IDs that do not exist.
+    """
+    if not cursor.connection.in_transaction:
+        raise RuntimeError("apply_stock_deltas() must run inside BEGIN IMMEDIATE")
+
+    if ingredients is None:
+        ingredients = fetch_ingredients(cursor, [change[0] for change in changes])
+
+    running = {}
+    totals = collections.defaultdict(float)
+    movements = []
+    results = []
+
+    for change in changes:
+        ingredient_id, delta = change[0], change[1]
+        ingredient = ingredients.get(ingredient_id)
+        if ingredient is None:
+            results.append(None)
+            continue
+
+        delta = float(delta)
+        old_stock = running.get(ingredient_id, float(ingredient['current_stock'] or 0))
+        new_stock = old_stock + delta
+        running[ingredient_id] = new_stock
+        totals[ingredient_id] += delta
+        movements.append((ingredient_id, delta, movement_type, change[2] if len(change) > 2 else reference))
+
+        results.append({
+            'ingredient': ingredient,
+            'delta': delta,
+            'old_stock': old_stock,
+            'new_stock': new_stock
+        })
+
+    cursor.executemany(
+        'UPDATE ingredients SET current_stock = current_stock + ? WHERE id = ?',
+        [(delta, ingredient_id) for ingredient_id, delta in totals.items()]
+    )
+
+    if movements:
+        record_movements(cursor, movements)
+        add_movement_stats(cursor, movements)
+        snapshot_if_due(cursor)
+        check_thresholds(cursor, ingredients, running, movement_type, reference)
+
+    cost_updates = [(float(cost), ingredient_id) for ingredient_id, cost in (costs or {}).items()
+                    if ingredient_id in ingredients]
+    if cost_updates:
+        cursor.executemany('UPDATE ingredients SET cost_per_unit = ? WHERE id = ?', cost_updates)
+        # Only menu items using an ingredient whose cost actually moved need new plate costs
+        refresh_for_ingredients(cursor, [ingredient_id for cost, ingredient_id in cost_updates
+                                         if float(ingredients[ingredient_id]['cost_per_unit'] or 0) != cost])
+
+    if totals or cost_updates:
+        bump_version(cursor, 'ingredients')
+
+    return results
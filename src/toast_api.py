@@ -3,9 +3,14 @@ import os
 import requests
 import sqlite3
 import collections
+import logging
 from datetime import datetime, timedelta
 import time
 from src.database import get_connection
+from src.stock_mutations import apply_stock_deltas
+from src.rollups import add_order_stats
+from src import metrics, sql_trace
+from src.logger import get_logger
 
 # --- Configuration & Credentials ---
 CREDENTIALS = {
@@ -19,26 +24,23 @@ CREDENTIALS = {
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 CREDENTIALS_FILE = os.path.join(BASE_DIR, 'logs', 'toast_credentials.txt')
 LAST_SYNC_FILE = os.path.join(BASE_DIR, 'logs', 'last_sync_time.txt')
-LOG_FILE = os.path.join(BASE_DIR, 'logs', 'inventory_log.txt')
 
-def log(message):
-    """Log messages to console and file"""
-    timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-    entry = f"[{timestamp}] {message}"
-    try:
-        print(entry)
-    except Exception:
-        pass # specific environment might have issues with stdout
-    
-    LOG_DIR = os.path.join(BASE_DIR, 'logs')
-    if not os.path.exists(LOG_DIR):
-        os.makedirs(LOG_DIR)
+_logger = get_logger('toast')
+
+def log(message, level=logging.INFO):
+    """Log sync progress through the shared app logger"""
+    _logger.log(level, message)
+
+def _toast_request(method, endpoint, url, **kwargs):
+    """requests.request() that feeds the Toast API call metrics (endpoint is a short label)"""
+    started = time.perf_counter()
+    status = 'error'
     try:
-        with open(LOG_FILE, 'a', encoding='utf-8') as f:
-            f.write(entry + "\n")
-    except Exception as e:
-        # If we can't write to log file, just ignore to avoid crushing the app
-        pass
+        response = requests.request(method, url, **kwargs)
+        status = response.status_code
+        return response
+    finally:
+        metrics.observe_toast_call(endpoint, status, time.perf_counter() - started)
 
 def load_credentials():
     creds = CREDENTIALS.copy()
@@ -52,7 +54,7 @@ def load_credentials():
                         if key in ["CLIENT_ID", "CLIENT_SECRET", "RESTAURANT_GUID", "ACCESS_TOKEN", "MANAGEMENT_GROUP_GUID"]:
                             creds[key] = value
         except Exception as e:
-            log(f"Error reading credentials file: {e}")
+            log(f"Error reading credentials file: {e}", logging.ERROR)
     
     return creds
 
@@ -68,7 +70,7 @@ def save_credentials(creds):
                     f.write(f"{key}={creds[key]}\n")
         return True
     except Exception as e:
-        log(f"Error saving credentials: {e}")
+        log(f"Error saving credentials: {e}", logging.ERROR)
         return False
 
 def refresh_access_token(creds):
@@ -88,7 +90,7 @@ def refresh_access_token(creds):
     headers = {"Content-Type": "application/json"}
 
     try:
-        response = requests.post(url, json=payload, headers=headers, timeout=30)
+        response = _toast_request('POST', 'authentication', url, json=payload, headers=headers, timeout=30)
         if response.status_code == 200:
             data = response.json()
             new_token = data.get('token', {}).get('accessToken')
@@ -98,13 +100,13 @@ def refresh_access_token(creds):
                 log("Token refreshed successfully and saved to logs/toast_credentials.txt")
                 return True, new_token
             else:
-                log(f"Refresh failed: No accessToken in response: {data}")
+                log(f"Refresh failed: No accessToken in response: {data}", logging.ERROR)
                 return False, "No token in response"
         else:
-            log(f"Refresh failed with status {response.status_code}: {response.text}")
+            log(f"Refresh failed with status {response.status_code}: {response.text}", logging.ERROR)
             return False, f"HTTP {response.status_code}"
     except Exception as e:
-        log(f"Error during token refresh: {e}")
+        log(f"Error during token refresh: {e}", logging.ERROR)
         return False, str(e)
 
 def get_last_sync_time():
@@ -124,7 +126,7 @@ def save_sync_time(iso_timestamp):
         with open(LAST_SYNC_FILE, 'w', encoding='utf-8') as f:
             f.write(iso_timestamp)
     except Exception as e:
-        log(f"Warning: Failed to save sync time: {e}")
+        log(f"Warning: Failed to save sync time: {e}", logging.WARNING)
 
 def get_menu(access_token, restaurant_guid):
     """Fetch the full menu from Toast API"""
@@ -135,11 +137,11 @@ def get_menu(access_token, restaurant_guid):
         "Content-Type": "application/json"
     }
     try:
-        response = requests.get(url, headers=headers, timeout=30)
+        response = _toast_request('GET', 'menus', url, headers=headers, timeout=30)
         response.raise_for_status()
         return response.json()
     except Exception as e:
-        log(f"API Error fetching menu: {e}")
+        log(f"API Error fetching menu: {e}", logging.ERROR)
         return None
 
 def fetch_orders(access_token, restaurant_guid, start_date_str, end_date_str):
@@ -155,7 +157,7 @@ def fetch_orders(access_token, restaurant_guid, start_date_str, end_date_str):
         start_time = datetime.strptime(start_date_str, '%Y-%m-%dT%H:%M:%S.000+0000')
         end_time = datetime.strptime(end_date_str, '%Y-%m-%dT%H:%M:%S.000+0000')
     except ValueError as e:
-        log(f"Date Parsing Error: {e}")
+        log(f"Date Parsing Error: {e}", logging.ERROR)
         return None
 
     all_orders = []
@@ -175,17 +177,17 @@ def fetch_orders(access_token, restaurant_guid, start_date_str, end_date_str):
         log(f"  Fetching chunk: {chunk_start_str} -> {chunk_end_str}")
 
         try:
-            response = requests.get(url, headers=headers, params=params)
+            response = _toast_request('GET', 'orders', url, headers=headers, params=params)
             response.raise_for_status()
             data = response.json()
             chunk_orders = data if isinstance(data, list) else data.get('orders', [])
             all_orders.extend(chunk_orders)
         except requests.exceptions.RequestException as e:
-            log(f"API Error fetching chunk {chunk_start_str}: {e}")
+            log(f"API Error fetching chunk {chunk_start_str}: {e}", logging.ERROR)
             return None
         except Exception as e:
             # Catch strict Errno 22 or other OS errors
-            log(f"CRITICAL Error fetching chunk {chunk_start_str}: {e} (Type: {type(e)})")
+            log(f"CRITICAL Error fetching chunk {chunk_start_str}: {e} (Type: {type(e)})", logging.ERROR)
             return None
 
         current_chunk_start = current_chunk_end
@@ -199,14 +201,18 @@ def get_order_details(access_token, restaurant_guid, order_guid):
         "Content-Type": "application/json"
     }
     try:
-        response = requests.get(url, headers=headers)
+        response = _toast_request('GET', 'order_details', url, headers=headers)
         response.raise_for_status()
         return response.json()
     except requests.exceptions.RequestException as e:
-        log(f"API Error fetching order details {order_guid}: {e}")
+        log(f"API Error fetching order details {order_guid}: {e}", logging.ERROR)
         return None
 
 def run_sync(dry_run=False):
+    with sql_trace.trace(f"toast sync{' (preview)' if dry_run else ''}"):
+        return _run_sync(dry_run)
+
+def _run_sync(dry_run=False):
     log("="*60)
     log(f"STARTING TOAST SALES SYNC {'(PREVIEW MODE)' if dry_run else ''}")
     log("="*60)
@@ -256,6 +262,7 @@ def run_sync(dry_run=False):
     cursor = conn.cursor()
     
     pending_sync = []
+    fetched_orders = {}
     total_deductions = collections.defaultdict(float)
     
     try:
@@ -269,6 +276,7 @@ def run_sync(dry_run=False):
                 
             order_full = get_order_details(creds['ACCESS_TOKEN'], creds['RESTAURANT_GUID'], guid)
             if not order_full: continue
+            fetched_orders[guid] = order_full
             
             order_preview = {
                 'guid': guid,
@@ -293,10 +301,10 @@ def run_sync(dry_run=False):
                 
                 order_preview['items'].append({'name': item_name, 'qty': quantity})
                 
-                cursor.execute('SELECT ingredient_id, quantity FROM recipe_components WHERE menu_item_guid = ?', (item_guid,))
+                cursor.execute('SELECT ingredient_id, COALESCE(stock_quantity, quantity) AS stock_quantity FROM recipe_components WHERE menu_item_guid = ?', (item_guid,))
                 for component in cursor.fetchall():
                     ing_id = component['ingredient_id']
-                    deduct_qty = component['quantity'] * quantity
+                    deduct_qty = component['stock_quantity'] * quantity
                     total_deductions[ing_id] += deduct_qty
             
             pending_sync.append(order_preview)
@@ -323,22 +331,19 @@ def run_sync(dry_run=False):
         # Actual Sync Logic (only if not dry_run)
         orders_stored = 0
         deductions_count = 0
+        stock_changes = []
+        order_stats = []
+        
+        # All Toast calls are done; take the write lock only for the local writes
+        cursor.execute('BEGIN IMMEDIATE')
         
         for order_preview in pending_sync:
-            # We need the full JSON again or better, we logic it
-            # Re-fetch or use cached? Let's re-fetch for simplicity if we are here
-            # (In reality, we should have cached it in the loop above)
-            # Re-implementing the actual storage loop based on pending_sync
+            order_full = fetched_orders[order_preview['guid']]
             
-            # Since we've already done the work above, let's just commit if not dry_run
-            # Wait, I should refactor to avoid double work.
-            pass
-
-        # RE-WRITING ACTUAL SYNC LOGIC TO BE ROBUST
-        for order_preview in pending_sync:
-            # Need full details again to store raw_json
-            order_full = get_order_details(creds['ACCESS_TOKEN'], creds['RESTAURANT_GUID'], order_preview['guid'])
-            if not order_full: continue
+            # Another worker may have stored this order since the preview pass
+            cursor.execute('SELECT id FROM orders WHERE toast_guid = ?', (order_preview['guid'],))
+            if cursor.fetchone():
+                continue
             
             cursor.execute('''
                 INSERT INTO orders (
@@ -362,6 +367,9 @@ def run_sync(dry_run=False):
             ))
             order_db_id = cursor.lastrowid
             orders_stored += 1
+            if not order_full.get('deleted', False):
+                day = (order_full.get('closedDate') or datetime.now().isoformat())[:10]
+                order_stats.append((day, order_full.get('totalAmount'), order_full.get('taxAmount'), order_full.get('tipAmount')))
             
             selections = order_full.get('selections', [])
             if not selections and 'checks' in order_full:
@@ -380,11 +388,11 @@ def run_sync(dry_run=False):
                 ''', (order_db_id, item_guid, item_name, quantity, selection.get('unitPrice', 0), selection.get('totalPrice', 0), json.dumps(selection.get('modifiers', []))))
                 order_item_id = cursor.lastrowid
                 
-                cursor.execute('SELECT ingredient_id, quantity FROM recipe_components WHERE menu_item_guid = ?', (item_guid,))
+                cursor.execute('SELECT ingredient_id, COALESCE(stock_quantity, quantity) AS stock_quantity FROM recipe_components WHERE menu_item_guid = ?', (item_guid,))
                 for component in cursor.fetchall():
                     ing_id = component['ingredient_id']
-                    required_qty = component['quantity'] * quantity
-                    cursor.execute('UPDATE ingredients SET current_stock = current_stock - ? WHERE id = ?', (float(required_qty), ing_id))
+                    required_qty = component['stock_quantity'] * quantity
+                    stock_changes.append((ing_id, -float(required_qty), order_preview['guid']))
                     cursor.execute('''
                         INSERT INTO order_deductions (
                             order_id, order_item_id, ingredient_id, quantity_deducted, timestamp
@@ -392,12 +400,14 @@ def run_sync(dry_run=False):
                     ''', (order_db_id, order_item_id, ing_id, float(required_qty), datetime.now().isoformat()))
                     deductions_count += 1
 
+        apply_stock_deltas(cursor, stock_changes, 'sale')
+        add_order_stats(cursor, order_stats)
         conn.commit()
         save_sync_time(end_time_str)
         return True, f"Successfully synced {orders_stored} new orders. {deductions_count} inventory deductions logged."
 
     except Exception as e:
-        log(f"Error during sync: {e}")
+        log(f"Error during sync: {e}", logging.ERROR)
         conn.rollback()
         return False, f"Sync error: {str(e)}"
     finally:
@@ -0,0 +1,258 @@
+"""
+Units of Measure
+Converts recipe quantities into the unit each ingredient is stocked in. Standard
+mass, volume and count units convert directly; anything else (cases, bottles,
+slices) goes through per-ingredient pack sizes in ingredient_units. Factors are
+compiled into recipe_components.stock_quantity whenever a recipe, an ingredient's
+stock unit or a pack size changes, so deductions stay a single multiply. Pack
+sizes are held in the stock unit and are rescaled when it changes.
+"""
+
+from src.database import get_connection, bump_version, IN_CLAUSE_CHUNK
+from src.plate_costs import refresh_menu_items
+
+UNIT_ALIASES = {
+    'g': ('gram', 'grams', 'gr'),
+    'kg': ('kgs', 'kilogram', 'kilograms', 'kilo', 'kilos'),
+    'oz': ('ounce', 'ounces'),
+    'lb': ('lbs', 'pound', 'pounds'),
+    'ml': ('milliliter', 'millilitre', 'milliliters', 'millilitres'),
+    'l': ('liter', 'litre', 'liters', 'litres'),
+    'tsp': ('teaspoon', 'teaspoons'),
+    'tbsp': ('tablespoon', 'tablespoons'),
+    'fl oz': ('floz', 'fl. oz', 'fluid ounce', 'fluid ounces'),
+    'cup': ('cups',),
+    'pint': ('pints', 'pt'),
+    'quart': ('quarts', 'qt'),
+    'gallon': ('gallons', 'gal'),
+    'each': ('ea', 'pc', 'pcs', 'piece', 'pieces', 'unit', 'units'),
+    'dozen': ('dz',)
+}
+# Pack units are free text; these plurals name the same pack as their singular
+PACK_ALIASES = {
+    'slice': ('slices',),
+    'case': ('cases',),
+    'box': ('boxes',),
+    'patty': ('patties',),
+    'bottle': ('bottles',),
+    'can': ('cans',),
+    'bag': ('bags',),
+    'pack': ('packs',),
+    'tray': ('trays',),
+    'jar': ('jars',),
+    'tub': ('tubs',),
+    'sleeve': ('sleeves',),
+    'carton': ('cartons',),
+    'loaf': ('loaves',),
+    'portion': ('portions',),
+    'pump': ('pumps',),
+    'scoop': ('scoops',)
+}
+_ALIASES = {alias: unit for table in (UNIT_ALIASES, PACK_ALIASES)
+            for unit, aliases in table.items() for alias in aliases}
+
+# Size of each standard unit in its dimension's base unit (grams, millilitres, items)
+DIMENSIONS = {
+    'mass': {'g': 1.0, 'kg': 1000.0, 'oz': 28.349523125, 'lb': 453.59237},
+    'volume': {'ml': 1.0, 'l': 1000.0, 'tsp': 4.92892159375, 'tbsp': 14.78676478125, 'fl oz': 29.5735295625,
+               'cup': 236.5882365, 'pint': 473.176473, 'quart': 946.352946, 'gallon': 3785.411784},
+    'count': {'each': 1.0, 'dozen': 12.0}
+}
+_DIMENSION_OF = {unit: name for name, units in DIMENSIONS.items() for unit in units}
+
+
+def normalize_unit(unit):
+    unit = (unit or '').strip().lower()
+    return _ALIASES.get(unit, unit)
+
+
+def _standard_factor(from_unit, to_unit):
+    """How many `to_unit` are in one `from_unit` when both are standard units, else None"""
+    # 'oz' next to a volume unit means fluid ounces
+    if from_unit == 'oz' and _DIMENSION_OF.get(to_unit) == 'volume':
+        from_unit = 'fl oz'
+    if to_unit == 'oz' and _DIMENSION_OF.get(from_unit) == 'volume':
+        to_unit = 'fl oz'
+    dimension = _DIMENSION_OF.get(from_unit)
+    if dimension is None or dimension != _DIMENSION_OF.get(to_unit):
+        return None
+    return DIMENSIONS[dimension][from_unit] / DIMENSIONS[dimension][to_unit]
+
+
+def conversion_factor(recipe_unit, stock_unit, packs=None):
+    """
+    Stock units in one `recipe_unit`. packs: {normalized unit: stock units in one of it}
+    for the ingredient. Raises ValueError when there is no path between the units.
+    """
+    recipe_unit, stock_unit = normalize_unit(recipe_unit), normalize_unit(stock_unit)
+    packs = packs or {}
+    if not recipe_unit or recipe_unit == stock_unit:
+        return 1.0
+    if recipe_unit in packs:
+        return packs[recipe_unit]
+    factor = _standard_factor(recipe_unit, stock_unit)
+    if factor is not None:
+        return factor
+    # e.g. grams against a 'case' stock unit with a pack size given in kg
+    for pack_unit, stock_units in packs.items():
+        factor = _standard_factor(recipe_unit, pack_unit)
+        if factor is not None:
+            return factor * stock_units
+    raise ValueError(f"No conversion from '{recipe_unit}' to '{stock_unit}'; add a pack size for it")
+
+
+def load_units(cursor, ingredient_ids):
+    """{ingredient_id: (stock unit, {unit: stock units})} for the given ingredients"""
+    ids = list(dict.fromkeys(i for i in ingredient_ids if i is not None))
+    found = {}
+    for start in range(0, len(ids), IN_CLAUSE_CHUNK):
+        chunk = ids[start:start + IN_CLAUSE_CHUNK]
+        placeholders = ','.join('?' * len(chunk))
+        cursor.execute(f'SELECT id, unit FROM ingredients WHERE id IN ({placeholders})', chunk)
+        for row in cursor.fetchall():
+            found[row[0]] = (row[1], {})
+        cursor.execute(f'SELECT ingredient_id, unit, stock_units FROM ingredient_units WHERE ingredient_id IN ({placeholders})', chunk)
+        for ingredient_id, unit, stock_units in cursor.fetchall():
+            if ingredient_id in found:
+                found[ingredient_id][1][normalize_unit(unit)] = stock_units
+    return found
+
+
+def compile_components(cursor, components, units=None):
+    """
+    Resolve [{'ingredient_id', 'quantity', 'unit'?}, ...] to
+    [(ingredient_id, quantity, unit, conversion_factor, stock_quantity), ...]
+    units: result of load_units() when the caller already has it
+    """
+    if units is None:
+        units = load_units(cursor, [item['ingredient_id'] for item in components])
+    compiled = []
+    for item in components:
+        ingredient_id = item['ingredient_id']
+        unit = (item.get('unit') or '').strip() or None
+        quantity = float(item['quantity'])
+        if unit is None:
+            factor = 1.0
+        elif ingredient_id not in units:
+            raise ValueError(f"Unknown ingredient '{ingredient_id}'")
+        else:
+            stock_unit, packs = units[ingredient_id]
+            try:
+                factor = conversion_factor(unit, stock_unit, packs)
+            except ValueError as e:
+                raise ValueError(f"{ingredient_id}: {e}")
+        compiled.append((ingredient_id, quantity, unit, factor, quantity * factor))
+    return compiled
+
+
+def recompile_ingredients(cursor, ingredient_ids):
+    """
+    Refresh compiled factors of components using these ingredients after their stock
+    unit or pack sizes changed. Returns the menu item GUIDs whose recipes changed.
+    """
+    ids = list(dict.fromkeys(ingredient_ids))
+    rows = []
+    for start in range(0, len(ids), IN_CLAUSE_CHUNK):
+        chunk = ids[start:start + IN_CLAUSE_CHUNK]
+        placeholders = ','.join('?' * len(chunk))
+        cursor.execute(f'''
+            SELECT id, menu_item_guid, ingredient_id, quantity, unit, conversion_factor
+            FROM recipe_components
+            WHERE unit IS NOT NULL AND ingredient_id IN ({placeholders})
+        ''', chunk)
+        rows.extend(cursor.fetchall())
+    if not rows:
+        return set()
+
+    compiled = compile_components(cursor, [{'ingredient_id': row[2], 'quantity': row[3] or 0, 'unit': row[4]} for row in rows])
+    updates = [(factor, stock_quantity, row[0])
+               for row, (_, _, _, factor, stock_quantity) in zip(rows, compiled) if factor != row[5]]
+    cursor.executemany('UPDATE recipe_components SET conversion_factor = ?, stock_quantity = ? WHERE id = ?', updates)
+    changed_ids = {component_id for _, _, component_id in updates}
+    return {row[1] for row in rows if row[0] in changed_ids}
+
+
+def rescale_pack_sizes(cursor, ingredient_id, old_unit, new_unit):
+    """
+    Re-express an ingredient's pack sizes in its new stock unit (e.g. 0.05 kg -> 0.11 lb).
+    Raises ValueError when pack sizes exist and the old unit does not convert to the new one.
+    """
+    old_unit, new_unit = normalize_unit(old_unit), normalize_unit(new_unit)
+    if old_unit == new_unit:
+        return 0
+    cursor.execute('SELECT COUNT(*) FROM ingredient_units WHERE ingredient_id = ?', (ingredient_id,))
+    if not cursor.fetchone()[0]:
+        return 0
+    factor = _standard_factor(old_unit, new_unit)
+    if factor is None:
+        raise ValueError(f"Pack sizes of '{ingredient_id}' are in '{old_unit}' and cannot be converted "
+                         f"to '{new_unit}'; remove them before changing the stock unit")
+    cursor.execute('UPDATE ingredient_units SET stock_units = stock_units * ? WHERE ingredient_id = ?',
+                   (factor, ingredient_id))
+    return cursor.rowcount
+
+
+def _after_units_change(cursor, ingredient_id):
+    changed = recompile_ingredients(cursor, [ingredient_id])
+    if changed:
+        bump_version(cursor, 'recipes')
+        refresh_menu_items(cursor, changed)
+    return len(changed)
+
+
+def get_ingredient_units(ingredient_id):
+    """Pack sizes for an ingredient: [{'unit', 'stock_units'}, ...]"""
+    conn = get_connection()
+    try:
+        cursor = conn.cursor()
+        cursor.execute('SELECT unit, stock_units FROM ingredient_units WHERE ingredient_id = ? ORDER BY unit', (ingredient_id,))
+        return [dict(row) for row in cursor.fetchall()]
+    finally:
+        conn.close()
+
+
+def set_ingredient_unit(ingredient_id, unit, stock_units):
+    """Define how many stock units one `unit` holds (e.g. 1 case = 24); returns recipes recompiled"""
+    unit = normalize_unit(unit)
+    stock_units = float(stock_units)
+    if not unit or stock_units <= 0:
+        raise ValueError("unit and a positive stock_units are required")
+    conn = get_connection()
+    cursor = conn.cursor()
+    try:
+        cursor.execute('BEGIN IMMEDIATE')
+        cursor.execute('SELECT 1 FROM ingredients WHERE id = ?', (ingredient_id,))
+        if not cursor.fetchone():
+            raise ValueError(f"Ingredient '{ingredient_id}' not found")
+        cursor.execute('''
+            INSERT INTO ingredient_units (ingredient_id, unit, stock_units) VALUES (?, ?, ?)
+            ON CONFLICT(ingredient_id, unit) DO UPDATE SET stock_units = excluded.stock_units
+        ''', (ingredient_id, unit, stock_units))
+        recompiled = _after_units_change(cursor, ingredient_id)
+        conn.commit()
+        return recompiled
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+
+
+def delete_ingredient_unit(ingredient_id, unit):
+    """Remove a pack size; fails if a recipe still needs it to convert"""
+    conn = get_connection()
+    cursor = conn.cursor()
+    try:
+        cursor.execute('BEGIN IMMEDIATE')
+        cursor.execute('DELETE FROM ingredient_units WHERE ingredient_id = ? AND unit = ?',
+                       (ingredient_id, normalize_unit(unit)))
+        deleted = cursor.rowcount > 0
+        if deleted:
+            _after_units_change(cursor, ingredient_id)
+        conn.commit()
+        return deleted
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
@@ -0,0 +1,146 @@
+"""
+Usage Variance
+Theoretical (recipe) usage vs. actual shelf usage per ingredient and period.
+Daily movement totals since the start of the range are loaded column-wise into
+NumPy arrays and binned into an ingredient x period matrix in one pass; opening
+and closing balances are worked backwards from current_stock.
+"""
+
+from datetime import date, timedelta
+import numpy as np
+from src.database import get_connection
+
+PERIODS = ('day', 'week', 'month')
+MAX_PERIODS = 400
+
+# Movement columns (first axis of the movement matrix)
+THEORETICAL, RECEIVED, WASTE, ADDITIONS, CORRECTIONS = range(5)
+
+# Every stock movement as (ingredient_id, day, column, signed amount). Sales, receipts
+# and waste come pre-summed per day from daily_ingredient_stats (kept in step with
+# order_deductions, goods_inward and inventory_adjustments); only the rarer additions,
+# stock-count corrections and manual edits are read row by row.
+MOVEMENTS_SQL = '''
+    SELECT ingredient_id, day, 0, -deducted FROM daily_ingredient_stats WHERE day >= ? AND deducted != 0
+    UNION ALL
+    SELECT ingredient_id, day, 1, received FROM daily_ingredient_stats WHERE day >= ? AND received != 0
+    UNION ALL
+    SELECT ingredient_id, day, 2, -wasted FROM daily_ingredient_stats WHERE day >= ? AND wasted != 0
+    UNION ALL
+    SELECT ingredient_id, substr(timestamp, 1, 10), CASE WHEN movement_type = 'count' THEN 4 ELSE 3 END,
+           CASE WHEN type = 'Addition' THEN quantity ELSE -quantity END
+    FROM inventory_adjustments
+    WHERE timestamp >= ? AND (type = 'Addition' OR movement_type = 'count')
+    UNION ALL
+    SELECT ingredient_id, substr(timestamp, 1, 10), 4, delta
+    FROM stock_ledger WHERE movement_type = 'manual' AND timestamp >= ?
+'''
+
+
+def period_bounds(start, end, period='week'):
+    """Boundary dates [start, ..., end]; weeks step 7 days from start, months snap to the 1st"""
+    if period not in PERIODS:
+        raise ValueError(f"period must be one of {', '.join(PERIODS)}")
+    if start >= end:
+        raise ValueError("start must be before end")
+    bounds = [start]
+    while bounds[-1] < end:
+        current = bounds[-1]
+        if period == 'day':
+            nxt = current + timedelta(days=1)
+        elif period == 'week':
+            nxt = current + timedelta(days=7)
+        else:
+            nxt = date(current.year + current.month // 12, current.month % 12 + 1, 1)
+        bounds.append(min(nxt, end))
+        if len(bounds) > MAX_PERIODS + 1:
+            raise ValueError(f"Too many periods (max {MAX_PERIODS}); use a coarser period")
+    return bounds
+
+
+def variance_report(start=None, end=None, period='week', ingredient_id=None):
+    """
+    Per ingredient and period: opening, received, theoretical use, waste, other additions,
+    corrections (counts and manual edits), closing, actual use and variance.
+    start is inclusive and end exclusive (YYYY-MM-DD); defaults to the last four weeks.
+    """
+    end_day = date.fromisoformat(end[:10]) if end else date.today() + timedelta(days=1)
+    start_day = date.fromisoformat(start[:10]) if start else end_day - timedelta(days=28)
+    bounds = period_bounds(start_day, end_day, period)
+    n_periods = len(bounds) - 1
+    start_str = start_day.isoformat()
+
+    conn = get_connection()
+    cursor = conn.cursor()
+    try:
+        if ingredient_id:
+            cursor.execute('SELECT id, name, unit, current_stock, cost_per_unit FROM ingredients WHERE id = ?', (ingredient_id,))
+        else:
+            cursor.execute('SELECT id, name, unit, current_stock, cost_per_unit FROM ingredients ORDER BY name')
+        ingredients = cursor.fetchall()
+        cursor.row_factory = None
+        cursor.execute(MOVEMENTS_SQL, (start_str,) * 5)
+        movements = cursor.fetchall()
+    finally:
+        conn.close()
+
+    index = {row['id']: i for i, row in enumerate(ingredients)}
+    n = len(ingredients)
+    current = np.array([float(row['current_stock'] or 0) for row in ingredients])
+    costs = np.array([float(row['cost_per_unit'] or 0) for row in ingredients])
+
+    # Last column collects everything after `end`, needed to walk back from current_stock
+    matrix = np.zeros((5, n, n_periods + 1))
+    if movements:
+        ids, days, columns, deltas = zip(*movements)
+        ing = np.fromiter((index.get(i, -1) for i in ids), dtype=np.int64, count=len(ids))
+        periods = np.searchsorted(np.array([b.isoformat() for b in bounds]),
+                                  np.array(days, dtype=str), side='right') - 1
+        keep = ing >= 0
+        np.add.at(matrix,
+                  (np.array(columns, dtype=np.int64)[keep], ing[keep], np.minimum(periods[keep], n_periods)),
+                  np.array(deltas, dtype=float)[keep])
+
+    net = matrix.sum(axis=0)
+    # after[:, p] = net change from the start of period p until now
+    after = np.cumsum(net[:, ::-1], axis=1)[:, ::-1]
+    closing = current[:, None] - after[:, 1:]
+    opening = closing - net[:, :n_periods]
+
+    theoretical = -matrix[THEORETICAL, :, :n_periods]
+    received = matrix[RECEIVED, :, :n_periods]
+    waste = -matrix[WASTE, :, :n_periods]
+    additions = matrix[ADDITIONS, :, :n_periods]
+    corrections = matrix[CORRECTIONS, :, :n_periods]
+    # What left the shelf = opening + in - waste - closing, which differs from the
+    # recipe figure by whatever counts and manual edits had to correct
+    actual = opening + received + additions - waste - closing
+    variance = actual - theoretical
+    variance_cost = variance * costs[:, None]
+
+    columns = {
+        'opening': opening, 'received': received, 'theoretical': theoretical, 'waste': waste,
+        'additions': additions, 'corrections': corrections, 'closing': closing,
+        'actual': actual, 'variance': variance, 'variance_cost': variance_cost
+    }
+    rounded = {name: np.round(values, 4) for name, values in columns.items()}
+    active = (np.abs(matrix[:, :, :n_periods]).sum(axis=(0, 2)) > 0) | (np.abs(opening[:, 0]) > 0)
+
+    report = []
+    for i in np.flatnonzero(active):
+        row = ingredients[i]
+        entry = {'id': row['id'], 'name': row['name'], 'unit': row['unit'], 'cost_per_unit': costs[i]}
+        entry.update({name: values[i].tolist() for name, values in rounded.items()})
+        entry['totals'] = {
+            'opening': float(rounded['opening'][i, 0]),
+            'closing': float(rounded['closing'][i, -1]),
+            **{name: round(float(columns[name][i].sum()), 4)
+               for name in ('received', 'theoretical', 'waste', 'additions', 'corrections', 'actual', 'variance', 'variance_cost')}
+        }
+        report.append(entry)
+
+    return {
+        'period': period,
+        'periods': [{'start': a.isoformat(), 'end': b.isoformat()} for a, b in zip(bounds, bounds[1:])],
+        'ingredients': report
+    }